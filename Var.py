@@ -1,19 +1,89 @@
 import numpy
 
-class Var(object):
-    def __init__(self, name, vtype):
-        self.name = name
-        self.type = vtype
-        self.storage = numpy.zeros(1, dtype=vtype)
+# ROOT leaf type code and numpy dtype per python type
+leaf_types = {
+    int: ('I', numpy.int32),
+    float: ('D', numpy.float64),
+    numpy.float32: ('F', numpy.float32),
+    numpy.uint8: ('b', numpy.uint8),
+}
+
+
+class RecordBuffer(object):
+    '''Holds the branch values of one tree entry. All slots of the same leaf
+    type live in one numpy array, such that a reset is a single vectorised
+    assignment per type and every branch address points into these arrays.
+    '''
+
+    default = -999
+    # Bit masks are empty by default
+    defaults = {'b': 0}
+
+    def __init__(self, variables):
+        '''variables: list of (name, python type)'''
+        counts = {}
+        self.names = []
+        self.types = {}
+        self.slots = {}
+        for name, vtype in variables:
+            if name in self.slots:
+                continue
+            leaf = leaf_types[vtype][0]
+            self.slots[name] = (leaf, counts.get(leaf, 0))
+            counts[leaf] = counts.get(leaf, 0) + 1
+            self.names.append(name)
+            self.types[name] = vtype
+
+        self.arrays = {leaf: numpy.zeros(counts[leaf], dtype=dtype)
+                       for leaf, dtype in leaf_types.values() if leaf in counts}
+        self.slots = {name: (self.arrays[leaf], index)
+                      for name, (leaf, index) in self.slots.iteritems()}
+
+    def bind(self, tree):
+        '''Creates one branch per variable, addressing the slot in the buffer'''
+        for name in self.names:
+            values, index = self.slots[name]
+            tree.Branch(name, values[index:index + 1],
+                        name + '/' + leaf_types[self.types[name]][0])
 
     def reset(self):
-        self.storage[0] = -999
+        for leaf, values in self.arrays.iteritems():
+            values.fill(self.defaults.get(leaf, self.default))
+
+    def slot(self, name):
+        '''Returns (array, index) to fill a variable without name lookup'''
+        return self.slots[name]
+
+    def slotGroup(self, names):
+        '''Returns a SlotGroup filling the variables names at once'''
+        return SlotGroup(self, names)
+
+    def __setitem__(self, name, val):
+        values, index = self.slots[name]
+        values[index] = val
+
+    def __getitem__(self, name):
+        values, index = self.slots[name]
+        return values[index]
+
 
-    def fill(self, val):
-        self.storage[0] = val
+class SlotGroup(object):
+    '''Fills a fixed list of variables of a RecordBuffer from a list of
+    values, scattered to the per-type arrays with indices resolved once'''
 
-    def add(self, val):
-        self.storage[0] += val
+    def __init__(self, record, names):
+        self.names = list(names)
+        by_array = {}
+        for i_name, name in enumerate(self.names):
+            values, index = record.slot(name)
+            by_array.setdefault(id(values), (values, [], []))
+            by_array[id(values)][1].append(index)
+            by_array[id(values)][2].append(i_name)
+        self.scatter = [(values, numpy.array(indices), numpy.array(sources))
+                        for values, indices, sources in by_array.itervalues()]
 
-    def __str__(self):
-        return 'Var: name={}, vtype={}, val={:.2f}'.format(self.name, self.type, self.storage[0])
+    def fill(self, values):
+        '''values in the order of names'''
+        values = numpy.array(values, dtype=numpy.float64)
+        for array, indices, sources in self.scatter:
+            array[indices] = values[sources]
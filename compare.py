@@ -5,6 +5,8 @@ Authors: Yuta Takahashi, Michal Bluj, Jan Steggemann.
 
 import re
 import warnings
+import multiprocessing
+from time import time
 from array import array
 from collections import namedtuple
 
@@ -12,9 +14,14 @@ from collections import namedtuple
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 from officialStyle import officialStyle
-from variables import vardict, hvardict, cvardict
-from compareTools import overlay, hoverlay, coverlay, makeEffPlotsVars, fillSampledic, findLooseId, shiftAlongX
-
+from variables import vardict, hvardict, cvardict, addSolvedWPs
+from compareTools import overlay, hoverlay, coverlay, bookEffCube, projectEffCube, projectEffCube2D, makeEffGraph, makeEffMap, drawEffMaps, fillSampledic, findLooseId, shiftAlongX, getLeaves
+
+from hist_engine import HistEngine, ColumnarEngine
+from hist_cache import HistCache
+from event_join import EventJoin
+from scheduler import PlotJob, estimateCost, schedule, loadCosts, recordCosts, mergeCosts
+from triage import Triage, recordScores, mergeScores
 from ROOT import gROOT, gStyle, TH1F, TH2F
 
 import argparse
@@ -55,20 +62,57 @@ def word_finder(expr):
     return [w for w in words if not is_number(w) and w not in ['min', 'max']]
 
 
+def cubeAxes(rdict):
+    '''Axes of the efficiency cubes that can be filled from the tree'''
+    return [axis for axis in eff_cube_axes
+            if set(word_finder(axis[1])).issubset(rdict['leaves'])]
+
+
+def effTitles():
+    '''Cube axis -> (axis title, name suffix)'''
+    return {
+        'pt': (options_dict[runtype].xlabel, ''),
+        'eta': (options_dict[runtype].xlabel_eta, '_eta'),
+        'dm': ('gen. decay mode', '_dm'),
+        'pu': ('no. of pileup', '_pu'),
+    }
+
+
+def effAxes():
+    '''(cube axis, x title, name suffix) of the efficiency plots to make'''
+    titles = effTitles()
+    return [(name,) + titles[name] for name in args.effAxes]
+
+
+def effMapAxes():
+    '''(x axis, y axis, x title, y title, name suffix) of the efficiency
+    maps to make'''
+    titles = effTitles()
+    return [(x, y, titles[x][0], titles[y][0], '_map_{}_{}'.format(x, y))
+            for x, y in [eff_map.split(':') for eff_map in args.effMaps]]
+
+
+def effImage(header):
+    '''File of the efficiency plot in the all directory, see overlay'''
+    eta = '_eta' if '_eta' in header else ''
+    return 'compare_{}/all{}/{}.png'.format(runtype, eta, header.replace(' ', '').replace('&&', ''))
+
+
 def efficiency_plots(d_sample, var_name, hdict):
-    graphs = []
-    graphs_eta = []
+    '''Books the efficiency cubes and returns the function that makes
+    the plots once the engines have run'''
+    cubes = []
 
     for rel, rdict in sorted(d_sample.items(), key=lambda item: item[1]["index"]):
         tree = rdict['tree']
         if 'leaves' not in rdict:
-            rdict['leaves'] = [leaf.GetName() for leaf in tree.GetListOfLeaves()]
+            rdict['leaves'] = getLeaves(tree)
         used_vars = word_finder(hdict['var'])
         if not set(used_vars).issubset(rdict['leaves']):
             with open('missing_leaves.txt', 'a+') as f:
-              print >> f, var_name + ' is missing in input file ' + rdict['file'].GetName()
+              print >> f, var_name + ' is missing in input file ' + rdict['source']
             warnings.warn(
-                var_name + ' is missing in input file ' + rdict['file'].GetName())
+                var_name + ' is missing in input file ' + rdict['source'])
             return
         num_sel = reco_cut
         den_sel = '1'
@@ -79,49 +123,55 @@ def efficiency_plots(d_sample, var_name, hdict):
         rel = "tauReco @ miniAOD" if rel=="slimmedTaus_slimmedTaus" else "tauReco @ AOD"
 
         for mvaIDname, sel in discriminators.items():
-            graphs.append(makeEffPlotsVars(tree=tree,
-                                           varx='tau_genpt',
-                                           numeratorAddSelection=num_sel +
-                                           '&&' + hdict['var'],
-                                           baseSelection=sel,
-                                           binning=ptPlotsBinning,
-                                           xtitle=options_dict[runtype].xlabel,
-                                           header=rel + mvaIDname, addon=rel + mvaIDname,
-                                           marker=rdict['marker'],
-                                           col=rdict['col']))
-
-            graphs_eta.append(makeEffPlotsVars(tree=tree,
-                                               varx='tau_geneta',
-                                               numeratorAddSelection=num_sel +
-                                               '&&' + hdict['var'],
-                                               baseSelection=sel,
-                                               binning=etaPlotsBinning,
-                                               xtitle=options_dict[runtype].xlabel_eta,
-                                               header=rel + mvaIDname, addon=rel + mvaIDname,
-                                               marker=rdict['marker'],
-                                               col=rdict['col']))
-
-    overlay(graphs=graphs,
-            header=var_name,
-            addon=hdict['title'],
-            runtype=runtype,
-            tlabel=options_dict[runtype].tlabel)
-
-    overlay(graphs=graphs_eta,
-            header=var_name + '_eta',
-            addon=hdict['title'] + '_eta',
-            runtype=runtype,
-            tlabel=options_dict[runtype].tlabel)
+            style = dict(header=rel + mvaIDname,
+                         marker=rdict['marker'],
+                         col=rdict['col'])
+            # One fill for all efficiency plots of the discriminator
+            cubes.append((bookEffCube(engine=rdict['engine'],
+                                      numeratorAddSelection=num_sel +
+                                      '&&' + hdict['var'],
+                                      baseSelection=sel,
+                                      axes=cubeAxes(rdict),
+                                      addon=rel + mvaIDname),
+                          style))
+
+    def plot():
+        for axis, xtitle, suffix in effAxes():
+            graphs = []
+            for eff_cubes, style in cubes:
+                eff_hists = projectEffCube(eff_cubes, axis, eff_binnings.get(axis))
+                if eff_hists:
+                    graphs.append(makeEffGraph(eff_hists, xtitle=xtitle, **style))
+            if not graphs:
+                continue
+
+            header = var_name + suffix
+            if triage.checkGraphs('eff:' + header, effImage(header), graphs):
+                overlay(graphs=graphs,
+                        header=header,
+                        addon=hdict['title'] + suffix,
+                        runtype=runtype,
+                        tlabel=options_dict[runtype].tlabel)
+
+        for x, y, xtitle, ytitle, suffix in effMapAxes():
+            maps = []
+            for eff_cubes, style in cubes:
+                eff_hists = projectEffCube2D(eff_cubes, x, y)
+                if eff_hists:
+                    maps.append(makeEffMap(eff_hists, xtitle=xtitle, ytitle=ytitle, header=style['header']))
+            if maps:
+                drawEffMaps(maps, var_name + suffix, runtype, options_dict[runtype].tlabel)
+    return plot
 
 
 def eff_plots_single(d_sample, vars_to_compare, var_dict):
     '''Adapted from Olena's code - can possibly merge it with efficiency_plots
+    Like efficiency_plots, returns the plotting function.
     '''
     if not vars_to_compare:
         return
 
-    hists = []
-    histseta = []
+    cubes = []
 
     for index, var_name in enumerate(vars_to_compare):
         hdict = var_dict[var_name]
@@ -131,11 +181,11 @@ def eff_plots_single(d_sample, vars_to_compare, var_dict):
         for _, rdict in sorted(d_sample.items(), key=lambda item: item[1]["index"]):
             tree = rdict['tree']
             if 'leaves' not in rdict:
-                rdict['leaves'] = [leaf.GetName() for leaf in tree.GetListOfLeaves()]
+                rdict['leaves'] = getLeaves(tree)
             used_vars = word_finder(hdict['var'])
             if not set(used_vars).issubset(rdict['leaves']):
                 warnings.warn(
-                    var_name + ' is missing in input file ' + rdict['file'].GetName())
+                    var_name + ' is missing in input file ' + rdict['source'])
                 return
             num_sel = reco_cut
             den_sel = '1'
@@ -146,59 +196,52 @@ def eff_plots_single(d_sample, vars_to_compare, var_dict):
             for mvaIDname, sel in discriminators.items():
                 dprint("\n\tmvaIDname:", mvaIDname, "hdict['var']:", hdict['var'])
 
-                hists.append(makeEffPlotsVars(tree=tree,
-                                              varx='tau_genpt',
-                                              numeratorAddSelection=num_sel + '&&' + hdict['var'],
-                                              baseSelection=sel,
-                                              binning=ptPlotsBinning,
-                                              xtitle=options_dict[runtype].xlabel,
-                                              header=var_name + mvaIDname, addon=var_name + mvaIDname,
-                                              marker=rdict['marker'],
-                                              col=int(colors[index])))
-
-                shiftAlongX(hists[-1], len(vars_to_compare), index)
-
-                histseta.append(makeEffPlotsVars(tree=tree,
-                                                 varx='tau_geneta',
-                                                 numeratorAddSelection=num_sel + '&&' + hdict['var'],
-                                                 baseSelection=sel,
-                                                 binning=etaPlotsBinning,
-                                                 xtitle=options_dict[runtype].xlabel_eta,
-                                                 header=var_name + mvaIDname, addon=var_name + mvaIDname,
-                                                 marker=rdict['marker'],
-                                                 col=int(colors[index])))
-
-                shiftAlongX(histseta[-1], len(vars_to_compare), index)
-
-    overlay(graphs=hists,
-            header=vars_to_compare[0],
-            addon=hdict['title'],
-            runtype=runtype,
-            tlabel=options_dict[runtype].tlabel,
-            comparePerReleaseSuffix="_comparePerRelease")
-
-    overlay(graphs=histseta,
-            header=vars_to_compare[0] + '_eta',
-            addon=hdict['title'] + '_eta',
-            runtype=runtype,
-            tlabel=options_dict[runtype].tlabel,
-            comparePerReleaseSuffix="_comparePerRelease")
+                style = dict(header=var_name + mvaIDname,
+                             marker=rdict['marker'],
+                             col=int(colors[index]))
+                cubes.append((bookEffCube(engine=rdict['engine'],
+                                          numeratorAddSelection=num_sel + '&&' + hdict['var'],
+                                          baseSelection=sel,
+                                          axes=cubeAxes(rdict),
+                                          addon=var_name + mvaIDname),
+                              style, index))
+
+    def plot():
+        for axis, xtitle, suffix in effAxes():
+            graphs = []
+            for eff_cubes, style, index in cubes:
+                eff_hists = projectEffCube(eff_cubes, axis, eff_binnings.get(axis))
+                if eff_hists:
+                    graphs.append(makeEffGraph(eff_hists, xtitle=xtitle, **style))
+                    shiftAlongX(graphs[-1], len(vars_to_compare), index)
+            if not graphs:
+                continue
+
+            overlay(graphs=graphs,
+                    header=vars_to_compare[0] + suffix,
+                    addon=hdict['title'] + suffix,
+                    runtype=runtype,
+                    tlabel=options_dict[runtype].tlabel,
+                    comparePerReleaseSuffix="_comparePerRelease")
+    return plot
 
 
 def var_plots(d_sample, var_name, hdict):
     hists = []
     trees = []
+    engines = []
 
     for rel, rdict in sorted(d_sample.items(), key=lambda item: item[1]["index"]):
 
         tree = rdict['tree']
         trees.append(tree)
+        engines.append(rdict['engine'])
         if 'leaves' not in rdict:
-            rdict['leaves'] = [leaf.GetName() for leaf in tree.GetListOfLeaves()]
+            rdict['leaves'] = getLeaves(tree)
         used_vars = word_finder(hdict['var'])
         if not set(used_vars).issubset(rdict['leaves']):
             warnings.warn(
-                var_name + ' is missing in input file ' + rdict['file'].GetName())
+                var_name + ' is missing in input file ' + rdict['source'])
             return
         hist = TH1F('h_' + var_name + '_' + rel, 'h_' + var_name +
                     '_' + rel, hdict['nbin'], hdict['min'], hdict['max'])
@@ -223,29 +266,29 @@ def var_plots(d_sample, var_name, hdict):
 
         hists.append(hist)
 
-    for i, tree in enumerate(trees):
-        if args.tau_matching:
-            if i == 0:
-                trees[0].AddFriend(trees[1], "ft")
-            elif i == 1:
-                trees[1].AddFriend(trees[0], "ft")
+    if args.tau_matching:
+        addMatchedFriends(d_sample)
 
+    for i, tree in enumerate(trees):
         if additional_selection != "":
             hdict['sel'] = hdict['sel'] + '&&' + additional_selection
         # hdict['sel'] = hdict['sel'] + '&&tau_dm==0'
 
-        if hists[i].Integral(0, hists[i].GetNbinsX() + 1) > 0:
-            hists[i].Scale(1. / hists[i].Integral(0, hists[i].GetNbinsX() + 1))
-        tree.Project(hists[i].GetName(), hdict['var'], hdict['sel'])
+        engines[i].book(hists[i], hdict['var'], hdict['sel'])
 
-    hoverlay(hists=hists,
-             xtitle=hdict['title'],
-             ytitle='a.u.',
-             name=var_name,
-             runtype=runtype,
-             tlabel=options_dict[runtype].tlabel,
-             xlabel=options_dict[runtype].xlabel,
-             xlabel_eta=options_dict[runtype].xlabel_eta)
+    def plot():
+        image = 'compare_{}/histograms/hist_{}.png'.format(runtype, var_name)
+        if not triage.checkHists('var:' + var_name, image, hists):
+            return
+        hoverlay(hists=hists,
+                 xtitle=hdict['title'],
+                 ytitle='a.u.',
+                 name=var_name,
+                 runtype=runtype,
+                 tlabel=options_dict[runtype].tlabel,
+                 xlabel=options_dict[runtype].xlabel,
+                 xlabel_eta=options_dict[runtype].xlabel_eta)
+    return plot
 
 def cvar_plots(d_sample, var_name, hdict):
     hists = []
@@ -264,12 +307,12 @@ def cvar_plots(d_sample, var_name, hdict):
             rel = "tauReco @ miniAOD"
         rels.append(rel)
         if 'leaves' not in rdict:
-            rdict['leaves'] = [leaf.GetName() for leaf in tree.GetListOfLeaves()]
+            rdict['leaves'] = getLeaves(tree)
         rdicts.append(rdict)
         used_vars = word_finder(hdict['var'])
         if not set(used_vars).issubset(rdict['leaves']):
             warnings.warn(
-                var_name + ' is missing in input file ' + rdict['file'].GetName())
+                var_name + ' is missing in input file ' + rdict['source'])
             return
     if hdict['dim'] == 1:
         hist = TH1F('h_' + var_name + '_' + rels[0], 'h_' + var_name +
@@ -279,14 +322,10 @@ def cvar_plots(d_sample, var_name, hdict):
                     '_' + rels[0], hdict['nbin'], hdict['min'], hdict['max'], hdict['nbin'], hdict['min'], hdict['max'])
 
 
-    aodtree = None
-    miniaodtree = None
     if rels[0] == "tauReco @ AOD":
-        aodtree = trees[0]
-        miniaodtree = trees[1]
+        engine = joinedEngine(rdicts[0], rdicts[1])
     elif rels[1] == "tauReco @ AOD":
-        aodtree = trees[1]
-        miniaodtree = trees[0]
+        engine = joinedEngine(rdicts[1], rdicts[0])
 
     hist.GetYaxis().SetNdivisions(507)
     hist.SetLineColor(rdicts[0]['col'])
@@ -296,8 +335,6 @@ def cvar_plots(d_sample, var_name, hdict):
     hist.Sumw2()
     hist.GetXaxis().SetTitle(hdict['title'])
 
-
-    aodtree.AddFriend(miniaodtree, "ft")
     xtitle = hdict['title']
     ytitle = 'a.u.'
 
@@ -311,33 +348,179 @@ def cvar_plots(d_sample, var_name, hdict):
         if hdict['norm'] == 'abs':
             xtitle = 'AOD ' + hdict['title'] + ' - miniAOD ' + hdict['title']
             # aodtree.Project(hist.GetName(), hdict['var'] + "-ft." + hdict['var'], hdict['sel'])
-            aodtree.Project(hist.GetName(), hdict['var'] + '-' + hdict['var'].replace('tau_', 'ft.tau_'), hdict['sel'])
+            engine.book(hist, hdict['var'] + '-' + hdict['var'].replace('tau_', 'ft.tau_'), hdict['sel'])
         elif hdict['norm'] == 'rel':
             xtitle = '(AOD ' + hdict['title'] + ' - miniAOD ' + hdict['title'] + ')/AOD ' + hdict['title']
-            aodtree.Project(hist.GetName(), '(' + hdict['var'] + '-' + hdict['var'].replace('tau_', 'ft.tau_') + ')/' + hdict['var'], hdict['sel'])
-        if hist.Integral(0, hist.GetNbinsX() + 1) > 0:
-            hist.Scale(1. / hist.Integral(0, hist.GetNbinsX() + 1))
+            engine.book(hist, '(' + hdict['var'] + '-' + hdict['var'].replace('tau_', 'ft.tau_') + ')/' + hdict['var'], hdict['sel'])
     elif hdict['dim'] == 2:
         xtitle = 'AOD ' + hdict['title']
         ytitle = 'miniAOD ' + hdict['title']
         # if hdict['norm'] == 'abs':
         #     # aodtree.Project(hist.GetName(), hdict['var'] + ":ft." + hdict['var'], hdict['sel'])
-        aodtree.Project(hist.GetName(), hdict['var'].replace('tau_', 'ft.tau_') + ':' + hdict['var'], hdict['sel'])
+        engine.book(hist, hdict['var'].replace('tau_', 'ft.tau_') + ':' + hdict['var'], hdict['sel'])
 
 
     hists.append(hist)
 
-    coverlay(hists=hists,
-             xtitle=xtitle,
-             ytitle=ytitle,
-             name=var_name,
-             runtype=runtype,
-             tlabel=options_dict[runtype].tlabel,
-             xlabel=options_dict[runtype].xlabel,
-             xlabel_eta=options_dict[runtype].xlabel_eta,
-             sellabel=additional_selection,
-             norm=hdict['norm'],
-             ndim=hdict['dim'])
+    def plot():
+        if hdict['dim'] == 1 and hist.Integral(0, hist.GetNbinsX() + 1) > 0:
+            hist.Scale(1. / hist.Integral(0, hist.GetNbinsX() + 1))
+
+        coverlay(hists=hists,
+                 xtitle=xtitle,
+                 ytitle=ytitle,
+                 name=var_name,
+                 runtype=runtype,
+                 tlabel=options_dict[runtype].tlabel,
+                 xlabel=options_dict[runtype].xlabel,
+                 xlabel_eta=options_dict[runtype].xlabel_eta,
+                 sellabel=additional_selection,
+                 norm=hdict['norm'],
+                 ndim=hdict['dim'])
+    return plot
+
+def usedLeaves(exprs, *rdicts):
+    '''Leaves of all rdicts used in exprs, without friend prefixes'''
+    used = set(word for expr in exprs for word in word_finder(expr)) - set(['ft'])
+    for rdict in rdicts:
+        if 'leaves' not in rdict:
+            rdict['leaves'] = getLeaves(rdict['tree'])
+        used &= set(rdict['leaves'])
+    return sorted(used)
+
+
+def joinedEngine(aod_rdict, miniaod_rdict):
+    '''Engine of the AOD and miniAOD taus joined by (run, lumi, event,
+    refidx), with the miniAOD columns as friend "ft". The joined dataset
+    holds the columns of all cvardict plots and is made on first use.'''
+    if 'join_engine' not in aod_rdict:
+        columns = usedLeaves([expr for c_dict in cvardict.values() for expr in [c_dict['var'], c_dict['sel']]] +
+                             [additional_selection], aod_rdict, miniaod_rdict)
+        join = EventJoin(aod_rdict['tree'], miniaod_rdict['tree'])
+        join.report('AOD', 'miniAOD')
+        joined = join.write('joined_{}_{}.root'.format(runtype, aod_rdict['index']), columns)
+        aod_rdict['join'] = join
+        aod_rdict['join_engine'] = type(aod_rdict['engine'])(joined, aod_rdict['engine'].cache)
+    return aod_rdict['join_engine']
+
+
+def addMatchedFriends(d_sample):
+    '''Attaches to each of the two trees the columns of the tau with the
+    same (run, lumi, event, refidx) in the other tree as friend "ft", with
+    ft.tau_matched = 0 for taus without partner'''
+    rdicts = [rdict for _, rdict in sorted(d_sample.items(), key=lambda item: item[1]["index"])]
+    if len(rdicts) != 2 or 'matched_friend' in rdicts[0]:
+        return
+    exprs = [h_dict['sel'] for h_dict in hvardict.values()] + [additional_selection]
+    # Only the columns used with the friend prefix are needed
+    exprs = [' '.join(re.findall(r'\bft\.(\w+)', expr)) for expr in exprs]
+    for rdict, other in [(rdicts[0], rdicts[1]), (rdicts[1], rdicts[0])]:
+        join = EventJoin(rdict['tree'], other['tree'])
+        join.report(rdict['source'], other['source'])
+        friend = join.alignedFriend('matched_{}_{}.root'.format(runtype, rdict['index']),
+                                    usedLeaves(exprs, other))
+        rdict['matched_friend'] = (join, friend)
+    for rdict in rdicts:
+        rdict['tree'].AddFriend(rdict['matched_friend'][1], 'ft')
+
+
+def listJobs(sampledict):
+    '''All plot jobs of this run with their estimated cost'''
+    n_entries = sum(rdict['tree'].GetEntries() for rdict in sampledict.values())
+    jobs = []
+    for h_name, h_dict in sorted(vardict.items()):
+        # Numerator and denominator, for pt and eta
+        jobs.append(PlotJob('eff:' + h_name, 2 * estimateCost(
+            [h_dict['var'], reco_cut, gen_cut], n_entries)))
+
+    # Add Olena's per-release/GT plots into this script
+    if variables and len(releases) == 1 and len(globaltags) == 1:
+        jobs.append(PlotJob('single:' + ','.join(variables), 2 * estimateCost(
+            [vardict[var]['var'] for var in variables] + [reco_cut, gen_cut], n_entries)))
+
+    for h_name, h_dict in sorted(hvardict.items()):
+        if runtype not in ['ZTT', 'TTbarTau', 'TenTaus', 'truetauDY'] and h_name.find('pt_resolution') != -1:
+            continue
+        jobs.append(PlotJob('var:' + h_name, estimateCost(
+            [h_dict['var'], h_dict['sel']], n_entries)))
+
+    if args.tau_matching:
+        for c_name, c_dict in sorted(cvardict.items()):
+            # Expression is evaluated for both trees
+            jobs.append(PlotJob('cvar:' + c_name, estimateCost(
+                [c_dict['var'], c_dict['var'], c_dict['sel']], n_entries)))
+    return jobs
+
+
+def bookJob(sampledict, job):
+    kind, name = job.key.split(':', 1)
+    if kind == 'eff':
+        return efficiency_plots(sampledict, name, vardict[name])
+    if kind == 'single':
+        return eff_plots_single(sampledict, name.split(','), vardict)
+    if kind == 'var':
+        return var_plots(sampledict, name, hvardict[name])
+    return cvar_plots(sampledict, name, cvardict[name])
+
+
+def runPart(part):
+    '''Makes the plots of one part of the cost-balanced schedule, or of all
+    jobs for part 0, and records the measured cost of every job'''
+    sampledict = fillSampledic(
+        globaltags, releases, runtype, inputfiles, folders,
+        engine=ColumnarEngine if args.engine == 'columnar' else HistEngine,
+        cache=HistCache(args.histCache, args.histCacheSize) if args.histCache else None)
+
+    triage.scores = {}
+    jobs = listJobs(sampledict)
+    if part != 0:
+        jobs = schedule(jobs, totalparts, loadCosts(cost_file))[part - 1]
+    print "Part", part, "makes", len(jobs), "plots"
+
+    # Plots are booked first, all histograms of a tree are then filled in
+    # one pass and the plots made from the filled histograms. The requests
+    # of each job are tagged, such that the engines measure what filling
+    # them costs on their own
+    HistEngine.profile_entries = args.profileEntries
+    plots = []
+    for index, job in enumerate(jobs):
+        print "Booking", index + 1, ":", job.key
+        HistEngine.tag = job.key
+        plots.append(bookJob(sampledict, job))
+    HistEngine.tag = None
+
+    start = time()
+    engines = []
+    for rel, rdict in sorted(sampledict.items(), key=lambda item: item[1]["index"]):
+        print "Filling histograms of", rel
+        for name in ['engine', 'join_engine']:
+            if name in rdict:
+                rdict[name].run()
+                engines.append(rdict[name])
+    profiles = {}
+    for engine in engines:
+        for tag, seconds in engine.tag_times.iteritems():
+            profiles[tag] = profiles.get(tag, 0.) + seconds
+    profile_time = sum(profiles.itervalues())
+    fill_time = time() - start - profile_time
+
+    # The filling time is shared between the jobs according to the time
+    # their histograms take to fill on their own, or to their estimate
+    # without profiling
+    if args.profileEntries:
+        shares = dict((job.key, profiles.get(job.key, 0.)) for job in jobs)
+    else:
+        shares = dict((job.key, job.estimate) for job in jobs)
+    total_share = sum(shares.itervalues())
+    measured = {}
+    for job, plot in zip(jobs, plots):
+        start = time()
+        if plot:
+            plot()
+        share = shares[job.key] / total_share if total_share else 0.
+        measured[job.key] = time() - start + fill_time * share
+    recordCosts(cost_file, part, measured)
+    recordScores(triage_file, part, triage.scores)
 
 
 if __name__ == '__main__':
@@ -357,60 +540,41 @@ if __name__ == '__main__':
     varyLooseId = args.varyLooseId
     colors = args.colors
     additional_selection = args.selection
+    if args.wpFile:
+        addSolvedWPs(args.wpFile)
 
-    sampledict = fillSampledic(
-        globaltags, releases, runtype, inputfiles, folders)
-
+    cost_file = args.costFile or 'compare_costs_{}.json'.format(runtype)
+    triage_file = args.triageFile or 'compare_{}/triage.json'.format(runtype)
+    triage = Triage(args.triageThreshold)
 
     ptPlotsBinning = array('d', [20, 200]) if args.onebin else array(
         'd', [20, 30, 40, 50, 60, 70, 80, 100, 150, 200])
     etaPlotsBinning = array('d', [-2.4, 2.4]) if args.onebin else array(
         'd', [round(-2.4 + i * 0.4, 1) for i in range(13)])
+    # All efficiency plots of a discriminator are projections of a cube
+    # over these axes, filled once; eff_binnings are the plot binnings
+    eff_cube_axes = [
+        ('pt', 'tau_genpt', list(ptPlotsBinning)),
+        ('eta', 'tau_geneta', list(etaPlotsBinning)),
+        ('dm', 'tau_gendm', [i - 1.5 for i in range(14)]),
+        ('pu', 'tau_nPU', range(0, 105, 5)),
+    ]
+    eff_binnings = {'pt': ptPlotsBinning, 'eta': etaPlotsBinning}
     reco_cut = 'tau_pt > 20 && abs(tau_eta) < 2.3'
     gen_cut = 'tau_genpt > 20 && abs(tau_geneta) < 2.3'
     # loose_id = 'tau_decayModeFinding > 0.5 && tau_byLooseCombinedIsolationDeltaBetaCorr3Hits > 0.5'
     # loose_id = 'tau_decayModeFinding > 0.5 && tau_byLooseIsolationMVArun2v1DBoldDMwLT > 0.5'
     loose_id = '1.0'
 
-    if part in [0, 1]:
-        print "First part of plots"
-        for h_name, h_dict in vardict.items():
-            efficiency_plots(sampledict, h_name, h_dict)
-
-        # Add Olena's per-release/GT plots into this script
-        if variables and len(releases) == 1 and len(globaltags) == 1:
-            eff_plots_single(sampledict, variables, vardict)
-
-        print "End first part of plots"
-    if part == 1:
-        exit()
-    elif part != 0:
-        print str(part)+". part of plots"
-
-    print "Total plots that should be made: "+str(len(hvardict.items()))
-    if part == 2:
-        for index, (h_name, h_dict) in enumerate(hvardict.iteritems()):
-            # if index >= float(len(hvardict.items())) / (totalparts-1) * (part-1): break
-            # if index < float(len(hvardict.items())) / (totalparts-1) * (part-2): continue
-
-            if runtype not in ['ZTT', 'TTbarTau', 'TenTaus', 'truetauDY'] and h_name.find('pt_resolution') != -1:
-                continue
-
-            print "Doing",index+1, ":", h_name
-            var_plots(sampledict, h_name, h_dict)
-
-    if part == 3:
-        if args.tau_matching:
-            print "Total plots that should be made: "+str(len(cvardict.items()))
-            for index, (c_name, c_dict) in enumerate(cvardict.iteritems()):
-                # if part != 0:
-                #     if index >= float(len(cvardict.items())) / (totalparts-1) * (part-1): break
-                #     if index < float(len(cvardict.items())) / (totalparts-1) * (part-2): continue
-                #
-                # if runtype not in ['ZTT', 'TTbarTau', 'TenTaus', 'truetauDY'] and c_name.find('pt_resolution') != -1:
-                #     continue
-
-                print "Doing",index+1, ":", c_name
-                cvar_plots(sampledict, c_name, c_dict)
+    if part == 0 and args.processes > 1:
+        pool = multiprocessing.Pool(min(args.processes, totalparts))
+        pool.map(runPart, range(1, totalparts + 1))
+        pool.close()
+        pool.join()
+    else:
+        runPart(part)
+    if part == 0:
+        mergeCosts(cost_file)
+        mergeScores(triage_file)
 
     print "Finished"
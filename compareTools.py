@@ -1,11 +1,18 @@
 import os
+import glob
 import errno
 import pprint
+from array import array
 
-from ROOT import TH1F, TFile, TCanvas, TPad, TLegend, \
-    TGraphAsymmErrors, Double, TLatex, TMath, TPaveStats, \
+from ROOT import TH1F, THnSparseD, TChain, TCanvas, TPad, TLegend, \
+    TGraphAsymmErrors, Double, TLatex, TPaveStats, \
     gStyle, gPad
 
+from tau_ids import add_wp_aliases
+from event_tree import add_event_friend
+from hist_engine import HistEngine, uniqueName
+from hist_arrays import histMaximum, graphYRange, ratioGraph, normalise2D
+
 pp = pprint.PrettyPrinter(indent=4)
 
 
@@ -41,7 +48,9 @@ def configureLegend(leg, ncolumn):
 
 
 def overlay(graphs, header, addon, runtype,
-            tlabel, comparePerReleaseSuffix=""):
+            tlabel, comparePerReleaseSuffix="", ratios=None, yrange=None):
+    '''Draws graphs with their ratios to the first graph below. Pre-computed
+    ratio graphs (e.g. from graphFromArrays) and y range can be passed.'''
     dir_translator = {
         "1p": "1prong",
         "1ppi0": "1prongpizero",
@@ -53,8 +62,7 @@ def overlay(graphs, header, addon, runtype,
         "newDMwo2p": "newDMwithout2prong",
     }
 
-    ymin = min(TMath.MinElement(g.GetN(), g.GetY()) for g in graphs)
-    ymax = max(TMath.MaxElement(g.GetN(), g.GetY()) for g in graphs)
+    ymin, ymax = yrange or graphYRange(graphs)
 
     c = TCanvas(tlabel)
 
@@ -86,20 +94,14 @@ def overlay(graphs, header, addon, runtype,
         legname = graph.GetName()
         # graph.GetPoint(0, x, y)
 
-        if i_graph == 0:
-            refg = graph.Clone()
-        else:
-            rp = graph.Clone()
-            for i_points in range(rp.GetN()):
-                if refg.GetPointY(i_points) != 0.0:
-                    rp.SetPoint(i_points, graph.GetPointX(i_points), graph.GetPointY(i_points)/refg.GetPointY(i_points))
-                else:
-                    rp.SetPoint(i_points, graph.GetPointX(i_points), 0.0)
-            ratio_graphs.append(rp)
+        if ratios is None and i_graph > 0:
+            ratio_graphs.append(ratioGraph(graph, graphs[0]))
 
         leg.AddEntry(graph, legname, 'lep')
 
     leg.Draw()
+    if ratios is not None:
+        ratio_graphs = ratios
 
     tex = TLatex(
         (graphs[-1].GetXaxis().GetXmin() +
@@ -210,7 +212,7 @@ def hoverlay(hists, xtitle, ytitle,
     if any(subname in name for subname in ['isoPt', 'outOfConePt', 'IsoRaw', 'deepTau']):
         pad1.SetLogy()
 
-    ymax = max([hist.GetMaximum() for hist in hists])
+    ymax = max(histMaximum(hist) for hist in hists)
     leg = TLegend(0.65, 0.65, 0.85, 0.9)
     configureLegend(leg, 1)
 
@@ -335,7 +337,7 @@ def coverlay(hists, xtitle, ytitle,
     if ndim == 2:
         c.SetLogz()
 
-    ymax = max([hist.GetMaximum() for hist in hists])
+    ymax = max(histMaximum(hist) for hist in hists)
     # leg = TLegend(0.65, 0.65, 0.85, 0.9)
     # configureLegend(leg, 1)
 
@@ -375,27 +377,8 @@ def coverlay(hists, xtitle, ytitle,
                     gStyle.SetPaintTextFormat("4.2f")
                     hist.SetMaximum(100)
                     hist.SetMinimum(0.0049)
-                if norm == "global":
-                    integral = hist.Integral(1,hist.GetNbinsX(),1,hist.GetNbinsY())
-                    for i in range(1, hist.GetNbinsX() + 1):
-                        for j in range(1, hist.GetNbinsY() + 1):
-                            bincontent = hist.GetBinContent(i,j)/integral*100 if integral > 0 else 0
-                            bincontent = min_bincontent if (bincontent > 0 and bincontent < min_bincontent) else bincontent
-                            hist.SetBinContent(i,j,bincontent)
-                elif norm == "col":
-                    for i in range(1, hist.GetNbinsX() + 1):
-                        integral = hist.Integral(i,i,1,hist.GetNbinsY())
-                        for j in range(1, hist.GetNbinsY() + 1):
-                            bincontent = hist.GetBinContent(i,j)/integral*100 if integral > 0 else 0
-                            bincontent = min_bincontent if (bincontent > 0 and bincontent < min_bincontent) else bincontent
-                            hist.SetBinContent(i,j,bincontent)
-                elif norm == "row":
-                    for j in range(1, hist.GetNbinsY() + 1):
-                        integral = hist.Integral(1,hist.GetNbinsX(),j,j)
-                        for i in range(1, hist.GetNbinsX() + 1):
-                            bincontent = hist.GetBinContent(i,j)/integral*100 if integral > 0 else 0
-                            bincontent = min_bincontent if (bincontent > 0 and bincontent < min_bincontent) else bincontent
-                            hist.SetBinContent(i,j,bincontent)
+                # global, col or row normalisation in percent
+                normalise2D(hist, norm, scale=100., min_content=min_bincontent)
                 hist.Draw("COLZ TEXT")
                 gPad.RedrawAxis()
         #     hist_TAR = hist.Clone()
@@ -550,25 +533,145 @@ def shiftAlongX(tGraph, numberOfGraphs, index):
         tGraph.SetPoint(binNumber, x, y)
 
 
-def makeEffPlotsVars(tree,
+def getLeaves(tree):
+    '''Leaf names of the tree including aliases, e.g. the single WPs of
+    packed WP branches, and the leaves of friends like per_event'''
+    leaves = [leaf.GetName() for leaf in tree.GetListOfLeaves()]
+    aliases = tree.GetListOfAliases()
+    if aliases:
+        leaves += [alias.GetName() for alias in aliases]
+    friends = tree.GetListOfFriends()
+    if friends:
+        for friend in friends:
+            leaves += [leaf.GetName() for leaf in friend.GetTree().GetListOfLeaves()]
+    return leaves
+
+
+def bookEffPlotsVars(engine,
                      varx,
                      numeratorAddSelection,
                      baseSelection,
                      binning,
-                     xtitle='', header='', addon='', marker=20, col=1):
-
-    _denomHist_ = TH1F('h_effp_' + addon,
-                       'h_effp' + addon,
-                       len(binning) - 1,
-                       binning)
-    _nominatorHist_ = TH1F('ah_effp_' + addon, 'ah_effp' + addon,
-                           len(binning) - 1,
-                           binning)
+                     addon=''):
+    '''Books numerator and denominator histograms on a HistEngine. Pass
+    the returned pair to makeEffGraph after the engine has run.'''
+    def makeHist(prefix):
+        return lambda: TH1F(uniqueName(prefix + addon),
+                            prefix[:-1] + addon,
+                            len(binning) - 1,
+                            binning)
+
+    # Denominators and repeated numerators are shared between plots;
+    # modified selections (--selection, --varyLooseId) give different keys
+    _denomHist_ = engine.bookShared(makeHist('h_effp_'), varx,
+                                    baseSelection, binning)
+    _nominatorHist_ = engine.bookShared(makeHist('ah_effp_'), varx,
+                                        baseSelection + ' && ' + numeratorAddSelection,
+                                        binning)
+    return _nominatorHist_, _denomHist_
+
+
+def bookEffCube(engine,
+                numeratorAddSelection,
+                baseSelection,
+                axes,
+                addon=''):
+    '''Books numerator and denominator efficiency cubes (THnSparseD) over
+    axes, a list of (name, expression, bin edges), on a HistEngine. All
+    efficiency plots of a discriminator are projections of its cubes, see
+    projectEffCube.'''
+    def makeCube(prefix):
+        def make():
+            cube = THnSparseD(uniqueName(prefix + addon), prefix[:-1] + addon, len(axes),
+                              array('i', [len(edges) - 1 for _, _, edges in axes]),
+                              array('d', [edges[0] for _, _, edges in axes]),
+                              array('d', [edges[-1] for _, _, edges in axes]))
+            for i_axis, (name, _, edges) in enumerate(axes):
+                cube.SetBinEdges(i_axis, array('d', edges))
+                cube.GetAxis(i_axis).SetName(name)
+            cube.Sumw2()
+            return cube
+        return make
+
+    varexp = ':'.join(expr for _, expr, _ in axes)
+    binning = tuple((name, tuple(edges)) for name, _, edges in axes)
+    _denomCube_ = engine.bookShared(makeCube('c_effp_'), varexp,
+                                    baseSelection, binning)
+    _nominatorCube_ = engine.bookShared(makeCube('ac_effp_'), varexp,
+                                        baseSelection + ' && ' + numeratorAddSelection,
+                                        binning)
+    return _nominatorCube_, _denomCube_
+
+
+def cubeAxis(cube, name):
+    for i_axis in range(cube.GetNdimensions()):
+        if cube.GetAxis(i_axis).GetName() == name:
+            return i_axis
+    return None
+
+
+def projectEffCube(cubes, name, binning=None):
+    '''Numerator and denominator histograms of the efficiency cubes on the
+    axis name, summed over all other axes including their under- and
+    overflow, and rebinned to binning (a subset of the cube bin edges).
+    Returns None if the cubes have no such axis.'''
+    hists = []
+    for cube in cubes:
+        i_axis = cubeAxis(cube, name)
+        if i_axis is None:
+            return None
+        hist = cube.Projection(i_axis, 'E')
+        hist.SetName(uniqueName('h_' + cube.GetName()))
+        if binning is not None:
+            hist = hist.Rebin(len(binning) - 1, uniqueName('h_' + cube.GetName()), binning)
+        hists.append(hist)
+    return tuple(hists)
+
+
+def projectEffCube2D(cubes, name_x, name_y):
+    '''Numerator and denominator TH2D of the efficiency cubes on two axes'''
+    hists = []
+    for cube in cubes:
+        i_x, i_y = cubeAxis(cube, name_x), cubeAxis(cube, name_y)
+        if i_x is None or i_y is None:
+            return None
+        hist = cube.Projection(i_y, i_x, 'E')
+        hist.SetName(uniqueName('h2_' + cube.GetName()))
+        hists.append(hist)
+    return tuple(hists)
+
+
+def makeEffMap(hists, xtitle='', ytitle='', header=''):
+    '''Efficiency TH2D of numerator and denominator TH2D, with binomial errors'''
+    _nominatorHist_, _denomHist_ = hists
+    h_eff = _nominatorHist_.Clone(uniqueName('h2_eff'))
+    h_eff.Divide(_nominatorHist_, _denomHist_, 1., 1., 'B')
+    h_eff.SetTitle(header)
+    h_eff.GetXaxis().SetTitle(xtitle)
+    h_eff.GetYaxis().SetTitle(ytitle)
+    h_eff.GetZaxis().SetTitle('efficiency')
+    h_eff.SetMinimum(0.)
+    h_eff.SetMaximum(1.)
+    return h_eff
+
+
+def drawEffMaps(maps, header, runtype, tlabel):
+    '''Draws the efficiency maps of all releases side by side'''
+    c = TCanvas(tlabel, '', 600 * len(maps), 500)
+    c.Divide(len(maps), 1)
+    gStyle.SetPaintTextFormat("4.2f")
+    for i_map, h_eff in enumerate(maps):
+        c.cd(i_map + 1)
+        gPad.SetRightMargin(0.15)
+        h_eff.SetMarkerSize(1.2)
+        h_eff.Draw("COLZ TEXT")
+    c.cd()
+    save(c, 'compare_' + runtype + '/all/' + header)
+    c = None
 
-    tree.Draw(varx + ' >> ' + _denomHist_.GetName(), baseSelection)
-    tree.Draw(varx + ' >> ' + _nominatorHist_.GetName(),
-              baseSelection + ' && ' + numeratorAddSelection)
 
+def makeEffGraph(hists, xtitle='', header='', marker=20, col=1):
+    _nominatorHist_, _denomHist_ = hists
     g_eff = TGraphAsymmErrors()
     g_eff.Divide(_nominatorHist_, _denomHist_, "cl=0.683 b(1,1) mode")
     g_eff.GetXaxis().SetTitle(xtitle)
@@ -587,44 +690,105 @@ def makeEffPlotsVars(tree,
     return g_eff
 
 
-def fillSampledic(globaltags, releases, runtype, inputfiles=None, trees=None):
+def makeEffPlotsVars(tree,
+                     varx,
+                     numeratorAddSelection,
+                     baseSelection,
+                     binning,
+                     xtitle='', header='', addon='', marker=20, col=1):
+    engine = HistEngine(tree)
+    hists = bookEffPlotsVars(engine, varx, numeratorAddSelection,
+                             baseSelection, binning, addon)
+    engine.run()
+    return makeEffGraph(hists, xtitle, header, marker, col)
+
+
+# Styles of the first samples; further ones are generated by sampleStyle
+styles = [
+    {'col': 1, 'marker': 26, 'width': 2},
+    {'col': 2, 'marker': 25, 'width': 2},
+    {'col': 4, 'marker': 21, 'width': 2},
+    {'col': 2, 'marker': 21, 'width': 2},
+    {'col': 7, 'marker': 24, 'width': 2},
+    {'col': 41, 'marker': 20, 'width': 2},
+    {'col': 6, 'marker': 22, 'width': 2},
+]
+style_colors = [1, 2, 4, 6, 7, 8, 9, 28, 30, 38, 41, 46]
+style_markers = [20, 21, 22, 23, 24, 25, 26, 32, 33, 34]
+
+
+def extraStyles():
+    '''All colour and marker combinations not among the styles above, walked
+    along diagonals such that consecutive ones differ in colour and mostly in
+    marker'''
+    used = [(style['col'], style['marker']) for style in styles]
+    combinations = [(style_colors[i_col], style_markers[(i_col + shift) % len(style_markers)])
+                    for shift in range(len(style_markers)) for i_col in range(len(style_colors))]
+    return [combination for combination in combinations if combination not in used]
+
+
+extra_styles = extraStyles()
+
+
+def sampleStyle(index):
+    '''Style of the index-th sample, for any number of samples: the styles
+    above, then the remaining colour and marker combinations, which only
+    repeat after 120 samples.'''
+    if index < len(styles):
+        return dict(styles[index])
+    col, marker = extra_styles[(index - len(styles)) % len(extra_styles)]
+    return {'col': col, 'marker': marker, 'width': 2}
+
+
+def sampleFiles(spec):
+    '''Files of a sample given as comma-separated file names or glob
+    patterns, e.g. "shards/Myroot_*.root". Remote URLs are kept as they are.'''
+    files = []
+    for pattern in spec.split(','):
+        matches = sorted(glob.glob(pattern)) if '://' not in pattern else []
+        files += matches or [pattern]
+    return files
+
+
+def fillSampledic(globaltags, releases, runtype, inputfiles=None, trees=None, engine=HistEngine, cache=None):
+    '''One entry per release/global tag pair with its tree as TChain over
+    all files of the sample, such that sharded productions need not be
+    merged. Files are only opened when the chain reads them.'''
     sampledict = {}
-    styles = [
-        {'col': 1, 'marker': 26, 'width': 2},
-        {'col': 2, 'marker': 25, 'width': 2},
-        {'col': 4, 'marker': 21, 'width': 2},
-        {'col': 2, 'marker': 21, 'width': 2},
-        {'col': 7, 'marker': 24, 'width': 2},
-        {'col': 41, 'marker': 20, 'width': 2},
-        {'col': 6, 'marker': 22, 'width': 2},
-    ]
+
+    jet_run_types = ['QCD', 'TTbar']
+    muon_run_types = ['ZMM', 'ZpMM']
+    ele_run_types = ['ZEE']
+    if runtype in jet_run_types:
+        runtype = runtype + "_genJets"
+    if runtype in muon_run_types:
+        runtype = runtype + "_genMuon"
+    if runtype in ele_run_types:
+        runtype = runtype + "_genEle"
 
     for index, globalTag in enumerate(globaltags):
         name = releases[index]+"_"+globalTag
-        sampledict[name] = styles[index]
-
-        jet_run_types = ['QCD', 'TTbar']
-        muon_run_types = ['ZMM', 'ZpMM']
-        ele_run_types = ['ZEE']
-        if runtype in jet_run_types:
-            runtype = runtype + "_genJets"
-        if runtype in muon_run_types:
-            runtype = runtype + "_genMuon"
-        if runtype in ele_run_types:
-            runtype = runtype + "_genEle"
+        sampledict[name] = sampleStyle(index)
 
         if not inputfiles:
-            sampledict[name]['file'] = TFile('Myroot_{}_{}_{}.root'.format(
-                releases[index],
-                globalTag,
-                runtype))
-        else:
-            sampledict[name]['file'] = TFile(inputfiles[index])
-        if not trees:
-            sampledict[name]['tree'] = sampledict[name]['file'].Get('per_tau')
+            spec = 'Myroot_{}_{}_{}.root'.format(releases[index], globalTag, runtype)
+            if not os.path.exists(spec):
+                # Unmerged shards of the production (--noMerge)
+                spec = 'Myroot_{}_{}_{}_part*.root'.format(releases[index], globalTag, runtype)
         else:
-            print trees[index]
-            sampledict[name]['tree'] = sampledict[name]['file'].Get(trees[index])
+            spec = inputfiles[index]
+        files = sampleFiles(spec)
+        sampledict[name]['source'] = spec
+
+        tree_name = trees[index] if trees else 'per_tau'
+        chain = TChain(tree_name)
+        for file_name in files:
+            # Without the number of entries the file is opened on first use
+            chain.Add(file_name)
+        sampledict[name]['tree'] = chain
+        add_wp_aliases(sampledict[name]['tree'])
+        add_event_friend(sampledict[name]['tree'])
+        sampledict[name]['engine'] = engine(sampledict[name]['tree'], cache)
 
         # adding the index such that we can sort the dictionary later to have correct ratio plots
         sampledict[name]['index'] = index
@@ -0,0 +1,225 @@
+''' Joins the taus of two productions of the same events (e.g. AOD and
+miniAOD) by (run, lumi, event, refidx) instead of by entry number, such
+that the correlation plots stay valid for sharded, reordered or partial
+productions. The keys of both trees are sorted and merge-joined with numpy;
+the matched pairs are written to a compact joined dataset (tree "joined"
+with the left and friend "ft" with the right columns, row by row) that the
+plots read without any friend lookups. Rows without partner or with a
+duplicate key are reported and also written to the joined file.
+'''
+
+import os
+import json
+
+import numpy
+import ROOT
+from ROOT import TChain, TFile, TTree, TNamed
+
+from event_tree import event_tree_name
+from hist_cache import treeFileNames
+from hist_engine import readTreeColumns
+
+key_vars = ['tau_run', 'tau_lumi', 'tau_eventid', 'tau_refidx']
+
+write_columns_code = '''
+#include "TTree.h"
+namespace tauval {
+// Fills the branches names[j] with data[j * n + i] for entries i in [0, n)
+void writeColumns(TTree* tree, const std::vector<std::string>& names,
+                  const double* data, Long64_t n) {
+  std::vector<double> values(names.size());
+  for (size_t j = 0; j < names.size(); ++j)
+    tree->Branch(names[j].c_str(), &values[j], (names[j] + "/D").c_str());
+  for (Long64_t i = 0; i < n; ++i) {
+    for (size_t j = 0; j < names.size(); ++j) values[j] = data[j * n + i];
+    tree->Fill();
+  }
+  tree->ResetBranchAddresses();
+}
+}
+'''
+
+_compiled = []
+
+
+def writeColumns(tree, names, columns):
+    '''Writes the rows of columns (shape (len(names), n)) to new branches of tree'''
+    if not _compiled:
+        _compiled.append(bool(ROOT.gInterpreter.Declare(write_columns_code)))
+    if not _compiled[0]:
+        raise RuntimeError('Cannot compile the column writer')
+    cpp_names = ROOT.std.vector('string')()
+    for name in names:
+        cpp_names.push_back(name)
+    data = numpy.ascontiguousarray(columns, dtype=numpy.float64)
+    ROOT.tauval.writeColumns(tree, cpp_names, data, data.shape[1] if data.ndim == 2 else 0)
+
+
+def plainChain(tree, name=None):
+    '''The tree read again from its files, without friends and aliases, such
+    that reading it does not load any friend entries'''
+    chain = TChain(name or tree.GetName())
+    for file_name in treeFileNames(tree):
+        chain.Add(file_name, 0)
+    return chain
+
+
+def readKeys(tree):
+    '''(run, lumi, event, refidx) of every entry, shape (4, entries), and a
+    mask of the entries whose event is known'''
+    chain = plainChain(tree)
+    if chain.GetBranch('tau_run'):
+        # Files written before per_event existed
+        keys = readTreeColumns(chain, key_vars)
+        return keys, numpy.ones(keys.shape[1], dtype=bool)
+
+    # tau_id is unique within a production, also across its shards
+    ids, refidx = readTreeColumns(chain, ['tau_id', 'tau_refidx'])
+    event_ids, runs, lumis, events = readTreeColumns(
+        plainChain(tree, event_tree_name), ['tau_id'] + key_vars[:3])
+    if not len(event_ids):
+        return numpy.zeros((len(key_vars), len(ids))), numpy.zeros(len(ids), dtype=bool)
+    order = numpy.argsort(event_ids, kind='mergesort')
+    sorted_ids = event_ids[order]
+    positions = numpy.minimum(numpy.searchsorted(sorted_ids, ids), len(order) - 1)
+    rows = order[positions]
+    keys = numpy.array([runs[rows], lumis[rows], events[rows], refidx])
+    return keys, sorted_ids[positions] == ids
+
+
+def mergeJoin(left_keys, right_keys):
+    '''Sorts the keys of both sides together and returns, for each key
+    present exactly once on both sides, the entries (left, right), ordered
+    by the left entry, plus the masks of the unique keys of each side'''
+    n_left = left_keys.shape[1]
+    keys = numpy.concatenate([left_keys, right_keys], axis=1)
+    order = numpy.lexsort(keys[::-1])
+    sorted_keys = keys[:, order]
+    new_key = numpy.ones(len(order), dtype=bool)
+    new_key[1:] = (sorted_keys[:, 1:] != sorted_keys[:, :-1]).any(axis=0)
+    ids = numpy.empty(len(order), dtype=numpy.int64)
+    ids[order] = numpy.cumsum(new_key) - 1
+    left_ids, right_ids = ids[:n_left], ids[n_left:]
+
+    n_ids = int(new_key.sum())
+    left_count = numpy.bincount(left_ids, minlength=n_ids)
+    right_count = numpy.bincount(right_ids, minlength=n_ids)
+    matched = (left_count == 1) & (right_count == 1)
+
+    right_entry = numpy.full(n_ids, -1, dtype=numpy.int64)
+    right_entry[right_ids] = numpy.arange(len(right_ids))
+    left_entries = numpy.nonzero(matched[left_ids])[0]
+    right_entries = right_entry[left_ids[left_entries]]
+    return left_entries, right_entries, left_count[left_ids] == 1, right_count[right_ids] == 1
+
+
+def sourceKey(trees, columns):
+    '''Identifies the inputs of a joined file to decide whether it is up to date'''
+    sources = []
+    for tree in trees:
+        for file_name in treeFileNames(tree):
+            stat = os.stat(file_name) if os.path.exists(file_name) else None
+            sources.append([tree.GetName(), os.path.abspath(file_name),
+                            stat.st_size if stat else 0, stat.st_mtime if stat else 0])
+    return json.dumps([sources, sorted(columns)])
+
+
+class EventJoin(object):
+    '''Matches the entries of left and right by (run, lumi, event, refidx)'''
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.left_keys, left_known = readKeys(left)
+        self.right_keys, right_known = readKeys(right)
+        left_valid = numpy.nonzero(left_known)[0]
+        right_valid = numpy.nonzero(right_known)[0]
+        left_entries, right_entries, left_unique, right_unique = mergeJoin(
+            self.left_keys[:, left_valid], self.right_keys[:, right_valid])
+        self.left_entries = left_valid[left_entries]
+        self.right_entries = right_valid[right_entries]
+        self.left_duplicates = left_valid[~left_unique]
+        self.right_duplicates = right_valid[~right_unique]
+        self.left_unmatched = numpy.setdiff1d(numpy.arange(self.left_keys.shape[1]), self.left_entries)
+        self.right_unmatched = numpy.setdiff1d(numpy.arange(self.right_keys.shape[1]), self.right_entries)
+
+    def report(self, left_name='left', right_name='right', n_show=5):
+        print 'Joined {} of {} {} and {} {} taus by (run, lumi, event, refidx)'.format(
+            len(self.left_entries), self.left_keys.shape[1], left_name,
+            self.right_keys.shape[1], right_name)
+        for name, keys, unmatched, duplicates in [
+                (left_name, self.left_keys, self.left_unmatched, self.left_duplicates),
+                (right_name, self.right_keys, self.right_unmatched, self.right_duplicates)]:
+            if not len(unmatched):
+                continue
+            print 'WARNING: {} unmatched {} taus ({} with duplicate key), e.g.'.format(
+                len(unmatched), name, len(duplicates))
+            for entry in unmatched[:n_show]:
+                print '  entry {}: run {:.0f} lumi {:.0f} event {:.0f} refidx {:.0f}'.format(
+                    entry, *keys[:, entry])
+
+    def write(self, file_name, columns):
+        '''Writes the matched pairs with the given columns to file_name and
+        returns the joined tree with the right side as friend "ft". An
+        existing file for the same inputs and columns is reused.'''
+        source_key = sourceKey([self.left, self.right], columns)
+        if not self.upToDate(file_name, source_key):
+            left_columns = readTreeColumns(self.left, columns)[:, self.left_entries]
+            right_columns = readTreeColumns(self.right, columns)[:, self.right_entries]
+
+            directory = ROOT.gDirectory.GetPath()
+            tmp_name = file_name + '.tmp{}'.format(os.getpid())
+            out_file = TFile(tmp_name, 'recreate')
+            for tree_name, names, data in [
+                    ('joined', columns, left_columns),
+                    ('ft', columns, right_columns),
+                    ('unmatched_left', key_vars, self.left_keys[:, self.left_unmatched]),
+                    ('unmatched_right', key_vars, self.right_keys[:, self.right_unmatched])]:
+                tree = TTree(tree_name, tree_name)
+                writeColumns(tree, names, data)
+                tree.Write()
+            TNamed('sources', source_key).Write()
+            out_file.Close()
+            ROOT.TDirectory.Cd(directory)
+            os.rename(tmp_name, file_name)
+
+        self.file = TFile(file_name)
+        joined = self.file.Get('joined')
+        joined.AddFriend(self.file.Get('ft'), 'ft')
+        return joined
+
+    def upToDate(self, file_name, source_key):
+        if not os.path.exists(file_name):
+            return False
+        directory = ROOT.gDirectory.GetPath()
+        in_file = TFile(file_name)
+        sources = in_file.Get('sources') if not in_file.IsZombie() else None
+        up_to_date = bool(sources) and sources.GetTitle() == source_key
+        in_file.Close()
+        ROOT.TDirectory.Cd(directory)
+        return up_to_date
+
+    def alignedFriend(self, file_name, columns):
+        '''Writes the right columns for every left entry (0 where there is
+        no partner) plus tau_matched to file_name and returns this tree,
+        which can be attached to the left tree as row-aligned friend'''
+        source_key = sourceKey([self.left, self.right], columns + ['tau_matched'])
+        if not self.upToDate(file_name, source_key):
+            n_left = self.left_keys.shape[1]
+            data = numpy.zeros((len(columns) + 1, n_left))
+            data[:-1, self.left_entries] = readTreeColumns(self.right, columns)[:, self.right_entries]
+            data[-1, self.left_entries] = 1.
+
+            directory = ROOT.gDirectory.GetPath()
+            tmp_name = file_name + '.tmp{}'.format(os.getpid())
+            out_file = TFile(tmp_name, 'recreate')
+            tree = TTree('ft', 'ft')
+            writeColumns(tree, columns + ['tau_matched'], data)
+            tree.Write()
+            TNamed('sources', source_key).Write()
+            out_file.Close()
+            ROOT.TDirectory.Cd(directory)
+            os.rename(tmp_name, file_name)
+
+        self.friend_file = TFile(file_name)
+        return self.friend_file.Get('ft')
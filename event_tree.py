@@ -0,0 +1,49 @@
+''' Layout of the per_event tree. Event quantities are stored once per event
+in per_event; the per_tau rows refer to their event via tau_id, which is
+the running event number of the production (also across its shards, which
+get distinct tau_id offsets). Attaching per_event as an indexed friend
+makes its branches available in per_tau expressions, e.g. tau_nPU or
+tau_vertex in vardict.
+'''
+
+from ROOT import TChain
+
+event_tree_name = 'per_event'
+
+event_vars = [
+    ('tau_id', int),
+    ('tau_run', int),
+    ('tau_lumi', int),
+    ('tau_eventid', int),
+    ('tau_vertex', int),
+    ('tau_nTruePU', float),
+    ('tau_nPU', int),
+]
+
+# Friend chains are not owned by a file, keep them alive
+_friend_chains = []
+
+
+def add_event_friend(tree):
+    '''Attaches the per_event tree of the same file(s) as friend indexed by
+    tau_id. For chains over several files, e.g. the unmerged shards of a
+    production, tau_id must be unique across the files. Does nothing for
+    files written before the split layout.
+    '''
+    if tree.InheritsFrom('TChain'):
+        files = [element.GetTitle() for element in tree.GetListOfFiles()]
+        if not files:
+            return None
+        event_tree = TChain(event_tree_name)
+        for file_name in files:
+            if not event_tree.Add(file_name, 0):
+                return None
+        _friend_chains.append(event_tree)
+    else:
+        in_file = tree.GetCurrentFile()
+        event_tree = in_file.Get(event_tree_name) if in_file else None
+        if not event_tree:
+            return None
+    event_tree.BuildIndex('tau_id')
+    tree.AddFriend(event_tree)
+    return event_tree
@@ -0,0 +1,226 @@
+''' Compiler for the TTree::Draw expressions of variables.py into an
+expression DAG evaluated with numpy. Expressions are tokenised like in
+compare.word_finder, parsed and stored by canonical form, such that common
+sub-expressions (e.g. "tau_pt > 20" or "tau_decayModeFinding > 0.5")
+are single nodes shared by all selections and are evaluated once per chunk
+of entries. The numeric conventions of TTreeFormula are kept: comparisons
+and logical operators give 0/1, division by zero gives 0.
+'''
+
+import re
+
+import numpy
+
+
+class ExpressionError(Exception):
+    pass
+
+
+token_re = re.compile(r'''\s*(
+    (?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?   # number
+  | [A-Za-z_]\w*(?:(?:\.|::)[A-Za-z_]\w*)*  # name, friend.name or TMath::Name
+  | &&|\|\||==|!=|<=|>=|>>|<<              # two-character operators
+  | [-+*/%^&|<>!(),]                        # one-character operators
+)''', re.VERBOSE)
+
+
+def tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        match = token_re.match(expr, pos)
+        if not match:
+            raise ExpressionError('Cannot tokenize "{}" at "{}"'.format(expr, expr[pos:]))
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def isNumber(token):
+    return token[0].isdigit() or token[0] == '.'
+
+
+def _divide(a, b):
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return numpy.where(b != 0., a / numpy.where(b != 0., b, 1.), 0.)
+
+
+def _modulo(a, b):
+    a, b = numpy.trunc(a), numpy.trunc(b)
+    return numpy.where(b != 0., numpy.fmod(a, numpy.where(b != 0., b, 1.)), 0.)
+
+
+def _bool(values):
+    return values.astype(float)
+
+
+binary_ops = {
+    '||': lambda a, b: _bool((a != 0.) | (b != 0.)),
+    '&&': lambda a, b: _bool((a != 0.) & (b != 0.)),
+    '|': lambda a, b: (a.astype(numpy.int64) | b.astype(numpy.int64)).astype(float),
+    '&': lambda a, b: (a.astype(numpy.int64) & b.astype(numpy.int64)).astype(float),
+    '==': lambda a, b: _bool(a == b),
+    '!=': lambda a, b: _bool(a != b),
+    '<': lambda a, b: _bool(a < b),
+    '<=': lambda a, b: _bool(a <= b),
+    '>': lambda a, b: _bool(a > b),
+    '>=': lambda a, b: _bool(a >= b),
+    '>>': lambda a, b: (a.astype(numpy.int64) >> b.astype(numpy.int64)).astype(float),
+    '<<': lambda a, b: (a.astype(numpy.int64) << b.astype(numpy.int64)).astype(float),
+    '+': numpy.add,
+    '-': numpy.subtract,
+    '*': numpy.multiply,
+    '/': _divide,
+    '%': _modulo,
+    '^': numpy.power,
+}
+
+# Operators whose operands can be reordered in the canonical form
+commutative_ops = ['||', '&&', '|', '&', '==', '!=', '+', '*']
+
+precedence = [['||'], ['&&'], ['|'], ['&'], ['==', '!='],
+              ['<', '<=', '>', '>='], ['>>', '<<'], ['+', '-'], ['*', '/', '%']]
+
+unary_ops = {
+    '!': lambda a: _bool(a == 0.),
+    '-': numpy.negative,
+    '+': lambda a: a,
+}
+
+functions = {
+    'abs': numpy.abs, 'fabs': numpy.abs, 'TMath::Abs': numpy.abs,
+    'min': numpy.minimum, 'TMath::Min': numpy.minimum,
+    'max': numpy.maximum, 'TMath::Max': numpy.maximum,
+    'sqrt': numpy.sqrt, 'TMath::Sqrt': numpy.sqrt,
+    'exp': numpy.exp, 'TMath::Exp': numpy.exp,
+    'log': numpy.log, 'TMath::Log': numpy.log,
+    'log10': numpy.log10, 'TMath::Log10': numpy.log10,
+    'pow': numpy.power, 'TMath::Power': numpy.power,
+    'sin': numpy.sin, 'cos': numpy.cos, 'tan': numpy.tan,
+    'atan2': numpy.arctan2, 'TMath::ATan2': numpy.arctan2,
+    'cosh': numpy.cosh, 'sinh': numpy.sinh,
+}
+
+
+class ExpressionCompiler(object):
+    '''Parses expressions into a DAG of nodes keyed by their canonical form.
+    Node types: ('num', value), ('col', name), ('op', op, a, b),
+    ('unary', op, a), ('call', function, args...).
+    '''
+
+    def __init__(self):
+        self.nodes = {}
+
+    def compile(self, expr):
+        '''Returns the canonical key of expr'''
+        self.tokens = tokenize(expr)
+        self.pos = 0
+        if not self.tokens:
+            raise ExpressionError('Empty expression')
+        key = self.parseBinary(0)
+        if self.pos != len(self.tokens):
+            raise ExpressionError('Unexpected "{}" in "{}"'.format(self.tokens[self.pos], expr))
+        return key
+
+    def add(self, key, node):
+        self.nodes.setdefault(key, node)
+        return key
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None:
+            raise ExpressionError('Unexpected end of expression')
+        if expected and token != expected:
+            raise ExpressionError('Expected "{}" but got "{}"'.format(expected, token))
+        self.pos += 1
+        return token
+
+    def parseBinary(self, level):
+        if level == len(precedence):
+            return self.parseUnary()
+        key = self.parseBinary(level + 1)
+        while self.peek() in precedence[level]:
+            op = self.take()
+            other = self.parseBinary(level + 1)
+            a, b = (key, other)
+            if op in commutative_ops:
+                a, b = sorted([key, other])
+            key = self.add('({}{}{})'.format(a, op, b), ('op', op, a, b))
+        return key
+
+    def parseUnary(self):
+        if self.peek() in unary_ops:
+            op = self.take()
+            a = self.parseUnary()
+            if op == '+':
+                return a
+            return self.add('{}({})'.format(op, a), ('unary', op, a))
+        return self.parsePower()
+
+    def parsePower(self):
+        key = self.parseAtom()
+        if self.peek() == '^':
+            self.take()
+            exponent = self.parseUnary()
+            key = self.add('({}^{})'.format(key, exponent), ('op', '^', key, exponent))
+        return key
+
+    def parseAtom(self):
+        token = self.take()
+        if token == '(':
+            key = self.parseBinary(0)
+            self.take(')')
+            return key
+        if isNumber(token):
+            value = float(token)
+            return self.add(repr(value), ('num', value))
+        if re.match(r'[A-Za-z_]', token):
+            if self.peek() == '(':
+                if token not in functions:
+                    raise ExpressionError('Unknown function ' + token)
+                self.take('(')
+                args = [self.parseBinary(0)]
+                while self.peek() == ',':
+                    self.take()
+                    args.append(self.parseBinary(0))
+                self.take(')')
+                name = functions[token].__name__
+                return self.add('{}({})'.format(name, ','.join(args)),
+                                ('call', functions[token]) + tuple(args))
+            return self.add(token, ('col', token))
+        raise ExpressionError('Unexpected "{}"'.format(token))
+
+    def columns(self, key):
+        '''Names of the tree columns used by the expression'''
+        node = self.nodes[key]
+        if node[0] == 'col':
+            return set([node[1]])
+        if node[0] == 'num':
+            return set()
+        children = node[2:]
+        return set().union(*[self.columns(child) for child in children])
+
+    def evaluate(self, key, columns, cache, size):
+        '''Evaluates the expression on a chunk. columns maps column names to
+        arrays, cache holds the arrays of already evaluated nodes.'''
+        if key in cache:
+            return cache[key]
+        node = self.nodes[key]
+        if node[0] == 'num':
+            values = numpy.full(size, node[1])
+        elif node[0] == 'col':
+            values = columns[node[1]]
+        elif node[0] == 'op':
+            values = binary_ops[node[1]](self.evaluate(node[2], columns, cache, size),
+                                         self.evaluate(node[3], columns, cache, size))
+        elif node[0] == 'unary':
+            values = unary_ops[node[1]](self.evaluate(node[2], columns, cache, size))
+        else:
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                values = node[1](*[self.evaluate(arg, columns, cache, size) for arg in node[2:]])
+        cache[key] = values
+        return values
@@ -0,0 +1,129 @@
+''' NumPy views of histogram and graph buffers for the post-processing of
+the comparison plots (normalisation, ratios, axis ranges), such that no
+Python loop walks over bins or points. The views share memory with the
+ROOT objects: writing to them changes the histogram or graph.
+'''
+
+from array import array
+
+import numpy
+from ROOT import TGraphAsymmErrors
+
+_dtypes = [('TArrayD', numpy.float64), ('TArrayF', numpy.float32),
+           ('TArrayI', numpy.int32), ('TArrayS', numpy.int16),
+           ('TArrayC', numpy.int8)]
+
+
+def _view(buf, dtype, size):
+    if hasattr(buf, 'SetSize'):
+        # PyROOT buffers do not know their length
+        buf.SetSize(size)
+    return numpy.frombuffer(buf, dtype=dtype, count=size)
+
+
+def histArray(hist):
+    '''Bin contents including under- and overflow, shape (nx + 2,) for 1D
+    and (ny + 2, nx + 2) for 2D histograms'''
+    dtype = next(dtype for base, dtype in _dtypes if hist.InheritsFrom(base))
+    values = _view(hist.GetArray(), dtype, hist.GetNcells())
+    if hist.GetDimension() == 2:
+        values = values.reshape(hist.GetNbinsY() + 2, hist.GetNbinsX() + 2)
+    return values
+
+
+def histSumw2(hist):
+    '''Sum of squared weights per bin, shaped like histArray'''
+    if not hist.GetSumw2N():
+        return histArray(hist).astype(numpy.float64)
+    values = _view(hist.GetSumw2().GetArray(), numpy.float64, hist.GetNcells())
+    if hist.GetDimension() == 2:
+        values = values.reshape(hist.GetNbinsY() + 2, hist.GetNbinsX() + 2)
+    return values
+
+
+def histMaximum(hist):
+    '''Largest bin content without under- and overflow'''
+    values = histArray(hist)
+    inner = values[1:-1, 1:-1] if values.ndim == 2 else values[1:-1]
+    return float(inner.max()) if inner.size else 0.
+
+
+def contentsChanged(hist):
+    '''Makes the statistics be recomputed from the bin contents, as after
+    SetBinContent'''
+    hist.PutStats(array('d', [0.] * 13))
+
+
+def graphArrays(graph):
+    '''x and y of the graph points'''
+    n_points = graph.GetN()
+    if not n_points:
+        return numpy.zeros(0), numpy.zeros(0)
+    return _view(graph.GetX(), numpy.float64, n_points), _view(graph.GetY(), numpy.float64, n_points)
+
+
+def graphYErrors(graph):
+    '''Lower and upper y errors of the graph points'''
+    n_points = graph.GetN()
+    if not n_points:
+        return numpy.zeros(0), numpy.zeros(0)
+    return _view(graph.GetEYlow(), numpy.float64, n_points), _view(graph.GetEYhigh(), numpy.float64, n_points)
+
+
+def graphYRange(graphs):
+    '''Smallest and largest y of all points of graphs'''
+    ys = [graphArrays(graph)[1] for graph in graphs]
+    ys = numpy.concatenate(ys) if ys else numpy.zeros(0)
+    if not len(ys):
+        return 0., 1.
+    return float(ys.min()), float(ys.max())
+
+
+def graphFromArrays(x, y, exl=None, exh=None, eyl=None, eyh=None, like=None):
+    '''TGraphAsymmErrors from arrays, with the style of graph like'''
+    zeros = numpy.zeros(len(x))
+    arrays = [numpy.ascontiguousarray(values if values is not None else zeros, dtype=numpy.float64)
+              for values in [x, y, exl, exh, eyl, eyh]]
+    graph = TGraphAsymmErrors(len(x), *arrays)
+    if like is not None:
+        graph.SetName(like.GetName())
+        graph.SetLineColor(like.GetLineColor())
+        graph.SetLineWidth(like.GetLineWidth())
+        graph.SetMarkerColor(like.GetMarkerColor())
+        graph.SetMarkerStyle(like.GetMarkerStyle())
+        graph.SetMarkerSize(like.GetMarkerSize())
+    return graph
+
+
+def ratioGraph(graph, ref):
+    '''Clone of graph with y divided by the y of ref at the same point
+    index, 0 where ref is 0. The errors are kept.'''
+    ratio = graph.Clone()
+    _, ratio_y = graphArrays(ratio)
+    _, ref_y = graphArrays(ref)
+    n_points = min(len(ratio_y), len(ref_y))
+    y, ref_y = ratio_y[:n_points], ref_y[:n_points]
+    y[:] = numpy.where(ref_y != 0., y / numpy.where(ref_y != 0., ref_y, 1.), 0.)
+    return ratio
+
+
+def normalise2D(hist, norm, scale=100., min_content=0.005):
+    '''Normalises the bins (without under- and overflow) of a 2D histogram
+    to the total ("global"), to each column ("col") or row ("row") sum,
+    times scale. Non-zero contents below min_content are raised to it so
+    they remain visible.'''
+    inner = histArray(hist)[1:-1, 1:-1]
+    values = inner.astype(numpy.float64)
+    if norm == 'global':
+        sums = values.sum()
+    elif norm == 'col':
+        sums = values.sum(axis=0, keepdims=True)
+    elif norm == 'row':
+        sums = values.sum(axis=1, keepdims=True)
+    else:
+        return
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        values = numpy.where(sums > 0., values / sums * scale, 0.)
+    values[(values > 0.) & (values < min_content)] = min_content
+    inner[:] = values
+    contentsChanged(hist)
@@ -0,0 +1,176 @@
+''' On-disk cache of filled histograms. A histogram is addressed by the
+checksums of the files it is filled from (the tree and its friends), the
+expression, the selection, the binning, the engine filling it and the
+version of the filling code and of the aliases the expressions may use,
+so a hit is always valid and only new or changed histograms are filled.
+Each entry is a small ROOT file written atomically; the least recently
+used entries are evicted when the cache exceeds its size cap.
+'''
+
+import os
+import json
+import hashlib
+
+import ROOT
+
+import eostools
+from relValTools import remoteChecksum
+
+# Source files whose changes invalidate all cached histograms, including
+# those defining the aliases and friends the expressions refer to
+code_files = ['hist_engine.py', 'expressions.py', 'tau_ids.py', 'event_tree.py', 'event_join.py']
+
+
+def codeVersion():
+    sha = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for code_file in code_files:
+        with open(os.path.join(directory, code_file), 'rb') as f:
+            sha.update(f.read())
+    sha.update(ROOT.gROOT.GetVersion())
+    return sha.hexdigest()
+
+
+def treeFileNames(tree):
+    if tree.InheritsFrom('TChain'):
+        return [element.GetTitle() for element in tree.GetListOfFiles()]
+    in_file = tree.GetCurrentFile()
+    return [in_file.GetName()] if in_file else []
+
+
+def treeFiles(tree, prefix='', seen=None):
+    '''(friend prefix, file name) of all files a tree reads, including
+    those of its friends, whose names are part of the expressions'''
+    names = treeFileNames(tree)
+    # Friends may refer back to the tree (AOD <-> miniAOD)
+    seen = seen if seen is not None else set()
+    seen.add((tree.GetName(), tuple(names)))
+    files = [(prefix, name) for name in names]
+    friends = tree.GetListOfFriends()
+    if friends:
+        for friend in friends:
+            friend_tree = friend.GetTree()
+            if not friend_tree:
+                continue
+            if (friend_tree.GetName(), tuple(treeFileNames(friend_tree))) not in seen:
+                files += treeFiles(friend_tree, prefix + friend.GetName() + '.', seen)
+    return files
+
+
+def binningKey(hist):
+    if hist.InheritsFrom('THnBase'):
+        axes = [hist.GetAxis(i) for i in range(hist.GetNdimensions())]
+    else:
+        axes = [hist.GetXaxis()]
+        if hist.GetDimension() > 1:
+            axes.append(hist.GetYaxis())
+    key = [hist.ClassName()]
+    for axis in axes:
+        if axis.GetXbins().GetSize():
+            key.append(list(axis.GetXbins()))
+        else:
+            key.append([axis.GetNbins(), axis.GetXmin(), axis.GetXmax()])
+    return key
+
+
+class HistCache(object):
+
+    def __init__(self, cache_dir, max_size_mb=2000.):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_mb * 1e6
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.version = codeVersion()
+        self.checksum_file = os.path.join(cache_dir, 'checksums.json')
+        self.checksums = {}
+        if os.path.exists(self.checksum_file):
+            with open(self.checksum_file) as f:
+                self.checksums = json.load(f)
+
+    def fileChecksum(self, file_name):
+        '''Checksum of an input file, remembered per path, size and mtime
+        such that big trees are only read once'''
+        if not os.path.exists(file_name):
+            return remoteChecksum(file_name)
+        stat = os.stat(file_name)
+        key = '{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime)
+        if key not in self.checksums:
+            self.checksums[key] = eostools.fileChecksum(file_name)
+            tmp_file = self.checksum_file + '.tmp{}'.format(os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(self.checksums, f)
+            os.rename(tmp_file, self.checksum_file)
+        return self.checksums[key]
+
+    def treeKey(self, tree):
+        '''Checksums of all files read by tree, None if one is unknown'''
+        key = [(prefix, self.fileChecksum(file_name))
+               for prefix, file_name in treeFiles(tree)]
+        if not key or None in [checksum for _, checksum in key]:
+            return None
+        return key
+
+    def key(self, tree_key, hist, varexp, selection, engine):
+        '''engine: name of the engine class, whose fills may differ in
+        rounding or in the treatment of edge cases'''
+        content = json.dumps([self.version, engine, tree_key, varexp, selection, binningKey(hist)])
+        return hashlib.sha1(content).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.root')
+
+    def load(self, key, hist):
+        '''Copies the cached contents into hist, returns False if missing'''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        directory = ROOT.gDirectory.GetPath()
+        in_file = ROOT.TFile(path)
+        cached = in_file.Get('hist') if not in_file.IsZombie() else None
+        found = bool(cached)
+        if found:
+            hist.Reset()
+            hist.Add(cached)
+        in_file.Close()
+        ROOT.TDirectory.Cd(directory)
+        if not found:
+            return False
+        os.utime(path, None)
+        return True
+
+    def store(self, key, hist):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        tmp_path = path + '.tmp{}'.format(os.getpid())
+        directory = ROOT.gDirectory.GetPath()
+        out_file = ROOT.TFile(tmp_path, 'recreate')
+        hist.Write('hist')
+        out_file.Close()
+        ROOT.TDirectory.Cd(directory)
+        os.rename(tmp_path, path)
+
+    def evict(self):
+        '''Removes least recently used entries beyond the size cap'''
+        entries = []
+        for sub_dir, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.root'):
+                    path = os.path.join(sub_dir, name)
+                    try:
+                        entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                    except OSError:
+                        pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Evicted by a parallel part
+                pass
+            total -= size
@@ -0,0 +1,503 @@
+''' Fills many histograms from one tree in a single pass. Histograms are
+booked with the usual TTree::Draw expressions ("y:x" for 2D, the selection
+used as weight; THnSparse cubes with "axis0:axis1:...") and filled by run(),
+which takes histograms from a HistCache where possible. Every distinct
+expression is compiled once as a TTreeFormula, such that aliases (packed WPs), indexed friends
+(per_event) and friend prefixes like "ft." work as in TTree::Draw, and it
+is evaluated at most once per entry, however many histograms use it.
+'''
+
+import re
+import warnings
+from time import time
+from itertools import count
+
+import numpy
+import ROOT
+
+from expressions import ExpressionCompiler, ExpressionError
+
+fill_histograms_code = '''
+#include "TTree.h"
+#include "TTreeFormula.h"
+#include "TH2.h"
+#include "THnBase.h"
+namespace tauval {
+// Histogram i is filled with the formulas axes[axis_begin[i]:axis_begin[i + 1]]
+// (x first), as TH1 (kind 1), TH2 (kind 2) or THnBase (kind 3). Its selection
+// is the conjunction of sel_terms[sel_begin[i]:sel_begin[i + 1]]; a single
+// term is used as weight
+void fillHistograms(TTree* tree, Long64_t n_entries, const std::vector<TTreeFormula*>& formulas,
+                    const std::vector<int>& axes, const std::vector<int>& axis_begin,
+                    const std::vector<int>& sel_terms, const std::vector<int>& sel_begin,
+                    const std::vector<TObject*>& hists, const std::vector<int>& kinds) {
+  std::vector<double> values(formulas.size());
+  std::vector<char> done(formulas.size());
+  std::vector<double> x;
+  auto value = [&](int i) {
+    if (!done[i]) {
+      formulas[i]->GetNdata();
+      values[i] = formulas[i]->EvalInstance(0);
+      done[i] = 1;
+    }
+    return values[i];
+  };
+  int tree_number = -1;
+  for (Long64_t entry = 0; entry < n_entries; ++entry) {
+    if (tree->LoadTree(entry) < 0) break;
+    if (tree->GetTreeNumber() != tree_number) {
+      tree_number = tree->GetTreeNumber();
+      for (auto formula : formulas) formula->UpdateFormulaLeaves();
+    }
+    std::fill(done.begin(), done.end(), 0);
+    for (size_t i = 0; i < hists.size(); ++i) {
+      double weight = 1.;
+      int n_terms = sel_begin[i + 1] - sel_begin[i];
+      if (n_terms == 1) {
+        weight = value(sel_terms[sel_begin[i]]);
+      } else {
+        for (int j = sel_begin[i]; j < sel_begin[i + 1]; ++j) {
+          if (value(sel_terms[j]) == 0.) { weight = 0.; break; }
+        }
+      }
+      if (weight == 0.) continue;
+      const int* axis = &axes[axis_begin[i]];
+      if (kinds[i] == 1) {
+        static_cast<TH1*>(hists[i])->Fill(value(axis[0]), weight);
+      } else if (kinds[i] == 2) {
+        static_cast<TH2*>(hists[i])->Fill(value(axis[0]), value(axis[1]), weight);
+      } else {
+        x.resize(axis_begin[i + 1] - axis_begin[i]);
+        for (size_t j = 0; j < x.size(); ++j) x[j] = value(axis[j]);
+        static_cast<THnBase*>(hists[i])->Fill(x.data(), weight);
+      }
+    }
+  }
+}
+}
+'''
+
+read_columns_code = '''
+#include "TTree.h"
+#include "TTreeFormula.h"
+#include "THnBase.h"
+namespace tauval {
+// Evaluates the formulas for entries [first, first + n) into out[i_formula * n + i_entry]
+Long64_t readColumns(TTree* tree, const std::vector<TTreeFormula*>& formulas,
+                     Long64_t first, Long64_t n, double* out) {
+  int tree_number = -1;
+  for (Long64_t i = 0; i < n; ++i) {
+    if (tree->LoadTree(first + i) < 0) return i;
+    if (tree->GetTreeNumber() != tree_number) {
+      tree_number = tree->GetTreeNumber();
+      for (auto formula : formulas) formula->UpdateFormulaLeaves();
+    }
+    for (size_t j = 0; j < formulas.size(); ++j) {
+      formulas[j]->GetNdata();
+      out[j * n + i] = formulas[j]->EvalInstance(0);
+    }
+  }
+  return n;
+}
+
+// Fills n entries with the coordinates x[i * ndim:(i + 1) * ndim] and weights w[i]
+void fillSparse(THnBase* hist, const double* x, const double* w, Long64_t n) {
+  int n_dim = hist->GetNdimensions();
+  for (Long64_t i = 0; i < n; ++i) hist->Fill(x + i * n_dim, w[i]);
+}
+}
+'''
+
+_hist_ids = count()
+
+
+def uniqueName(prefix):
+    '''Histogram names need to be unique while all booked histograms live'''
+    return '{}_{}'.format(prefix, next(_hist_ids))
+
+
+def splitVarexp(varexp):
+    '''"y:x" -> ["y", "x"], ignoring "::" scope operators'''
+    return re.split(r'(?<!:):(?!:)', varexp)
+
+
+def histAxes(hist, varexp):
+    '''Expressions of the histogram axes, x first. TH1/TH2 follow the
+    TTree::Draw convention "y:x", THnSparse cubes list their axes in order.'''
+    exprs = splitVarexp(varexp)
+    return exprs if hist.InheritsFrom('THnBase') else exprs[::-1]
+
+
+def histKind(hist):
+    '''1, 2 or 3 for TH1, TH2 or THnBase, as in fillHistograms'''
+    if hist.InheritsFrom('THnBase'):
+        return 3
+    return 2 if hist.InheritsFrom('TH2') else 1
+
+
+def normalise(expr):
+    return re.sub(r'\s+', '', expr)
+
+
+def stripParentheses(expr):
+    '''"(a && b)" -> "a && b", "(a) && (b)" stays'''
+    expr = expr.strip()
+    while expr.startswith('(') and expr.endswith(')'):
+        depth = 0
+        for i, char in enumerate(expr):
+            depth += {'(': 1, ')': -1}.get(char, 0)
+            if depth == 0 and i < len(expr) - 1:
+                return expr
+        expr = expr[1:-1].strip()
+    return expr
+
+
+def splitConjunction(selection):
+    '''Splits a selection into its top-level && terms, recursively, and
+    drops terms that are always true. A selection with a top-level || is
+    kept whole, as && binds stronger: "a && b || c" is "(a && b) || c".'''
+    selection = stripParentheses(selection)
+    terms = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(selection):
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if depth == 0 and selection.startswith('||', i):
+            return [selection]
+        if depth == 0 and selection.startswith('&&', i):
+            terms.append(selection[start:i])
+            start = i + 2
+    if not terms:
+        return [] if selection in ['1', '1.', '1.0'] else [selection]
+    terms.append(selection[start:])
+    return [term for sub_selection in terms for term in splitConjunction(sub_selection)]
+
+
+class HistEngine(object):
+    '''Collects histogram requests for one tree and fills them in one pass'''
+
+    compiled = None
+    # Tag of the requests booked next, e.g. the plot they belong to
+    tag = None
+    # If set, run() first fills the requests of each tag on their own over
+    # this many entries, which measures their cost in tag_times
+    profile_entries = 0
+
+    def __init__(self, tree, cache=None):
+        self.tree = tree
+        self.cache = cache
+        self.requests = []
+        self.shared = {}
+        self.tags = {}
+        self.tag_times = {}
+        self.max_entries = None
+
+    def book(self, hist, varexp, selection='1'):
+        '''Fills hist with varexp for entries passing selection on run().
+        hist can also be a THnSparse, with the axis expressions as
+        "axis0:axis1:...". Returns hist for convenience.'''
+        self.requests.append((hist, varexp, selection or '1'))
+        self.tags[id(hist)] = self.tag
+        return hist
+
+    def bookShared(self, make_hist, varexp, selection, binning):
+        '''Returns the histogram booked earlier for the same expression,
+        selection and binning, or books a new one from make_hist(). Shared
+        histograms must not be modified by the caller.'''
+        key = (normalise(varexp), normalise(selection or '1'), tuple(binning))
+        if key not in self.shared:
+            self.shared[key] = self.book(make_hist(), varexp, selection)
+        return self.shared[key]
+
+    @classmethod
+    def compile(cls):
+        if cls.compiled is None:
+            cls.compiled = bool(ROOT.gInterpreter.Declare(fill_histograms_code))
+            if not cls.compiled:
+                print 'WARNING: Cannot compile histogram engine, falling back to one TTree::Project per histogram'
+        return cls.compiled
+
+    def entries(self):
+        n_entries = self.tree.GetEntries()
+        return n_entries if self.max_entries is None else min(n_entries, self.max_entries)
+
+    def project(self, hist, varexp, selection):
+        if hist.InheritsFrom('THnBase'):
+            warnings.warn('Cannot fill {} with {} [{}]'.format(hist.GetName(), varexp, selection))
+            return
+        # Project looks up the histogram by name in the current directory
+        name = hist.GetName()
+        hist.SetName(uniqueName('h_project'))
+        self.tree.Project(hist.GetName(), varexp, selection, '', self.entries())
+        hist.SetName(name)
+
+    def profile(self):
+        '''Adds to tag_times the time to fill copies of the pending requests
+        of each tag on their own over the first profile_entries entries'''
+        groups = {}
+        for hist, varexp, selection in self.requests:
+            copy = hist.Clone(uniqueName('h_profile'))
+            ROOT.SetOwnership(copy, True)
+            groups.setdefault(self.tags.get(id(hist)), []).append((copy, varexp, selection))
+        profiler = type(self)(self.tree)
+        profiler.max_entries = self.profile_entries
+        for tag, requests in groups.iteritems():
+            profiler.requests = requests
+            start = time()
+            profiler.fill()
+            self.tag_times[tag] = self.tag_times.get(tag, 0.) + time() - start
+
+    def run(self):
+        '''Fills all booked histograms, from the cache if available, and
+        clears the requests'''
+        if not self.cache or not self.requests:
+            if self.profile_entries and self.requests:
+                self.profile()
+            return self.fill()
+        # Friends are attached by now and are part of the key
+        tree_key = self.cache.treeKey(self.tree)
+        if tree_key is None:
+            print 'Histogram cache: unknown checksum of an input file of', self.tree.GetName()
+            return self.fill()
+        misses = []
+        requests, self.requests = self.requests, []
+        engine = type(self).__name__
+        for hist, varexp, selection in requests:
+            key = self.cache.key(tree_key, hist, normalise(varexp), normalise(selection), engine)
+            if not self.cache.load(key, hist):
+                misses.append((key, hist))
+                self.requests.append((hist, varexp, selection))
+        print 'Histogram cache: {} of {} histograms cached'.format(len(requests) - len(misses), len(requests))
+        if self.profile_entries and self.requests:
+            self.profile()
+        self.fill()
+        for key, hist in misses:
+            self.cache.store(key, hist)
+        self.cache.evict()
+
+    def fill(self):
+        '''Fills all booked histograms from the tree and clears the requests'''
+        requests, self.requests = self.requests, []
+        if not requests:
+            return
+        if not self.compile():
+            for hist, varexp, selection in requests:
+                self.project(hist, varexp, selection)
+            return
+
+        # Formulas on a TChain need a loaded tree
+        self.tree.LoadTree(0)
+        formulas = []
+        indices = {}
+
+        def formula(expr):
+            if expr not in indices:
+                tree_formula = ROOT.TTreeFormula(uniqueName('f'), expr, self.tree)
+                indices[expr] = len(formulas) if tree_formula.GetNdim() else None
+                if tree_formula.GetNdim():
+                    formulas.append(tree_formula)
+            return indices[expr]
+
+        axis_terms = ROOT.std.vector('int')()
+        axis_begin = ROOT.std.vector('int')()
+        sel_terms = ROOT.std.vector('int')()
+        sel_begin = ROOT.std.vector('int')()
+        hists = ROOT.std.vector('TObject*')()
+        kinds = ROOT.std.vector('int')()
+        for hist, varexp, selection in requests:
+            exprs = histAxes(hist, varexp)
+            axes = [formula(expr) for expr in exprs]
+            # Common cuts like the gen and reco acceptance are evaluated
+            # once per entry for all selections they appear in
+            terms = splitConjunction(selection) or ['1']
+            if len(terms) == 1 and terms[0] != stripParentheses(selection):
+                # Remainder of a conjunction, which is a 0/1 weight
+                terms = ['({})!=0'.format(terms[0])]
+            terms = [formula(term) for term in terms]
+            if None in axes or None in terms or histKind(hist) < 3 and len(exprs) != histKind(hist):
+                warnings.warn('Cannot book {} with {} [{}], using TTree::Project'.format(
+                    hist.GetName(), varexp, selection))
+                self.project(hist, varexp, selection)
+                continue
+            axis_begin.push_back(axis_terms.size())
+            for axis in axes:
+                axis_terms.push_back(axis)
+            sel_begin.push_back(sel_terms.size())
+            for term in terms:
+                sel_terms.push_back(term)
+            hists.push_back(hist)
+            kinds.push_back(histKind(hist))
+        axis_begin.push_back(axis_terms.size())
+        sel_begin.push_back(sel_terms.size())
+
+        cpp_formulas = ROOT.std.vector('TTreeFormula*')()
+        for tree_formula in formulas:
+            cpp_formulas.push_back(tree_formula)
+        ROOT.tauval.fillHistograms(self.tree, self.entries(), cpp_formulas, axis_terms, axis_begin,
+                                   sel_terms, sel_begin, hists, kinds)
+
+
+class ColumnarEngine(HistEngine):
+    '''HistEngine that reads the tree columns in chunks and evaluates all
+    expressions with numpy through one ExpressionCompiler DAG, so the cost
+    grows with the number of distinct sub-expressions rather than with the
+    number of histograms. Requests that cannot be compiled are filled by
+    the TTreeFormula loop of HistEngine.
+    '''
+
+    chunk_size = 100000
+    reader_compiled = None
+
+    @classmethod
+    def compileReader(cls):
+        if cls.reader_compiled is None:
+            cls.reader_compiled = bool(ROOT.gInterpreter.Declare(read_columns_code))
+        return cls.reader_compiled
+
+    def fill(self):
+        requests, self.requests = self.requests, []
+        if not requests or not self.compileReader():
+            self.requests = requests
+            return HistEngine.fill(self)
+
+        self.tree.LoadTree(0)
+        compiler = ExpressionCompiler()
+        readers = {}
+        compiled = []
+        for hist, varexp, selection in requests:
+            try:
+                axes = [compiler.compile(expr) for expr in histAxes(hist, varexp)]
+                sel = compiler.compile(selection)
+                if histKind(hist) < 3 and len(axes) != histKind(hist):
+                    raise ExpressionError('Expected {} axes'.format(histKind(hist)))
+                for column in set().union(*[compiler.columns(key) for key in axes + [sel]]):
+                    if column not in readers:
+                        reader = ROOT.TTreeFormula(uniqueName('c'), column, self.tree)
+                        readers[column] = reader if reader.GetNdim() else None
+                    if readers[column] is None:
+                        raise ExpressionError('Cannot read ' + column)
+            except ExpressionError as error:
+                warnings.warn('Columnar evaluation of {} with {} [{}] not possible ({}), using TTreeFormula'.format(
+                    hist.GetName(), varexp, selection, error))
+                self.requests.append((hist, varexp, selection))
+                continue
+            compiled.append((hist, axes, sel))
+
+        columns = sorted(name for name, reader in readers.iteritems() if reader)
+        cpp_readers = ROOT.std.vector('TTreeFormula*')()
+        for column in columns:
+            cpp_readers.push_back(readers[column])
+
+        n_entries = self.entries()
+        buf = numpy.empty(len(columns) * self.chunk_size)
+        for first in xrange(0, n_entries, self.chunk_size):
+            size = min(self.chunk_size, n_entries - first)
+            size = ROOT.tauval.readColumns(self.tree, cpp_readers, first, size, buf)
+            if size <= 0:
+                break
+            block = buf[:len(columns) * size].reshape(len(columns), size)
+            values = dict(zip(columns, block))
+            # Evaluated nodes of this chunk, shared by all histograms
+            cache = {}
+            for hist, axes, sel in compiled:
+                weights = compiler.evaluate(sel, values, cache, size)
+                passed = weights != 0.
+                n_passed = int(passed.sum())
+                if not n_passed:
+                    continue
+                fill = [compiler.evaluate(key, values, cache, size)[passed] for key in axes]
+                weights = numpy.ascontiguousarray(weights[passed], dtype=numpy.float64)
+                if histKind(hist) == 3:
+                    # One row of coordinates per entry
+                    coordinates = numpy.ascontiguousarray(numpy.column_stack(fill), dtype=numpy.float64)
+                    ROOT.tauval.fillSparse(hist, coordinates, weights, n_passed)
+                else:
+                    fill = [numpy.ascontiguousarray(axis_values, dtype=numpy.float64) for axis_values in fill]
+                    hist.FillN(n_passed, *(fill + [weights]))
+
+        # Remaining requests with the TTreeFormula loop
+        HistEngine.fill(self)
+
+
+def readTreeColumns(tree, exprs, chunk_size=ColumnarEngine.chunk_size):
+    '''Evaluates exprs for all entries of tree, returns an array of shape
+    (len(exprs), entries)'''
+    if not ColumnarEngine.compileReader():
+        raise RuntimeError('Cannot compile the column reader')
+    n_entries = tree.GetEntries()
+    out = numpy.empty((len(exprs), n_entries))
+    if not n_entries or not exprs:
+        return out
+    tree.LoadTree(0)
+    readers = []
+    cpp_readers = ROOT.std.vector('TTreeFormula*')()
+    for expr in exprs:
+        reader = ROOT.TTreeFormula(uniqueName('c'), expr, tree)
+        if not reader.GetNdim():
+            raise RuntimeError('Cannot read {} from {}'.format(expr, tree.GetName()))
+        readers.append(reader)
+        cpp_readers.push_back(reader)
+    buf = numpy.empty(len(exprs) * chunk_size)
+    for first in xrange(0, n_entries, chunk_size):
+        size = min(chunk_size, n_entries - first)
+        if ROOT.tauval.readColumns(tree, cpp_readers, first, size, buf) != size:
+            raise RuntimeError('Cannot read entries {}-{} of {}'.format(first, first + size, tree.GetName()))
+        out[:, first:first + size] = buf[:len(exprs) * size].reshape(len(exprs), size)
+    return out
+
+
+def readSelectedColumns(tree, exprs, selection='1', chunk_size=ColumnarEngine.chunk_size):
+    '''Evaluates exprs for the entries of tree passing selection in one pass:
+    the leaves are read once per chunk and all expressions and the selection
+    are evaluated with numpy on the chunk, sharing common sub-expressions.
+    Expressions that cannot be compiled are read with TTreeFormula. Returns
+    an array of shape (len(exprs), passing entries).'''
+    if not ColumnarEngine.compileReader():
+        raise RuntimeError('Cannot compile the column reader')
+    exprs = list(exprs)
+    n_entries = tree.GetEntries()
+    if not n_entries:
+        return numpy.empty((len(exprs), 0))
+    tree.LoadTree(0)
+    compiler = ExpressionCompiler()
+    readers = {}
+
+    def addReader(column):
+        if column not in readers:
+            reader = ROOT.TTreeFormula(uniqueName('c'), column, tree)
+            if not reader.GetNdim():
+                raise ExpressionError('Cannot read ' + column)
+            readers[column] = reader
+
+    keys = []
+    for expr in exprs + [selection]:
+        try:
+            key = compiler.compile(expr)
+            for column in compiler.columns(key):
+                addReader(column)
+        except ExpressionError:
+            key = None
+            try:
+                addReader(expr)
+            except ExpressionError:
+                raise RuntimeError('Cannot read {} from {}'.format(expr, tree.GetName()))
+        keys.append(key)
+
+    columns = sorted(readers)
+    cpp_readers = ROOT.std.vector('TTreeFormula*')()
+    for column in columns:
+        cpp_readers.push_back(readers[column])
+    buf = numpy.empty(len(columns) * chunk_size)
+    chunks = [numpy.empty((len(exprs), 0))]
+    for first in xrange(0, n_entries, chunk_size):
+        size = min(chunk_size, n_entries - first)
+        if ROOT.tauval.readColumns(tree, cpp_readers, first, size, buf) != size:
+            raise RuntimeError('Cannot read entries {}-{} of {}'.format(first, first + size, tree.GetName()))
+        values = dict(zip(columns, buf[:len(columns) * size].reshape(len(columns), size)))
+        cache = {}
+        evaluated = [compiler.evaluate(key, values, cache, size) if key is not None else values[expr]
+                     for key, expr in zip(keys, exprs + [selection])]
+        passed = evaluated[-1] != 0.
+        chunks.append(numpy.array([expr_values[passed] for expr_values in evaluated[:-1]]).reshape(
+            len(exprs), int(passed.sum())))
+    return numpy.concatenate(chunks, axis=1)
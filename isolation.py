@@ -0,0 +1,123 @@
+''' Recomputation of the tau isolation sums from the isolation candidates.
+The candidates of a tau are read into numpy arrays once and all isolation
+definitions, including optional extra cone sizes and dz thresholds, are
+computed from these arrays with masks.
+'''
+
+import math
+
+import numpy
+
+from relValTools import is_above_cmssw_version
+
+iso_vars = ['tau_iso_dz001', 'tau_iso_dz02', 'tau_iso_pv', 'tau_iso_nopv',
+            'tau_iso_neu', 'tau_iso_puppi', 'tau_iso_puppiNoL']
+
+
+def numberToName(number):
+    '''0.3 -> "0p3", used to build branch names'''
+    return ('%g' % number).replace('.', 'p')
+
+
+def deltaR2ToAxis(eta, phi, etas, phis):
+    dphi = numpy.mod(phis - phi + math.pi, 2. * math.pi) - math.pi
+    return (etas - eta)**2 + dphi**2
+
+
+class IsolationEngine(object):
+    '''Computes the isolation sums of a tau. Next to the standard sums in
+    iso_vars, charged sums for every combination of the extra cones and dz
+    thresholds and neutral sums for every extra cone are computed.
+    '''
+    cone = 0.5
+    min_pt = 0.5
+
+    def __init__(self, cones=None, dzs=None):
+        self.cones = cones or []
+        self.dzs = dzs or [0.2]
+        self.has_track_details = is_above_cmssw_version(9, 2, 0)
+
+    def variables(self):
+        '''Names of all sums returned by compute'''
+        return ['tau_iso_dz02', 'tau_iso_dz001', 'tau_iso_pv', 'tau_iso_nopv',
+                'tau_iso_neu', 'tau_iso_puppi', 'tau_iso_puppiNoL'] + self.extraVars()
+
+    def extraVars(self):
+        charged = ['tau_iso_dR{}_dz{}'.format(numberToName(cone), numberToName(dz))
+                   for cone in self.cones for dz in self.dzs]
+        neutral = ['tau_iso_neu_dR{}'.format(numberToName(cone)) for cone in self.cones]
+        return charged + neutral
+
+    def getTrack(self, cand):
+        if self.has_track_details and not cand.hasTrackDetails():
+            return None
+        return cand.pseudoTrack()
+
+    def chargedArrays(self, tau, pv_position):
+        rows = []
+        for cand in tau.isolationChargedHadrCands():
+            track = self.getTrack(cand)
+            rows.append((
+                cand.charge(), cand.eta(), cand.phi(), cand.pt(),
+                cand.dxy(pv_position), cand.dz(pv_position),
+                bool(track),
+                track.normalizedChi2() if track else -1.,
+                cand.numberOfHits(), cand.vertexRef().key(),
+                cand.pvAssociationQuality(),
+                cand.puppiWeight(), cand.puppiWeightNoLep(),
+            ))
+        arr = numpy.array(rows, dtype=float).reshape(len(rows), 13)
+        return dict(zip(['charge', 'eta', 'phi', 'pt', 'dxy', 'dz', 'has_track',
+                         'chi2', 'nhits', 'vtx_key', 'pv_quality', 'puppi', 'puppi_nolep'],
+                        arr.T))
+
+    def gammaArrays(self, tau):
+        rows = [(cand.charge(), cand.pdgId(), cand.eta(), cand.phi(), cand.pt(),
+                 cand.puppiWeight(), cand.puppiWeightNoLep())
+                for cand in tau.isolationGammaCands()]
+        arr = numpy.array(rows, dtype=float).reshape(len(rows), 7)
+        return dict(zip(['charge', 'pdgid', 'eta', 'phi', 'pt', 'puppi', 'puppi_nolep'],
+                        arr.T))
+
+    def compute(self, tau, vertices, tau_vertex_idx):
+        '''Returns a dict {variable name: isolation sum}'''
+        iso = {}
+        ch = self.chargedArrays(tau, vertices[tau_vertex_idx].position())
+        ch_dr2 = deltaR2ToAxis(tau.eta(), tau.phi(), ch['eta'], ch['phi'])
+        # MB use candidate methods only
+        sel = ((ch['charge'] != 0) &
+               (ch['pt'] > self.min_pt) &
+               (ch['dxy'] < 0.1) &
+               (ch['has_track'] > 0) &
+               ~((ch['nhits'] > 0) & ((ch['chi2'] >= 100.) | (ch['nhits'] < 3))))
+        in_cone = sel & (ch_dr2 <= self.cone**2)
+        abs_dz = numpy.abs(ch['dz'])
+        pt = ch['pt']
+        dz02 = in_cone & (abs_dz < 0.2)
+        from_pv = ch['vtx_key'] == tau_vertex_idx
+
+        iso['tau_iso_dz02'] = pt[dz02].sum()
+        iso['tau_iso_dz001'] = pt[in_cone & (abs_dz < 0.015)].sum()
+        iso['tau_iso_pv'] = pt[in_cone & from_pv & (ch['pv_quality'] > 4)].sum()
+        iso['tau_iso_nopv'] = pt[dz02 & ~from_pv].sum()
+        puppi = (pt * ch['puppi'])[dz02].sum()
+        puppi_nolep = (pt * ch['puppi_nolep'])[dz02].sum()
+
+        for cone in self.cones:
+            for dz in self.dzs:
+                name = 'tau_iso_dR{}_dz{}'.format(numberToName(cone), numberToName(dz))
+                iso[name] = pt[sel & (ch_dr2 <= cone**2) & (abs_dz < dz)].sum()
+
+        ga = self.gammaArrays(tau)
+        ga_dr2 = deltaR2ToAxis(tau.eta(), tau.phi(), ga['eta'], ga['phi'])
+        ga_sel = (ga['charge'] == 0) & (numpy.abs(ga['pdgid']) == 22) & (ga['pt'] > self.min_pt)
+        ga_in_cone = ga_sel & (ga_dr2 <= self.cone**2)
+
+        iso['tau_iso_neu'] = ga['pt'][ga_in_cone].sum()
+        iso['tau_iso_puppi'] = puppi + (ga['pt'] * ga['puppi'])[ga_in_cone].sum()
+        iso['tau_iso_puppiNoL'] = puppi_nolep + (ga['pt'] * ga['puppi_nolep'])[ga_in_cone].sum()
+
+        for cone in self.cones:
+            iso['tau_iso_neu_dR{}'.format(numberToName(cone))] = ga['pt'][ga_sel & (ga_dr2 <= cone**2)].sum()
+
+        return iso
@@ -0,0 +1,74 @@
+''' Matching of reference objects (gen taus, jets, leptons) to reco taus.
+The full deltaR^2 matrix is built at once with numpy and resolved into a
+unique assignment, either greedily (closest pairs first) or optimally
+(minimal sum of deltaR^2, requires scipy).
+'''
+
+import math
+
+import numpy
+
+
+def etaPhiArrays(objs):
+    '''Returns eta and phi of a list of candidates as numpy arrays.'''
+    etas = numpy.fromiter((obj.eta() for obj in objs), dtype=float, count=len(objs))
+    phis = numpy.fromiter((obj.phi() for obj in objs), dtype=float, count=len(objs))
+    return etas, phis
+
+
+def deltaR2Matrix(etas1, phis1, etas2, phis2):
+    '''Returns the (len(etas1), len(etas2)) matrix of deltaR^2 values with
+    delta phi wrapped into [-pi, pi).
+    '''
+    deta = etas1[:, numpy.newaxis] - etas2[numpy.newaxis, :]
+    dphi = phis1[:, numpy.newaxis] - phis2[numpy.newaxis, :]
+    dphi = numpy.mod(dphi + math.pi, 2. * math.pi) - math.pi
+    return deta * deta + dphi * dphi
+
+
+def greedyAssignment(dr2, max_dr2):
+    '''Assigns rows to columns starting from the closest pair, skipping rows
+    and columns that are already taken. Only pairs with dr2 < max_dr2 are
+    considered.
+    '''
+    rows, cols = numpy.nonzero(dr2 < max_dr2)
+    order = numpy.argsort(dr2[rows, cols], kind='mergesort')
+    match = {}
+    used_cols = set()
+    for row, col in zip(rows[order], cols[order]):
+        if row in match or col in used_cols:
+            continue
+        match[int(row)] = int(col)
+        used_cols.add(col)
+    return match
+
+
+def optimalAssignment(dr2, max_dr2):
+    '''Assigns rows to columns such that the number of pairs with
+    dr2 < max_dr2 is maximal and their summed dr2 minimal.
+    '''
+    from scipy.optimize import linear_sum_assignment
+
+    allowed = dr2 < max_dr2
+    # Forbidden pairs are more expensive than any set of allowed pairs
+    penalty = max_dr2 * (min(dr2.shape) + 1)
+    rows, cols = linear_sum_assignment(numpy.where(allowed, dr2, penalty))
+    return {int(row): int(col) for row, col in zip(rows, cols) if allowed[row, col]}
+
+
+assignments = {
+    'greedy': greedyAssignment,
+    'optimal': optimalAssignment,
+}
+
+
+def matchRefsToTaus(refObjs, taus, dR2=0.25, method='greedy'):
+    '''Returns a dict {refidx: tauidx} with a unique reco tau per reference
+    object, requiring deltaR^2 < dR2 (dR2=0.25 == dR=0.5).
+    '''
+    if not len(refObjs) or not len(taus):
+        return {}
+    ref_etas, ref_phis = etaPhiArrays(refObjs)
+    tau_etas, tau_phis = etaPhiArrays(taus)
+    dr2 = deltaR2Matrix(ref_etas, ref_phis, tau_etas, tau_phis)
+    return assignments[method](dr2, dR2)
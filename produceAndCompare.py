@@ -5,6 +5,8 @@ import pprint
 import sys
 
 from relValTools import addArguments
+from scheduler import mergeCosts
+from triage import mergeScores
 #import Validation.RecoTau.webplotting as webplotting
 
 
@@ -61,7 +63,13 @@ if __name__ == '__main__':
                 useRecoJets * ' -u ' + \
                 ' -s ' + storageSite + \
                 ' -l ' + localdir + \
-                ' --tauCollection ' + tauCollection + mvaidstr + dd
+                ' --tauCollection ' + tauCollection + mvaidstr + dd + \
+                ' --jobs ' + str(args.jobs) + \
+                args.noMerge * ' --noMerge' + \
+                args.packWPs * ' --packWPs' + \
+                ' --storageProfile ' + args.storageProfile + \
+                (len(args.doubleVars) > 0) * (' --doubleVars ' + ' '.join(args.doubleVars)) + \
+                (len(args.cacheDir) > 0) * (' --cacheDir ' + args.cacheDir + ' --cacheSize ' + str(args.cacheSize))
             + (len(outputFileName) > 0) * (' --outputFileName ' + outputFileName)
 
         print '===================='
@@ -73,9 +81,21 @@ if __name__ == '__main__':
     globalTagsstr = ' '.join(globalTags)
     releases = ' '.join(relVals)
 
+    # Options of the histogram filling and scheduling shared by all parts
+    compareOptions = (len(args.costFile) > 0) * (' --costFile ' + args.costFile) + \
+        ' --profileEntries ' + str(args.profileEntries) + \
+        ' --processes ' + str(args.processes) + \
+        ' --engine ' + args.engine + \
+        ' --histCache "' + args.histCache + '" --histCacheSize ' + str(args.histCacheSize) + \
+        ' --effAxes ' + ' '.join(args.effAxes) + \
+        ' --effMaps ' + ' '.join(args.effMaps)
+
     commands = []
     for i in range(totalparts):
-        commands.append('python ' + scriptPath + 'compare.py --releases ' + releases + ' --globalTags ' + globalTagsstr + ' --runtype ' + str(runtype) + onebin + ' -p ' + str(i+1) + dd)
+        commands.append('python ' + scriptPath + 'compare.py --releases ' + releases + ' --globalTags ' + globalTagsstr + ' --runtype ' + str(runtype) + onebin +
+                        ' -p ' + str(i+1) + ' --totalparts ' + str(totalparts) + ' ' + dd +
+                        ' --triageThreshold ' + str(args.triageThreshold) + (len(args.triageFile) > 0) * (' --triageFile ' + args.triageFile) +
+                        (len(args.wpFile) > 0) * (' --wpFile ' + args.wpFile) + compareOptions)
 
     for command in commands:
         print '===================='
@@ -83,6 +103,11 @@ if __name__ == '__main__':
         print '===================='
         os.system(command)
 
+    # Measured plot costs balance the parts of the next run
+    mergeCosts(args.costFile or 'compare_costs_{}.json'.format(runtype))
+    # Ranked plot scores of all parts
+    mergeScores(args.triageFile or 'compare_{}/triage.json'.format(runtype))
+
 
     #webplotting.webplotting(input_dir="./compare_{0}".format(runtype), recursive=True)
     print "FINISHED SUCCESSFULLY"
@@ -9,6 +9,8 @@ import sys
 import os
 import copy
 import subprocess
+import multiprocessing
+from collections import namedtuple
 from time import time
 from datetime import datetime, timedelta
 
@@ -16,17 +18,19 @@ import ROOT
 import argparse  # needs to come after ROOT import
 
 from DataFormats.FWLite import Events, Handle
-from PhysicsTools.HeppyCore.utils.deltar import deltaR, bestMatch, deltaR2
+from PhysicsTools.HeppyCore.utils.deltar import deltaR, deltaR2
 from PhysicsTools.Heppy.physicsutils.TauDecayModes import tauDecayModes
-from Var import Var
-from tau_ids import all_tau_ids, lepton_tau_ids, \
-    tau_ids, fill_tau_ids, \
-    slimmed_tau_ids, selected_pat_tau_ids
+from Var import RecordBuffer
+from matching import matchRefsToTaus
+from isolation import IsolationEngine
+from tau_ids import TauIDTable, get_run_tau_ids
+from storage import StorageProfile, reportStorage
+from event_tree import event_tree_name, event_vars
 
 
 from relValTools import addArguments, getFilesFromEOS, \
-    getFilesFromDAS, getNeventsFromDAS, is_above_cmssw_version, \
-    runtype_to_sample, dprint
+    getFilesFromDAS, getNeventsFromDAS, \
+    runtype_to_sample, dprint, StageInCache
 
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 ROOT.gROOT.SetBatch(True)
@@ -52,13 +56,34 @@ def finalDaughters(gen, daughters=None):
     return daughters
 
 
-def visibleP4(gen):
-    gen.final_ds = finalDaughters(gen)
-    return sum(
-        (d.p4() for d in gen.final_ds
-            if abs(d.pdgId()) not in [12, 14, 16]),
-        ROOT.math.XYZTLorentzVectorD()
-    )
+GenTauDecay = namedtuple('GenTauDecay', 'final_ds vis_p4 charged_p4 neutral_p4 dm')
+
+
+def genTauDecay(gen):
+    '''Walks the decay tree of a gen tau once and returns its final
+    daughters, the visible, charged and neutral p4 and the gen decay mode.
+    '''
+    final_ds = finalDaughters(gen)
+    visible_ds = []
+    vis_p4 = ROOT.math.XYZTLorentzVectorD()
+    charged_p4 = ROOT.math.XYZTLorentzVectorD()
+    neutral_p4 = ROOT.math.XYZTLorentzVectorD()
+    for d in final_ds:
+        if abs(d.pdgId()) in [12, 14, 16]:
+            continue
+        p4 = d.p4()
+        visible_ds.append(d)
+        vis_p4 = vis_p4 + p4
+        if d.charge():
+            charged_p4 = charged_p4 + p4
+        else:
+            neutral_p4 = neutral_p4 + p4
+
+    return GenTauDecay(final_ds=final_ds,
+                       vis_p4=vis_p4,
+                       charged_p4=charged_p4,
+                       neutral_p4=neutral_p4,
+                       dm=tauDecayModes.genDecayModeInt(visible_ds))
 
 
 def removeOverlap(all_jets, gen_leptons, dR2=0.25): # dR2=0.25  ==  dR=0.5
@@ -84,150 +109,82 @@ def isGenLepton(lep_cand, pid):
         abs(lep_cand.eta()) < 2.3
     )
 
-def MatchTausToJets(refObjs, dR2=0.25):
-
-  # For each Jet, get the closest RecoTau
-  Match = {}
-  for jetidx,refObj in enumerate(refObjs):
-      tau, _dr2_ = bestMatch(refObj, taus) # dR2=0.25  ==  dR=0.5
-      for tauidx,itau in enumerate(taus):
-        if itau==tau: break
-      if _dr2_ < dR2: Match[jetidx]=tauidx
-
-  # Is the same Tau assinged to more than one Jet?
-  DoubleCheck = []
-  for ijet,itau in Match.iteritems():
-    for jjet,jtau in Match.iteritems():
-      if jjet >= ijet: continue
-      if itau==jtau:
-        if ijet not in DoubleCheck: DoubleCheck.append(ijet)
-        if jjet not in DoubleCheck: DoubleCheck.append(jjet)
-
-  # Get all distances between all conflicting Jets and corresponding Taus
-  Distances = {}
-  for ijet in DoubleCheck:
-    for jjet in DoubleCheck:
-      itau = Match[jjet]
-      Distances[str(ijet)+"_"+str(itau)] = deltaR(taus[itau].eta(), taus[itau].phi(), refObjs[ijet].eta(), refObjs[ijet].phi())
-  #print Distances
-
-  # Remove all conflicting Jets, to re-assign later
-  for ijet in DoubleCheck:
-    del Match[ijet]
-
-  # Assign shortest distance between Tau and Jet, then move on ignoring the already assigned Taus/Jets
-  while Distances != {}:
-    keepthis = min(Distances, key=Distances.get)
-    thisjet = int(keepthis[:keepthis.find("_")])
-    thistau = int(keepthis[keepthis.rfind("_")+1:])
-    Match[thisjet] = thistau
-    deletethis = []
-    for element in Distances:
-      if element.startswith(str(thisjet)) or element.endswith(str(thistau)): deletethis.append(element)
-    for element in deletethis: del Distances[element]
-
-  return Match
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
-    )
-    addArguments(parser, produce=True, compare=False)
-    args = parser.parse_args()
 
+def splitFiles(filelist, jobs, maxEvents=-1):
+    '''Splits filelist into at most jobs contiguous shards with similar
+    numbers of events. Returns a list of (files, max_events, evtid_offset)
+    such that the tau_id counter of the merged shards is identical to the
+    one of a single-process run.
+    '''
+    sizes = []
+    for f_name in filelist:
+        if maxEvents > 0 and sum(sizes) >= maxEvents:
+            break
+        sizes.append(Events([f_name]).size())
+
+    total = sum(sizes)
+    if maxEvents > 0:
+        total = min(total, maxEvents)
+    target = float(total) / jobs
+
+    shards = []
+    files, n_shard, offset = [], 0, 0
+    for f_name, size in zip(filelist, sizes):
+        files.append(f_name)
+        n_shard += size
+        if n_shard >= target and len(shards) < jobs - 1:
+            shards.append((files, n_shard, offset))
+            offset += n_shard
+            files, n_shard = [], 0
+    if files:
+        shards.append((files, n_shard, offset))
+
+    if maxEvents > 0:
+        shards = [(files, min(n_shard, maxEvents - offset), offset)
+                  for files, n_shard, offset in shards if offset < maxEvents]
+    return shards
+
+
+def mergeOutputs(part_names, outputFileName, storage):
+    '''Merges the per-shard output files into outputFileName. The per_tau
+    trees are concatenated in shard order, histograms like h_ngen are summed.
+    '''
+    merger = ROOT.TFileMerger(False)
+    if storage.compression() is None:
+        merger.OutputFile(outputFileName, 'RECREATE')
+    else:
+        merger.OutputFile(outputFileName, 'RECREATE', storage.compression())
+    for part_name in part_names:
+        merger.AddFile(part_name)
+    if not merger.Merge():
+        print 'Merging of', part_names, 'into', outputFileName, 'failed'
+        sys.exit(1)
+    for part_name in part_names:
+        os.remove(part_name)
+
+
+def runShard(shard):
+    args, files, outputFileName, maxEvents, evtid_offset = shard
+    return processFiles(args, files, outputFileName, maxEvents, evtid_offset)
+
+
+def processFiles(args, filelist, outputFileName, maxEvents=-1, evtid_offset=0):
+    '''Runs the event loop over filelist and writes the per_event and per_tau
+    trees to outputFileName. The tau_id counter starts at evtid_offset + 1 such that
+    the trees of several shards can be merged.
+    Returns the number of processed events and of matched taus.
+    '''
     runtype = args.runtype
-    globaldebug = args.debug
-    maxEvents = args.maxEvents
-    RelVal = args.release
-    globalTag = args.globalTag
-    exact = args.exact
     useRecoJets = args.useRecoJets
     storageSite = args.storageSite
-    localdir = args.localdir
     tauCollection = args.tauCollection
     mvaid = args.mvaid
     no_anti_lepton = args.noAntiLepton
-    if len(localdir) > 1 and localdir[-1] != "/":
-        localdir += "/"
-    inputfiles = args.inputfiles
-
-    dprint('Running with')
-    dprint('runtype', runtype)
-    dprint('RelVal', RelVal)
-    dprint('globalTag', globalTag)
-    dprint('storageSite', storageSite)
-
-    filelist = []
-
-    if inputfiles:
-        filelist = inputfiles
-    else:
-        path = '/store/relval/{}/{}/MINIAODSIM/{}'.format(
-            RelVal,
-            runtype_to_sample[runtype],
-            globalTag
-        )
-
-        if storageSite == "eos":
-            filelist = getFilesFromEOS(path)
-        elif storageSite == "das":
-            filelist = getFilesFromDAS(
-                RelVal, runtype_to_sample[runtype], globalTag, exact)
-        elif storageSite == 'loc':
-            filelist = getFilesFromEOS(
-                localdir + runtype_to_sample[runtype] +
-                "/" + RelVal + '-' + globalTag + '/',
-                cmseospath=False)
-
-        if not filelist:
-            print 'Sample', RelVal, runtype, 'does not exist in', path
-            sys.exit(0)
 
     events = Events(filelist)
-    if maxEvents < 0 and storageSite == "das":
-      maxEvents=getNeventsFromDAS(RelVal, runtype_to_sample[runtype], globalTag, exact)
-    print len(filelist), "files will be analyzed:", filelist, '\nEvents will be analyzed: %i' % maxEvents
-
-    # +++++++ Output file +++++++++
-    outputFileName = args.outputFileName
-    if not outputFileName:
-        if storageSite == 'loc':
-            outputFileName = localdir + \
-                runtype_to_sample[runtype] + "/" + RelVal + \
-                '-' + globalTag + '/' + 'TauValTree/'
-            if not os.path.isdir(outputFileName):
-                result = subprocess.check_output(
-                    "mkdir -p {outputFileName}".format(
-                        outputFileName=outputFileName
-                    ),
-                    shell=True
-                )
-
-        genSuffix = ""
-        if not useRecoJets and (runtype in jet_run_types):
-            genSuffix = "_genJets"
-        if runtype in muon_run_types:
-            genSuffix = "_genMuon"
-        if runtype in ele_run_types:
-            genSuffix = "_genEle"
-
-        outputFileName += 'Myroot_' + RelVal + '_' + \
-            globalTag + '_' + runtype + genSuffix + '.root'
-
-    else:
-        if "/" in outputFileName and outputFileName[0] != "/":
-            print "location of output file has a dir structure " \
-                  " but doesn't start with dash"
-            sys.exit(0)
-        if outputFileName[-5:] != ".root":
-            outputFileName += '.root'
-            print "output file should have a root format" \
-                  " - added automatically:", outputFileName
-
-    print "outputFileName:", outputFileName
 
-    out_file = ROOT.TFile(outputFileName, 'recreate')
+    storage = StorageProfile(args.storageProfile, args.doubleVars)
+    out_file = storage.openFile(outputFileName)
 
     h_ngen = ROOT.TH1F("h_ngen", "h_ngen", 10, 0, 10)
     h_pfch_pt = ROOT.TH1F("h_pfch_pt", "pfch;p_{T} (GeV)", 500, 0, 500)
@@ -244,82 +201,89 @@ if __name__ == '__main__':
     h_lost_phi = ROOT.TH1F("h_lost_phi", "lost;#phi", 64, -3.2, 3.2)
 
     tau_tree = ROOT.TTree('per_tau', 'per_tau')
+    event_tree = ROOT.TTree(event_tree_name, event_tree_name)
 
     all_vars = [
-        Var('tau_eventid', int),
-        Var('tau_id', int),
-        Var('tau_refidx', int),
-        Var('tau_run', int),
-        Var('tau_lumi', int),
-        Var('tau_dm', int),
-        Var('tau_pt', float),
-        Var('tau_eta', float),
-        Var('tau_phi', float),
-        Var('tau_mass', float),
-        Var('tau_chargedpt', float),
-        Var('tau_neutralpt', float),
-        Var('tau_gendm', int),
-        Var('tau_genpt', float),
-        Var('tau_geneta', float),
-        Var('tau_genphi', float),
-        Var('tau_genchargedpt', float),
-        Var('tau_genneutralpt', float),
-        Var('tau_vertex', int),
-        Var('tau_nTruePU', float),
-        Var('tau_nPU', int),
-        # Var('tau_vtxTovtx_dz', float),
-        Var('tau_tauVtxTovtx_dz', float),
-        Var('tau_iso_dz001', float),
-        Var('tau_iso_dz02', float),
-        Var('tau_iso_pv', float),
-        Var('tau_iso_nopv', float),
-        Var('tau_iso_neu', float),
-        Var('tau_iso_puppi', float),
-        Var('tau_iso_puppiNoL', float),
-        Var('tau_dxy', float),
-        Var('tau_dxy_err', float),
-        Var('tau_dxy_sig', float),
-        Var('tau_ip3d', float),
-        Var('tau_ip3d_err', float),
-        Var('tau_ip3d_sig', float),
-        Var('tau_flightLength', float),
-        Var('tau_flightLength_sig', float),
-        Var('tau_etaAtEcalEntrance', float),
-        Var('tau_phiAtEcalEntrance', float),
-        Var('tau_etaAtEcalEntranceLeadChargedCand', float),
-        Var('tau_ptLeadChargedCand', float),
-        Var('tau_pdgidLeadChargedCand', float),
-        Var('tau_emFraction_MVA', float),
-        Var('tau_hcalEnergyLeadChargedHadrCand', float),
-        Var('tau_ecalEnergyLeadChargedHadrCand', float),
-        Var('tau_pleadChargedHadrCand', float),
-        Var('tau_hcalEnergyLeadChargedHadrCandFrac', float),
-        Var('tau_ecalEnergyLeadChargedHadrCandFrac', float),
+        ('tau_id', int),
+        ('tau_refidx', int),
+        ('tau_dm', int),
+        ('tau_pt', float),
+        ('tau_eta', float),
+        ('tau_phi', float),
+        ('tau_mass', float),
+        ('tau_chargedpt', float),
+        ('tau_neutralpt', float),
+        ('tau_gendm', int),
+        ('tau_genpt', float),
+        ('tau_geneta', float),
+        ('tau_genphi', float),
+        ('tau_genchargedpt', float),
+        ('tau_genneutralpt', float),
+        # ('tau_vtxTovtx_dz', float),
+        ('tau_tauVtxTovtx_dz', float),
+        ('tau_iso_dz001', float),
+        ('tau_iso_dz02', float),
+        ('tau_iso_pv', float),
+        ('tau_iso_nopv', float),
+        ('tau_iso_neu', float),
+        ('tau_iso_puppi', float),
+        ('tau_iso_puppiNoL', float),
+        ('tau_dxy', float),
+        ('tau_dxy_err', float),
+        ('tau_dxy_sig', float),
+        ('tau_ip3d', float),
+        ('tau_ip3d_err', float),
+        ('tau_ip3d_sig', float),
+        ('tau_flightLength', float),
+        ('tau_flightLength_sig', float),
+        ('tau_etaAtEcalEntrance', float),
+        ('tau_phiAtEcalEntrance', float),
+        ('tau_etaAtEcalEntranceLeadChargedCand', float),
+        ('tau_ptLeadChargedCand', float),
+        ('tau_pdgidLeadChargedCand', float),
+        ('tau_emFraction_MVA', float),
+        ('tau_hcalEnergyLeadChargedHadrCand', float),
+        ('tau_ecalEnergyLeadChargedHadrCand', float),
+        ('tau_pleadChargedHadrCand', float),
+        ('tau_hcalEnergyLeadChargedHadrCandFrac', float),
+        ('tau_ecalEnergyLeadChargedHadrCandFrac', float),
     ]
 
-    if tauCollection=="selectedPatTaus":
-        all_tau_ids += selected_pat_tau_ids
-    elif tauCollection=="slimmedTaus":
-        all_tau_ids += slimmed_tau_ids
-
-    if not no_anti_lepton:
-        all_tau_ids += lepton_tau_ids
-
-    for mva_id in mvaid:
-        all_tau_ids += tau_ids[mva_id]
-
-    for (tau_id, v_type) in all_tau_ids:
-        if tauCollection=="selectedPatTaus":
-            if (tau_id, v_type) in selected_pat_tau_ids:
-                tau_id = tau_id.replace("2018", "").replace("Simple", "3")
-                print 'tau_' + tau_id
-        all_vars.append(Var('tau_' + tau_id, v_type))
-
-    all_var_dict = {var.name: var for var in all_vars}
-
-    for var in all_vars:
-        tau_tree.Branch(var.name, var.storage, var.name +
-                        '/' + ('I' if var.type == int else 'D'))
+    iso_engine = IsolationEngine(args.isoCones, args.isoDz)
+    all_vars += [(name, float) for name in iso_engine.extraVars()]
+
+    tau_id_table = TauIDTable(
+        get_run_tau_ids(tauCollection, mvaid, no_anti_lepton),
+        pack_wps=args.packWPs)
+    all_vars += tau_id_table.variables()
+
+    record = RecordBuffer(storage.variableTypes(all_vars))
+    record.bind(tau_tree)
+    storage.configureTree(tau_tree)
+    tau_id_table.compile(record)
+
+    event_record = RecordBuffer(storage.variableTypes(event_vars))
+    event_record.bind(event_tree)
+    storage.configureTree(event_tree)
+
+    # Slots of the variables filled together, resolved once
+    event_slots = event_record.slotGroup(['tau_id', 'tau_run', 'tau_lumi', 'tau_eventid', 'tau_vertex'])
+    pu_slots = event_record.slotGroup(['tau_nTruePU', 'tau_nPU'])
+    ref_slots = record.slotGroup(['tau_id', 'tau_refidx'])
+    gen_tau_slots = record.slotGroup(['tau_gendm', 'tau_genpt', 'tau_geneta', 'tau_genphi',
+                                      'tau_genchargedpt', 'tau_genneutralpt'])
+    gen_slots = record.slotGroup(['tau_gendm', 'tau_genpt', 'tau_geneta', 'tau_genphi'])
+    iso_names = iso_engine.variables()
+    iso_slots = record.slotGroup(iso_names)
+    flight_slots = record.slotGroup(['tau_flightLength', 'tau_flightLength_sig'])
+    reco_slots = record.slotGroup([
+        'tau_dm', 'tau_pt', 'tau_eta', 'tau_phi', 'tau_mass',
+        'tau_chargedpt', 'tau_neutralpt', 'tau_tauVtxTovtx_dz',
+        'tau_dxy', 'tau_dxy_err', 'tau_dxy_sig', 'tau_ip3d', 'tau_ip3d_err', 'tau_ip3d_sig',
+        'tau_etaAtEcalEntrance', 'tau_etaAtEcalEntranceLeadChargedCand', 'tau_phiAtEcalEntrance',
+        'tau_ptLeadChargedCand', 'tau_pdgidLeadChargedCand', 'tau_emFraction_MVA',
+        'tau_hcalEnergyLeadChargedHadrCand', 'tau_ecalEnergyLeadChargedHadrCand', 'tau_pleadChargedHadrCand',
+        'tau_hcalEnergyLeadChargedHadrCandFrac', 'tau_ecalEnergyLeadChargedHadrCandFrac'])
 
     evtid = 0
 
@@ -421,20 +385,18 @@ if __name__ == '__main__':
         # ]
 
         refObjs = []
+        # Per-event gen decay cache, filled in parallel to refObjs
+        genDecays = []
         if runtype in tau_run_types:
             for gen_tau in genTaus:
-                gen_tau.visP4 = visibleP4(gen_tau)
+                decay = genTauDecay(gen_tau)
 
-                gen_dm = tauDecayModes.genDecayModeInt(
-                    [d for d in gen_tau.final_ds
-                        if abs(d.pdgId()) not in [12, 14, 16]]
-                )
-                if abs(gen_tau.visP4.eta()) > 2.3:
+                if abs(decay.vis_p4.eta()) > 2.3:
                     continue
-                # if gen_tau.visP4.pt() < 10:
-                if gen_tau.visP4.pt() < 15:
+                # if decay.vis_p4.pt() < 10:
+                if decay.vis_p4.pt() < 15:
                     continue
-                if gen_dm == -11 or gen_dm == -13:
+                if decay.dm == -11 or decay.dm == -13:
                     continue
                 # For the 10-tau sample, remove gen taus that have overlap
                 if any(deltaR(other_tau, gen_tau) < 0.5
@@ -442,6 +404,7 @@ if __name__ == '__main__':
                     continue
 
                 refObjs.append(gen_tau)
+                genDecays.append(decay)
 
         elif runtype in jet_run_types:
             if useRecoJets:
@@ -471,72 +434,40 @@ if __name__ == '__main__':
             refObjs = copy.deepcopy(genMuons)
 
         ###
-        Matched = MatchTausToJets(refObjs, dR2)
+        Matched = matchRefsToTaus(refObjs, taus, dR2, args.matching)
 
         ###
+        event_record.reset()
+        event_slots.fill([evtid_offset + evtid, run, lumi, eid, len(vertices)])
+        for iPuInfo in puInfo:
+            if iPuInfo.getBunchCrossing() == 0:
+                pu_slots.fill([iPuInfo.getTrueNumInteractions(), iPuInfo.getPU_NumInteractions()])
+                break
+        event_tree.Fill()
+
         h_ngen.Fill(len(refObjs))
         for refidx,refObj in enumerate(refObjs):
-            for var in all_vars:
-                var.reset()
-            all_var_dict['tau_id'].fill(evtid)
-            all_var_dict['tau_refidx'].fill(refidx)
-            all_var_dict['tau_run'].fill(run)
-            all_var_dict['tau_lumi'].fill(lumi)
-            all_var_dict['tau_eventid'].fill(eid)
-            all_var_dict['tau_vertex'].fill(len(vertices))
-            for iPuInfo in puInfo:
-                if iPuInfo.getBunchCrossing() == 0:
-                    all_var_dict['tau_nTruePU'].fill(
-                        iPuInfo.getTrueNumInteractions())
-                    all_var_dict['tau_nPU'].fill(
-                        iPuInfo.getPU_NumInteractions())
-                    break
+            record.reset()
+            ref_slots.fill([evtid_offset + evtid, refidx])
 
             if runtype in tau_run_types:
-                gen_dm = tauDecayModes.genDecayModeInt(
-                    [d for d in finalDaughters(refObj)
-                        if (abs(d.pdgId()) not in [12, 14, 16])]
-                )
-
-                all_var_dict['tau_gendm'].fill(gen_dm)
-                all_var_dict['tau_genpt'].fill(refObj.visP4.pt())
-                all_var_dict['tau_geneta'].fill(refObj.visP4.eta())
-                all_var_dict['tau_genphi'].fill(refObj.visP4.phi())
-                charged_p4 = sum(
-                    (d.p4() for d in refObj.final_ds
-                        if d.charge()),
-                    ROOT.math.XYZTLorentzVectorD())
-                neutral_p4 = sum(
-                    (d.p4() for d in refObj.final_ds
-                        if (abs(d.pdgId()) not in [12, 14, 16] and
-                            not d.charge())),
-                    ROOT.math.XYZTLorentzVectorD())
-                all_var_dict['tau_genchargedpt'].fill(charged_p4.pt())
-                all_var_dict['tau_genneutralpt'].fill(neutral_p4.pt())
+                decay = genDecays[refidx]
+                gen_tau_slots.fill([decay.dm, decay.vis_p4.pt(), decay.vis_p4.eta(), decay.vis_p4.phi(),
+                                    decay.charged_p4.pt(), decay.neutral_p4.pt()])
             else:
-                all_var_dict['tau_gendm'].fill(-1)
-                all_var_dict['tau_genpt'].fill(refObj.pt())
-                all_var_dict['tau_geneta'].fill(refObj.eta())
-                all_var_dict['tau_genphi'].fill(refObj.phi())
+                gen_slots.fill([-1, refObj.pt(), refObj.eta(), refObj.phi()])
 
             if refidx in Matched:
                 tau = taus[Matched[refidx]]
                 # Fill reco-tau variables if it exists...
                 NMatchedTaus += 1
 
-                all_var_dict['tau_dm'].fill(tau.decayMode())
-                all_var_dict['tau_pt'].fill(tau.pt())
-                all_var_dict['tau_eta'].fill(tau.eta())
-                all_var_dict['tau_phi'].fill(tau.phi())
-                all_var_dict['tau_mass'].fill(tau.mass())
-
-                all_var_dict['tau_chargedpt'].fill(
-                    sum((d.p4() for d in tau.signalChargedHadrCands()),
-                        ROOT.math.XYZTLorentzVectorD()).pt())
-                all_var_dict['tau_neutralpt'].fill(
-                    sum((d.p4() for d in tau.signalGammaCands()),
-                        ROOT.math.XYZTLorentzVectorD()).pt()
-                )
+                chargedpt = sum(
+                    (d.p4() for d in tau.signalChargedHadrCands()),
+                    ROOT.math.XYZTLorentzVectorD()).pt()
+                neutralpt = sum(
+                    (d.p4() for d in tau.signalGammaCands()),
+                    ROOT.math.XYZTLorentzVectorD()).pt()
 
                 # Use candidate to vertex associaton as in MiniAOD
                 tau_vertex_idxpf = tau.leadChargedHadrCand().vertexRef().key()
@@ -551,114 +482,161 @@ if __name__ == '__main__':
                     if vtxdz < tau_tauVtxTovtx_dz:
                         tau_tauVtxTovtx_dz = vtxdz
 
-                all_var_dict['tau_tauVtxTovtx_dz'].fill(tau_tauVtxTovtx_dz)
-                all_var_dict['tau_iso_dz001'].fill(0.)
-                all_var_dict['tau_iso_dz02'].fill(0.)
-                all_var_dict['tau_iso_pv'].fill(0.)
-                all_var_dict['tau_iso_nopv'].fill(0.)
-                all_var_dict['tau_iso_neu'].fill(0.)
-                all_var_dict['tau_iso_puppi'].fill(0.)
-                all_var_dict['tau_iso_puppiNoL'].fill(0.)
-
-                for cand in tau.isolationChargedHadrCands():
-
-                    if not abs(cand.charge()) > 0:
-                        continue
-                    if deltaR(tau.eta(),
-                              tau.phi(),
-                              cand.eta(),
-                              cand.phi()) > 0.5:
-                        continue
-
-                    def get_track(charged_cand):
-                        if is_above_cmssw_version(9, 2, 0):
-                            if charged_cand.hasTrackDetails():
-                                return charged_cand.pseudoTrack()
-                            return None
-                        return charged_cand.pseudoTrack()
-
-                    # MB use candidate methods only
-                    if (cand.pt() <= 0.5 or
-                            cand.dxy(
-                                vertices[tau_vertex_idxpf].position()
-                    ) >= 0.1):
-                        continue
-
-                    cand_track = get_track(cand)
-                    if not cand_track:
-                        continue
-                    if (cand.numberOfHits() > 0 and
-                            (cand_track.normalizedChi2() >= 100. or
-                             cand.numberOfHits() < 3)):
-                        continue
-                    # dz_tt = tt.dz(vertices[tau_vertex_idxpf].position())
-
-                    # MB use cand methods only
-                    dz_tt = cand.dz(vertices[tau_vertex_idxpf].position())
-                    if abs(dz_tt) < 0.2:
-                        all_var_dict['tau_iso_dz02'].add(cand.pt())
-                        all_var_dict['tau_iso_puppi'].add(
-                            cand.pt() * cand.puppiWeight())
-                        all_var_dict['tau_iso_puppiNoL'].add(
-                            cand.pt() * cand.puppiWeightNoLep())
-
-                    if abs(dz_tt) < 0.015:
-                        all_var_dict['tau_iso_dz001'].add(cand.pt())
-
-                    if (cand.vertexRef().key() == tau_vertex_idxpf and
-                            cand.pvAssociationQuality() > 4):
-                        all_var_dict['tau_iso_pv'].add(cand.pt())
-
-                    elif (cand.vertexRef().key() != tau_vertex_idxpf and
-                          abs(dz_tt) < 0.2):
-                        all_var_dict['tau_iso_nopv'].add(cand.pt())
-
-                for cand in tau.isolationGammaCands():
-                    if abs(cand.charge()) > 0 or abs(cand.pdgId()) != 22:
-                        continue
-                    if deltaR(tau.eta(),
-                              tau.phi(),
-                              cand.eta(),
-                              cand.phi()) > 0.5:
-                        continue
-                    if cand.pt() <= 0.5:
-                        continue
-
-                    all_var_dict['tau_iso_neu'].add(cand.pt())
-                    all_var_dict['tau_iso_puppi'].add(
-                        cand.pt() * cand.puppiWeight())
-                    all_var_dict['tau_iso_puppiNoL'].add(
-                        cand.pt() * cand.puppiWeightNoLep())
-
-                all_var_dict['tau_dxy'].fill(tau.dxy())
-                all_var_dict['tau_dxy_err'].fill(tau.dxy_error())
-                all_var_dict['tau_dxy_sig'].fill(tau.dxy_Sig())
-                all_var_dict['tau_ip3d'].fill(tau.ip3d())
-                all_var_dict['tau_ip3d_err'].fill(tau.ip3d_error())
-                all_var_dict['tau_ip3d_sig'].fill(tau.ip3d_Sig())
+                iso = iso_engine.compute(tau, vertices, tau_vertex_idxpf)
+                iso_slots.fill([iso[name] for name in iso_names])
 
                 if tau.hasSecondaryVertex():
-                    all_var_dict['tau_flightLength'].fill(
-                        math.sqrt(tau.flightLength().mag2()))
-                    all_var_dict['tau_flightLength_sig'].fill(
-                        tau.flightLengthSig())
-
-                all_var_dict['tau_etaAtEcalEntrance'].fill(tau.etaAtEcalEntrance())
-                all_var_dict['tau_etaAtEcalEntranceLeadChargedCand'].fill(tau.etaAtEcalEntranceLeadChargedCand())
-                all_var_dict['tau_phiAtEcalEntrance'].fill(tau.phiAtEcalEntrance())
-                all_var_dict['tau_ptLeadChargedCand'].fill(tau.ptLeadChargedCand())
-                all_var_dict['tau_pdgidLeadChargedCand'].fill(tau.leadChargedHadrCand().pdgId())
-                all_var_dict['tau_emFraction_MVA'].fill(tau.emFraction_MVA())
-                all_var_dict['tau_hcalEnergyLeadChargedHadrCand'].fill(tau.hcalEnergyLeadChargedHadrCand())
-                all_var_dict['tau_ecalEnergyLeadChargedHadrCand'].fill(tau.ecalEnergyLeadChargedHadrCand())
-                all_var_dict['tau_pleadChargedHadrCand'].fill(tau.leadChargedHadrCand().p())
-                all_var_dict['tau_hcalEnergyLeadChargedHadrCandFrac'].fill(tau.hcalEnergyLeadChargedHadrCand()/tau.leadChargedHadrCand().p())
-                all_var_dict['tau_ecalEnergyLeadChargedHadrCandFrac'].fill(tau.ecalEnergyLeadChargedHadrCand()/tau.leadChargedHadrCand().p())
-
-                fill_tau_ids(all_var_dict, tau, all_tau_ids)
+                    flight_slots.fill([math.sqrt(tau.flightLength().mag2()), tau.flightLengthSig()])
+
+                lead_charged = tau.leadChargedHadrCand()
+                reco_slots.fill([
+                    tau.decayMode(), tau.pt(), tau.eta(), tau.phi(), tau.mass(),
+                    chargedpt, neutralpt, tau_tauVtxTovtx_dz,
+                    tau.dxy(), tau.dxy_error(), tau.dxy_Sig(), tau.ip3d(), tau.ip3d_error(), tau.ip3d_Sig(),
+                    tau.etaAtEcalEntrance(), tau.etaAtEcalEntranceLeadChargedCand(), tau.phiAtEcalEntrance(),
+                    tau.ptLeadChargedCand(), lead_charged.pdgId(), tau.emFraction_MVA(),
+                    tau.hcalEnergyLeadChargedHadrCand(), tau.ecalEnergyLeadChargedHadrCand(), lead_charged.p(),
+                    tau.hcalEnergyLeadChargedHadrCand()/lead_charged.p(), tau.ecalEnergyLeadChargedHadrCand()/lead_charged.p()])
+
+                tau_id_table.fill(tau)
             tau_tree.Fill()
     print "MATCHED TAUS:", NMatchedTaus
     print evtid, 'events are processed !'
 
     out_file.Write()
     out_file.Close()
+
+    return min(evtid, maxEvents) if maxEvents > 0 else evtid, NMatchedTaus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    addArguments(parser, produce=True, compare=False)
+    args = parser.parse_args()
+
+    runtype = args.runtype
+    globaldebug = args.debug
+    maxEvents = args.maxEvents
+    RelVal = args.release
+    globalTag = args.globalTag
+    exact = args.exact
+    useRecoJets = args.useRecoJets
+    storageSite = args.storageSite
+    localdir = args.localdir
+    tauCollection = args.tauCollection
+    mvaid = args.mvaid
+    no_anti_lepton = args.noAntiLepton
+    if len(localdir) > 1 and localdir[-1] != "/":
+        localdir += "/"
+    inputfiles = args.inputfiles
+
+    dprint('Running with')
+    dprint('runtype', runtype)
+    dprint('RelVal', RelVal)
+    dprint('globalTag', globalTag)
+    dprint('storageSite', storageSite)
+
+    filelist = []
+
+    if inputfiles:
+        filelist = inputfiles
+    else:
+        path = '/store/relval/{}/{}/MINIAODSIM/{}'.format(
+            RelVal,
+            runtype_to_sample[runtype],
+            globalTag
+        )
+
+        if storageSite == "eos":
+            filelist = getFilesFromEOS(path)
+        elif storageSite == "das":
+            filelist = getFilesFromDAS(
+                RelVal, runtype_to_sample[runtype], globalTag, exact)
+        elif storageSite == 'loc':
+            filelist = getFilesFromEOS(
+                localdir + runtype_to_sample[runtype] +
+                "/" + RelVal + '-' + globalTag + '/',
+                cmseospath=False)
+
+        if not filelist:
+            print 'Sample', RelVal, runtype, 'does not exist in', path
+            sys.exit(0)
+
+    if maxEvents < 0 and storageSite == "das":
+      maxEvents=getNeventsFromDAS(RelVal, runtype_to_sample[runtype], globalTag, exact)
+    if args.cacheDir:
+        # Keeps the shared locks on the staged files until the end of the job
+        stage_in_cache = StageInCache(args.cacheDir, args.cacheSize)
+        filelist = stage_in_cache.stageFiles(filelist)
+
+    print len(filelist), "files will be analyzed:", filelist, '\nEvents will be analyzed: %i' % maxEvents
+
+    # +++++++ Output file +++++++++
+    outputFileName = args.outputFileName
+    if not outputFileName:
+        if storageSite == 'loc':
+            outputFileName = localdir + \
+                runtype_to_sample[runtype] + "/" + RelVal + \
+                '-' + globalTag + '/' + 'TauValTree/'
+            if not os.path.isdir(outputFileName):
+                result = subprocess.check_output(
+                    "mkdir -p {outputFileName}".format(
+                        outputFileName=outputFileName
+                    ),
+                    shell=True
+                )
+
+        genSuffix = ""
+        if not useRecoJets and (runtype in jet_run_types):
+            genSuffix = "_genJets"
+        if runtype in muon_run_types:
+            genSuffix = "_genMuon"
+        if runtype in ele_run_types:
+            genSuffix = "_genEle"
+
+        outputFileName += 'Myroot_' + RelVal + '_' + \
+            globalTag + '_' + runtype + genSuffix + '.root'
+
+    else:
+        if "/" in outputFileName and outputFileName[0] != "/":
+            print "location of output file has a dir structure " \
+                  " but doesn't start with dash"
+            sys.exit(0)
+        if outputFileName[-5:] != ".root":
+            outputFileName += '.root'
+            print "output file should have a root format" \
+                  " - added automatically:", outputFileName
+
+    print "outputFileName:", outputFileName
+
+    # Files holding the produced trees
+    output_names = [outputFileName]
+    if args.jobs > 1 and len(filelist) > 1:
+        shards = splitFiles(filelist, args.jobs, maxEvents)
+        part_names = [outputFileName[:-5] + '_part{}.root'.format(i)
+                      for i in range(len(shards))]
+        print 'Processing', len(shards), 'shards in parallel'
+        pool = multiprocessing.Pool(len(shards))
+        results = pool.map(runShard, [
+            (args, files, part_name, n_events, offset)
+            for (files, n_events, offset), part_name in zip(shards, part_names)
+        ])
+        pool.close()
+        pool.join()
+        if args.noMerge:
+            # compare.py reads the parts as one chain
+            print 'Keeping the unmerged outputs', ' '.join(part_names)
+            output_names = part_names
+        else:
+            mergeOutputs(part_names, outputFileName,
+                         StorageProfile(args.storageProfile, args.doubleVars))
+        print "MATCHED TAUS (all shards):", sum(r[1] for r in results)
+        print sum(r[0] for r in results), 'events are processed in total !'
+    else:
+        processFiles(args, filelist, outputFileName, maxEvents)
+
+    if args.storageReport:
+        for output_name in output_names:
+            reportStorage(output_name)
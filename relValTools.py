@@ -1,5 +1,8 @@
 import re
 import os
+import shutil
+import fcntl
+import hashlib
 import subprocess
 
 import eostools
@@ -12,7 +15,9 @@ from sample_mapping import runtype_to_sample
 
 def addArguments(parser, produce=True, compare=False):
     parser.add_argument('--runtype', choices=['DYToLL', 'ZTT', 'ZEE', 'ZMM', 'ZpMM', 'QCD', 'TTbar', 'TTbarTau', 'ZpTT', 'TenTaus', 'truetauDY', 'efakeDY', 'mufakeDY', 'jfakeDY', 'jfakeQCD'], help='choose sample type')
-    parser.add_argument('-i', '--inputfiles', default=[], nargs='*', help="List of files locations [Default: %(default)s]")
+    parser.add_argument('-i', '--inputfiles', default=[], nargs='*',
+        help="List of files locations, one per release; each can be comma-separated files or glob patterns, e.g. "
+             "'Myroot_*_part*.root' [Default: %(default)s]")
 
     # useful for debugging
     parser.add_argument('-n', '--maxEvents', default=-1, type=int, help='Number of events that will be analyzed (-1 = all events) [Default: %(default)s]')
@@ -32,12 +37,46 @@ def addArguments(parser, produce=True, compare=False):
         parser.add_argument('-u', '--useRecoJets', default=False, action="store_true", help='Use RecoJets [Default: %(default)s]')
         parser.add_argument('--noAntiLepton', default=False, action='store_true', help='Do not access anti-lepton discriminators, e.g. if you use the tau reconstruction on top of MiniAOD that does not calculate them')
         parser.add_argument('--exact', default='', help='Provide exact DAS query (of the form "/Sample.../GT.../MINIAODSIM")')
+        parser.add_argument('--matching', default='greedy', choices=['greedy', 'optimal'], help='Unique assignment of reco taus to reference objects; optimal requires scipy [Default: %(default)s]')
+        parser.add_argument('--isoCones', default=[], type=float, nargs='*',
+            help='Extra cone sizes for the recomputed isolation; charged sums are stored for each combination with --isoDz '
+                 '[Default: %(default)s]')
+        parser.add_argument('--isoDz', default=[0.2], type=float, nargs='*', help='dz thresholds (cm) of the extra charged isolation sums [Default: %(default)s]')
+        parser.add_argument('--packWPs', default=False, action='store_true',
+            help='Store the working points of each discriminator family as one 8-bit mask branch (tau_by<family>WPs) next to the '
+                 'raw score')
+        parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of processes; the input files are split across them and the outputs merged [Default: %(default)s]')
+        parser.add_argument('--noMerge', default=False, action='store_true',
+            help='With --jobs, keep the per-shard outputs (<output>_part<N>.root), which compare.py reads as one chain, instead '
+                 'of merging them')
+        parser.add_argument('--storageProfile', default='default', choices=['default', 'fast', 'archive'],
+            help='Output storage: fast = float32 + LZ4, archive = float32 + LZMA, both with large baskets for columnar reads '
+                 '[Default: %(default)s]')
+        parser.add_argument('--doubleVars', default=[], nargs='*', help='Branch name patterns (e.g. tau_dxy*) kept in double precision by the fast/archive profiles [Default: %(default)s]')
+        parser.add_argument('--cacheDir', default='', help='Local stage-in cache for remote input files, shared between jobs; disabled if empty [Default: %(default)s]')
+        parser.add_argument('--cacheSize', default=200., type=float, help='Size cap of the stage-in cache in GB, least recently used files are evicted [Default: %(default)s]')
+        parser.add_argument('--storageReport', default=False, action='store_true', help='Print file size and read speed of the produced tree')
 
     if compare:
-        parser.add_argument('-p', '--part', default=0, type=int, help='Make WP plots(1), fraction of histogram plots(2..totalparts), \
-            , or everything at once(0) (This part needs to be split up to avoid a crash that happens for some reason)')
-        parser.add_argument('--totalparts', default=7, type=int, help='How many parts the compare step should be split into. \
-            Increase this value if root crashes occur.')
+        parser.add_argument('-p', '--part', default=0, type=int, help='Make the plots of one of the cost-balanced parts (1..totalparts) or everything at once (0)')
+        parser.add_argument('--totalparts', default=7, type=int,
+            help='How many parts the compare step should be split into; the plot jobs are distributed by their estimated or '
+                 'previously measured cost')
+        parser.add_argument('--processes', default=1, type=int, help='With --part 0, run the parts in a local process pool of this size [Default: %(default)s]')
+        parser.add_argument('--costFile', default='', help='File with the measured plot costs of earlier runs used to balance the parts [Default: compare_costs_<runtype>.json]')
+        parser.add_argument('--profileEntries', default=10000, type=int,
+            help='Entries over which the histograms of each plot are filled on their own to measure its cost; 0 shares the '
+                 'filling time by the estimated costs [Default: %(default)s]')
+        parser.add_argument('--effAxes', default=['pt', 'eta'], nargs='*', choices=['pt', 'eta', 'dm', 'pu'],
+            help='Efficiency plots to make (gen. pt, eta, decay mode, pileup); all are projections of one efficiency cube per '
+                 'discriminator [Default: %(default)s]')
+        parser.add_argument('--effMaps', default=[], nargs='*', choices=['pt:eta', 'pt:dm', 'pt:pu', 'eta:dm', 'eta:pu', 'dm:pu'],
+            help='Efficiency maps to make (x:y), also projections of the efficiency cubes [Default: %(default)s]')
+        parser.add_argument('--triageThreshold', default=0., type=float,
+            help='Only render plots whose compatibility score with the first release, -log10 of the smallest chi2/KS/pull '
+                 'p-value, is at least this; all plots are scored [Default: %(default)s]')
+        parser.add_argument('--triageFile', default='', help='Ranked JSON summary of the plot scores, with an HTML version next to it [Default: compare_<runtype>/triage.json]')
+        parser.add_argument('--wpFile', default='', help='Working points solved by solve_wps.py, added to the efficiency plots [Default: %(default)s]')
         parser.add_argument('-b', '--onebin', default=False, action="store_true", help='Plot inclusive efficiencies by only using one bin')
         parser.add_argument('--releases', default=["CMSSW_9_4_0_pre1", "CMSSW_9_4_0_pre2"], nargs='*', help='List of releases')
         parser.add_argument('--globalTags', default=['93X_mc2017_realistic_v3-v1', 'PU25ns_94X_mc2017_realistic_v1-v1'], nargs='*', help='List of global tags [Default: %(default)s]')
@@ -47,8 +86,17 @@ def addArguments(parser, produce=True, compare=False):
         parser.add_argument('-c', '--colors', default=[1, 4], nargs='*', help='Colors of variables to place on a single plot (if only one release+GT)')
         parser.add_argument('--varyLooseId', default=False, action="store_true", help='If the loose Id should be varied')
         parser.add_argument('--setLooseId', default='tau_byLooseIsolationMVArun2v1DBoldDMwLT', help='LooseId to be considered')
-        parser.add_argument('--tau-matching', default=False, action='store_true', help='Make tau matching comparison plots')
+        parser.add_argument('--tau-matching', default=False, action='store_true',
+            help='Make tau matching comparison plots; the taus of the two trees are joined by (run, lumi, event, refidx) and the '
+                 'partner is available as ft.* (ft.tau_matched = 0 without partner)')
         parser.add_argument('--selection', default='', help='Add additional selection')
+        parser.add_argument('--engine', default='columnar', choices=['columnar', 'formula'],
+            help='Histogram filling: columnar evaluates all expressions as numpy arrays with shared sub-expressions, formula '
+                 'uses one TTreeFormula per expression [Default: %(default)s]')
+        parser.add_argument('--histCache', default='hist_cache',
+            help='Directory of filled histograms keyed by input checksums, expression, selection and binning, such that '
+                 're-plotting only fills new histograms; disabled if empty [Default: %(default)s]')
+        parser.add_argument('--histCacheSize', default=2000., type=float, help='Size cap of the histogram cache in MB, least recently used histograms are evicted [Default: %(default)s]')
 
 
 def dprint(*text):
@@ -118,6 +166,126 @@ def getNeventsFromDAS(release, runtype, globalTag, exact=""):
       return -1
 
 
+def remoteChecksum(url):
+    '''adler32 checksum of a local, EOS or xrootd file, None if unknown'''
+    if os.path.exists(url) or eostools.isEOS(url):
+        return eostools.fileChecksum(url)
+    if url.startswith('root://'):
+        _, host, path, _ = eostools.splitPFN(url)
+        out, _, ret = eostools._runCommand(['xrdfs', host, 'query', 'checksum', path])
+        if ret == 0 and out.startswith('adler32'):
+            return out.split()[1].rjust(8, '0')
+    return None
+
+
+class StageInCache(object):
+    '''Local disk cache for remote input files, shared between jobs.
+    Files are copied once (eostools.xrdcp for EOS, xrdcp for other xrootd
+    URLs), verified against the remote adler32 checksum and evicted in LRU
+    order when the cache grows beyond max_size_gb.
+
+    Locking: a file is downloaded under an exclusive lock on <file>.lock and
+    used under a shared lock that is held until the process exits, such that
+    concurrent jobs never evict files that are still read. Eviction itself
+    is serialised by a lock on the cache directory.
+    '''
+
+    def __init__(self, cache_dir, max_size_gb=200.):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_gb * 1e9
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        self.held_locks = {}
+
+    def localPath(self, url):
+        key = hashlib.sha1(url).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key + '_' + os.path.basename(url))
+
+    def openLock(self, path):
+        return open(path + '.lock', 'a')
+
+    def copy(self, url, dest):
+        if os.path.exists(url):
+            shutil.copyfile(url, dest)
+        elif eostools.isEOS(url):
+            eostools.xrdcp(url, dest)
+        else:
+            eostools._xrdcpSingleFile(url, dest)
+
+    def fetch(self, url, path):
+        tmp_path = path + '.part{}'.format(os.getpid())
+        self.copy(url, tmp_path)
+        if not os.path.exists(tmp_path):
+            raise RuntimeError('Staging of ' + url + ' failed')
+        checksum = remoteChecksum(url)
+        if checksum is None:
+            print 'StageInCache: no remote checksum for', url, '- not verified'
+        elif eostools.fileChecksum(tmp_path) != checksum:
+            os.remove(tmp_path)
+            raise RuntimeError('Checksum mismatch for staged copy of ' + url)
+        os.rename(tmp_path, path)
+
+    def stage(self, url):
+        '''Returns the local path of url, copying it if not cached yet'''
+        path = self.localPath(url)
+        if path in self.held_locks:
+            return path
+        lock = self.openLock(path)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            dprint('StageInCache: hit', url)
+        else:
+            print 'StageInCache: staging', url
+            self.fetch(url, path)
+        # Mark as recently used and keep it from being evicted
+        os.utime(path, None)
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        self.held_locks[path] = lock
+        return path
+
+    def stageFiles(self, filelist):
+        '''Rewrites filelist to local paths'''
+        local_files = [self.stage(url) for url in filelist]
+        self.evict()
+        return local_files
+
+    def evict(self):
+        '''Removes least recently used files that are not in use by any
+        job until the cache size is below the cap'''
+        dir_lock = open(os.path.join(self.cache_dir, '.cache.lock'), 'a')
+        fcntl.flock(dir_lock, fcntl.LOCK_EX)
+        try:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name.startswith('.') or name.endswith('.lock') or '.part' in name:
+                    continue
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if path in self.held_locks:
+                    continue
+                lock = self.openLock(path)
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # In use by another job
+                    lock.close()
+                    continue
+                print 'StageInCache: evicting', path
+                os.remove(path)
+                total -= size
+                lock.close()
+        finally:
+            dir_lock.close()
+
+
 def get_cmssw_version():
     """returns 'CMSSW_X_Y_Z'"""
     return os.environ["CMSSW_RELEASE_BASE"].split('/')[-1]
@@ -8,9 +8,13 @@ import subprocess
 import argparse
 from collections import namedtuple
 
+import numpy
 from ROOT import TH1F, TChain
 
-from roc_tools import histsToRoc, makeROCPlot
+from roc_tools import histsToRoc, arraysToRoc, makeROCPlot, makeROCGrid, binIndex, groupByBin, aucTable
+from hist_engine import readSelectedColumns
+from tau_ids import add_wp_aliases
+from event_tree import add_event_friend
 
 
 class ROCPlotter(object):
@@ -29,6 +33,15 @@ class ROCPlotter(object):
         ('tau_byDeepTau2017v2p1VSjetraw', 'deep2017v2p1_inv'),
     ]
 
+    # Variables of the differential ROC curves:
+    # name, expression, title, categorical, signal only
+    diff_vars = [
+        ('pt', 'tau_genpt', 'p_{T}^{gen}', False, False),
+        ('eta', 'abs(tau_geneta)', '|#eta^{gen}|', False, False),
+        # Background jets have no generated decay mode
+        ('dm', 'tau_gendm', 'DM^{gen}', True, True),
+    ]
+
     def __init__(self):
 
         self.parseArgs()
@@ -47,6 +60,12 @@ class ROCPlotter(object):
         self.tree_name = self.args.tree_name
         self.selection_denominator = self.args.selection_denominator
         self.bins = self.args.bins
+        self.binned = self.args.binned
+        self.roc_points = self.args.roc_points
+        self.bootstrap = self.args.bootstrap
+        self.processes = self.args.processes
+        # {(files, selection): {scan variable: scores of the selected entries}}
+        self.scores = {}
         self.x_min = self.args.x_min
         self.x_max = self.args.x_max
 
@@ -100,7 +119,21 @@ class ROCPlotter(object):
         parser.add_argument('--selection-denominator', default='1', type=str,
                             help='')
         parser.add_argument('--bins', default='100', type=int,
-                            help='')
+                            help='Score bins of the binned ROC curves (--binned)')
+        parser.add_argument('--binned', action='store_true', default=False,
+                            help='Binned ROC curves from score histograms instead of exact ones')
+        parser.add_argument('--roc-points', default=500, type=int,
+                            help='Points of the exact ROC curves to plot, 0 for every threshold')
+        parser.add_argument('--bootstrap', default=0, type=int,
+                            help='Bootstrap replicas of the uncertainty bands of the exact ROC curves, 0 for none')
+        parser.add_argument('--processes', default=1, type=int,
+                            help='Processes evaluating the bootstrap replicas')
+        parser.add_argument('--diff-pt', default=[], type=float, nargs="*",
+                            help='Gen-pt bin edges of differential ROC curves')
+        parser.add_argument('--diff-eta', default=[], type=float, nargs="*",
+                            help='Gen-|eta| bin edges of differential ROC curves')
+        parser.add_argument('--diff-dm', default=[], type=int, nargs="*",
+                            help='Gen decay modes of differential ROC curves (background inclusive)')
         parser.add_argument('--x-min', default='0.1', type=float,
                             help='')
         parser.add_argument('--x-max', default='1.0', type=float,
@@ -140,39 +173,160 @@ class ROCPlotter(object):
         self.dpprint("setups:", setups)
         return setups
 
+    def readScores(self, scan_variables):
+        '''Reads all scan variables for the signal and background files of
+        all setups, with one pass over each chain'''
+        for signal_files, background_files in zip(self.ds_signal_files, self.ds_background_files):
+            self.scoreArrays(signal_files, self.selection_signal, scan_variables)
+            self.scoreArrays(background_files, self.selection_background, scan_variables)
+
+    def scoreArrays(self, files, selection, scan_variables):
+        '''Scores of the entries of files passing selection, per scan
+        variable. Variables not read yet are read together in one pass.'''
+        scores = self.scores.setdefault((files, selection), {})
+        missing = sorted(set(scan_variables) - set(scores))
+        if missing:
+            chain = TChain(self.tree_name)
+            chain.Add(files)
+            add_wp_aliases(chain)
+            add_event_friend(chain)
+            scores.update(zip(missing, readSelectedColumns(
+                chain, missing, '&&'.join([selection, self.selection_denominator]))))
+        return scores
+
+    def getScores(self, files, scan_variable, selection):
+        '''Scan variable of the entries passing selection, except those with
+        score 0, which do not pass the selection of the scan variable'''
+        scores = self.scoreArrays(files, selection, [scan_variable])[scan_variable]
+        return scores[scores != 0.]
+
     def getROCs(self, setups=[]):
         rocs = []
         for setup in setups:
-            chain_s = TChain(self.tree_name)
-            chain_s.Add(setup.signal_files)
-            # for f_signal in setup.signal_files:
-            #     chain_s.Add(f_signal)
-            h_s = TH1F('signal' + setup.name, '', self.bins+1, -1.0/self.bins, 1.000001) # Add one underflow bin, for events not passing selection
-            chain_s.Draw(setup.scan_variable + '>>' + h_s.GetName(), '&&'.join([self.selection_signal, self.selection_denominator]))
-
-            chain_b = TChain(self.tree_name)
-            chain_b.Add(setup.background_files)
-            # for f_b in setup.background_files:
-            #     chain_b.Add(f_b)
-            h_b = TH1F('background' + setup.name, '', self.bins+1, -1.0/self.bins, 1.000001)
-            chain_b.Draw(setup.scan_variable + '>>' + h_b.GetName(), '&&'.join([self.selection_background, self.selection_denominator]))
-
-            roc = histsToRoc(h_s, h_b, False)
+            if self.binned:
+                roc = self.getBinnedROC(setup)
+            else:
+                roc = arraysToRoc(self.getScores(setup.signal_files, setup.scan_variable, self.selection_signal),
+                                  self.getScores(setup.background_files, setup.scan_variable, self.selection_background),
+                                  n_points=self.roc_points, n_replicas=self.bootstrap, processes=self.processes)
+                if roc is not None:
+                    print setup.title, 'AUC', roc.auc
+                    if self.bootstrap:
+                        print '  bootstrap AUC spread', roc.auc_spread
             roc.title = setup.title
             rocs.append(roc)
         return rocs
 
-    def run(self):
+    def getBinnedROC(self, setup):
+        chain_s = TChain(self.tree_name)
+        chain_s.Add(setup.signal_files)
+        add_wp_aliases(chain_s)
+        add_event_friend(chain_s)
+        # for f_signal in setup.signal_files:
+        #     chain_s.Add(f_signal)
+        h_s = TH1F('signal' + setup.name, '', self.bins+1, -1.0/self.bins, 1.000001) # Add one underflow bin, for events not passing selection
+        chain_s.Draw(setup.scan_variable + '>>' + h_s.GetName(), '&&'.join([self.selection_signal, self.selection_denominator]))
 
-        for scan_var, scan_var_name in self.scan_vars:
-            self.dprint("scanvars", scan_var, scan_var_name)
+        chain_b = TChain(self.tree_name)
+        chain_b.Add(setup.background_files)
+        add_wp_aliases(chain_b)
+        add_event_friend(chain_b)
+        # for f_b in setup.background_files:
+        #     chain_b.Add(f_b)
+        h_b = TH1F('background' + setup.name, '', self.bins+1, -1.0/self.bins, 1.000001)
+        chain_b.Draw(setup.scan_variable + '>>' + h_b.GetName(), '&&'.join([self.selection_background, self.selection_denominator]))
 
+        return histsToRoc(h_s, h_b, False)
+
+    def scanVariables(self):
+        '''(name, expression) of the scan variables'''
+        scan_variables = []
+        for scan_var, scan_var_name in self.scan_vars:
             # Define such that signal -> 1, background -> 0
             # scan_variable = '(tau_decayModeFinding && tau_pt>20. && abs(tau_eta)<2.3) * (1./(1.+{}))'.format(scan_var)
             scan_variable = '(tau_decayModeFindingNewDMs && tau_dm!=5 && tau_dm!=6 && tau_pt>20. && abs(tau_eta)<2.3) * (1./(1.+{}))'.format(scan_var)
             # scan_variable = '(tau_decayModeFinding && tau_pt>20. && abs(tau_eta)<2.3 && abs(tau_tauVtxTovtx_dz)<0.2) * (1./(1.+{}))'.format(scan_var)
             # scan_variable = '(tau_decayModeFinding && tau_pt>0. && abs(tau_eta)<2.3) * (1./(1.+{}))'.format(scan_var)
             # scan_variable = '(tau_decayModeFinding && tau_pt>20. && abs(tau_eta)<2.3) * ({})'.format(scan_var)
+            scan_variables.append((scan_var_name, scan_variable))
+        return scan_variables
+
+    def diffBinning(self):
+        '''(expression, bins, categorical, signal only, labels) of the
+        variables with bins given on the command line'''
+        binning = []
+        for name, expr, title, categorical, signal_only in self.diff_vars:
+            bins = getattr(self.args, 'diff_' + name)
+            if not bins:
+                continue
+            if categorical:
+                labels = ['{} = {}'.format(title, value) for value in bins]
+            else:
+                labels = ['{:g} < {} < {:g}'.format(low, title, high) for low, high in zip(bins[:-1], bins[1:])]
+            binning.append((expr, bins, categorical, signal_only, labels))
+        return binning
+
+    @staticmethod
+    def diffBins(binning):
+        '''(title, background bin) of every bin of the product of the
+        binning, in the order of diffBinIndex'''
+        bins = [('', 0)]
+        for _, _, _, signal_only, labels in binning:
+            n_background = 1 if signal_only else len(labels)
+            bins = [(', '.join(filter(None, [title, label])), background * n_background + (0 if signal_only else i_label))
+                    for title, background in bins for i_label, label in enumerate(labels)]
+        return bins
+
+    @staticmethod
+    def diffBinIndex(columns, binning, scan_variable, signal):
+        '''Bin of each entry in the product of the binning, -1 outside or
+        for score 0. Signal-only variables are skipped for background.'''
+        scores = columns[scan_variable]
+        index = numpy.where(scores != 0., 0, -1)
+        for expr, bins, categorical, signal_only, labels in binning:
+            if signal_only and not signal:
+                continue
+            var_index = binIndex(columns[expr], bins, categorical)
+            index = numpy.where((index >= 0) & (var_index >= 0), index * len(labels) + var_index, -1)
+        return scores, index
+
+    def makeDifferentialROCs(self, setups, scan_var_name, binning):
+        '''Grid of ROC curves per bin and table of their AUC, from the score
+        arrays grouped by bin'''
+        bins = self.diffBins(binning)
+        n_background = max(background for _, background in bins) + 1
+        exprs = [expr for expr, _, _, _, _ in binning]
+        bin_rocs = [[] for _ in bins]
+        for setup in setups:
+            signal = self.scoreArrays(setup.signal_files, self.selection_signal, [setup.scan_variable] + exprs)
+            background = self.scoreArrays(setup.background_files, self.selection_background, [setup.scan_variable] + exprs)
+            signals = groupByBin(*self.diffBinIndex(signal, binning, setup.scan_variable, True), n_bins=len(bins))
+            backgrounds = groupByBin(*self.diffBinIndex(background, binning, setup.scan_variable, False), n_bins=n_background)
+            for i_bin, (bin_title, i_background) in enumerate(bins):
+                roc = arraysToRoc(signals[i_bin], backgrounds[i_background], n_points=self.roc_points)
+                if roc is not None:
+                    roc.title = setup.title
+                bin_rocs[i_bin].append(roc)
+
+        set_name = self.roc_dir + scan_var_name + '_diff'
+        makeROCGrid(bin_rocs, [bin_title for bin_title, _ in bins], set_name,
+                    xmin=self.x_min, xmax=self.x_max, ymin=0.0002, logy=True)
+        table = aucTable([bin_title for bin_title, _ in bins], [setup.title for setup in setups],
+                         [[roc.auc if roc is not None else None for roc in rocs] for rocs in bin_rocs])
+        print table
+        with open(set_name + '_auc.txt', 'w') as f:
+            f.write(table + '\n')
+
+    def run(self):
+        scan_variables = self.scanVariables()
+        binning = self.diffBinning()
+        if not self.binned or binning:
+            # All scores in memory after one pass over each input
+            self.readScores((self.args.ds_scan_variable or [scan_variable for _, scan_variable in scan_variables]) +
+                            [expr for expr, _, _, _, _ in binning])
+
+        for scan_var_name, scan_variable in scan_variables:
+            self.dprint("scanvars", scan_variable, scan_var_name)
             print scan_variable
             if self.args.ds_scan_variable == []:
                 self.ds_scan_variable = [scan_variable] * len(self.args.ds_title)
@@ -181,6 +335,8 @@ class ROCPlotter(object):
             rocs = self.getROCs(setups)
 
             makeROCPlot(rocs, self.roc_dir + scan_var_name, xmin=self.x_min, xmax=self.x_max, ymin=0.0002 if 'mva' in scan_var_name else 0.0002, logy=True)
+            if binning:
+                self.makeDifferentialROCs(setups, scan_var_name, binning)
 
 
 if __name__ == '__main__':
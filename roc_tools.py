@@ -1,6 +1,11 @@
+import math
+import multiprocessing
+
+import numpy
 import ROOT
-from ROOT import gROOT, gStyle, TEfficiency, TRatioPlot, TPad, TLine
+from ROOT import gROOT, gStyle, TEfficiency, TRatioPlot, TPad, TLine, TMath, TLatex
 from officialStyle import officialStyle
+from hist_arrays import graphFromArrays
 
 gROOT.SetBatch(True)
 officialStyle(gStyle)
@@ -70,6 +75,270 @@ def histsToRoc(hsig, hbg, w_error=False):
     return roc
 
 
+def wilsonInterval(eff, n, interval=0.683):
+    '''Wilson score intervals of the efficiencies eff out of n (effective)
+    entries, vectorised'''
+    z2 = 2. * TMath.ErfInverse(interval) ** 2
+    denominator = 1. + z2 / n
+    center = (eff + z2 / (2. * n)) / denominator
+    half_width = numpy.sqrt(z2 * (eff * (1. - eff) / n + z2 / (4. * n * n))) / denominator
+    return center - half_width, center + half_width
+
+
+def clopperPearsonInterval(eff, n, interval=0.683):
+    '''Clopper-Pearson intervals of the efficiencies eff out of n
+    (effective) entries, vectorised (requires scipy)'''
+    from scipy.special import betaincinv
+
+    k = eff * n
+    alpha = (1. - interval) / 2.
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        low = numpy.where(k > 0., betaincinv(k, n - k + 1., alpha), 0.)
+        high = numpy.where(k < n, betaincinv(k + 1., n - k, 1. - alpha), 1.)
+    return low, high
+
+
+intervals = {
+    'wilson': wilsonInterval,
+    'clopper_pearson': clopperPearsonInterval,
+}
+
+
+def rocArea(eff_s, eff_b):
+    '''Area under the signal vs background efficiency curve, starting at
+    (0, 0): the probability that a signal entry scores better than a
+    background one'''
+    x = numpy.concatenate([[0.], eff_b])
+    y = numpy.concatenate([[0.], eff_s])
+    return float(((x[1:] - x[:-1]) * (y[1:] + y[:-1])).sum() / 2.)
+
+
+# ROC being bootstrapped, inherited by the forked pool processes such that
+# the sorted scores are not sent to them
+_bootstrap_roc = []
+
+
+def _bootstrapReplicas(args):
+    '''Background efficiency at the signal efficiencies of grid and AUC of
+    n_replicas Poisson-weighted replicas of the sorted scores'''
+    seed, n_replicas, grid = args
+    roc = _bootstrap_roc[0]
+    rng = numpy.random.RandomState(seed)
+    eff_b = numpy.empty((n_replicas, len(grid)))
+    aucs = numpy.empty(n_replicas)
+    for i_replica in xrange(n_replicas):
+        poisson = rng.poisson(1., len(roc.sorted_weights_s))
+        passed_s = numpy.cumsum(poisson * roc.sorted_weights_s)
+        passed_b = numpy.cumsum(poisson * roc.sorted_weights_b)
+        replica_s = passed_s[roc.ends] / (passed_s[-1] or 1.)
+        replica_b = passed_b[roc.ends] / (passed_b[-1] or 1.)
+        eff_b[i_replica] = numpy.interp(grid, replica_s, replica_b)
+        aucs[i_replica] = rocArea(replica_s, replica_b)
+    return eff_b, aucs
+
+
+class ExactRoc(object):
+    '''Signal and background efficiencies of a cut at every distinct score,
+    from the unbinned (optionally weighted) score arrays, which are sorted
+    once. An entry passes the cut at thresholds[i] if its score is at least
+    the threshold, or at most if lower scores are signal-like.'''
+
+    def __init__(self, signal, background, signal_weights=None, background_weights=None, higher_is_signal=None):
+        signal = numpy.asarray(signal, dtype=numpy.float64)
+        background = numpy.asarray(background, dtype=numpy.float64)
+        w_s = numpy.ones(len(signal)) if signal_weights is None else numpy.asarray(signal_weights, dtype=numpy.float64)
+        w_b = numpy.ones(len(background)) if background_weights is None else numpy.asarray(background_weights, dtype=numpy.float64)
+        self.sum_s, self.sum_b = w_s.sum(), w_b.sum()
+        # Effective numbers of entries for the binomial intervals
+        self.n_s = self.sum_s ** 2 / (w_s ** 2).sum() if len(w_s) else 0.
+        self.n_b = self.sum_b ** 2 / (w_b ** 2).sum() if len(w_b) else 0.
+        if higher_is_signal is None:
+            higher_is_signal = (signal * w_s).sum() * self.sum_b > (background * w_b).sum() * self.sum_s
+        self.higher_is_signal = higher_is_signal
+
+        scores = numpy.concatenate([signal, background])
+        order = numpy.argsort(-scores if higher_is_signal else scores, kind='mergesort')
+        scores = scores[order]
+        weights = numpy.concatenate([w_s, w_b])[order]
+        is_signal = order < len(signal)
+        # Sorted weights, kept for the bootstrap replicas
+        self.sorted_weights_s = numpy.where(is_signal, weights, 0.)
+        self.sorted_weights_b = numpy.where(is_signal, 0., weights)
+        passed_s = numpy.cumsum(self.sorted_weights_s)
+        passed_b = numpy.cumsum(self.sorted_weights_b)
+
+        # A cut keeps all entries with the same score: last entry of each run
+        last = numpy.ones(len(scores), dtype=bool)
+        last[:-1] = scores[1:] != scores[:-1]
+        passed_s, passed_b, scores = passed_s[last], passed_b[last], scores[last]
+        # Skip points where negative weights make the sums decrease
+        kept = (passed_s == numpy.maximum.accumulate(passed_s)) & (passed_b == numpy.maximum.accumulate(passed_b))
+
+        self.ends = numpy.nonzero(last)[0][kept]
+        self.thresholds = scores[kept]
+        self.eff_s = passed_s[kept] / (self.sum_s or 1.)
+        self.eff_b = passed_b[kept] / (self.sum_b or 1.)
+        self.auc = rocArea(self.eff_s, self.eff_b)
+
+    def sample(self, n_points=None):
+        '''Indices of about n_points points, spread evenly in signal
+        efficiency and logarithmically in background efficiency such that the
+        high-rejection region keeps its detail on log-y plots; all points
+        if n_points is not given'''
+        n_all = len(self.eff_s)
+        if not n_points or n_all <= n_points:
+            return numpy.arange(n_all)
+        n_lin = n_points // 2
+        targets_s = numpy.linspace(self.eff_s[0], self.eff_s[-1], n_lin)
+        indices = [numpy.searchsorted(self.eff_s, targets_s), [0, n_all - 1]]
+        positive = self.eff_b[self.eff_b > 0.]
+        if len(positive):
+            targets_b = numpy.logspace(math.log10(positive[0]), math.log10(positive[-1]), n_points - n_lin)
+            indices.append(numpy.searchsorted(self.eff_b, targets_b))
+        return numpy.unique(numpy.minimum(numpy.concatenate(indices), n_all - 1).astype(numpy.int64))
+
+    def bootstrap(self, n_replicas=200, processes=1, n_grid=200, interval=0.683, seed=1):
+        '''Poisson-weighted bootstrap replicas of the scores, which keep
+        the sorting, evaluated in a pool of processes. Returns the signal
+        efficiency grid, the interval of the background efficiency at each
+        grid point (correlated through the threshold, unlike the binomial
+        intervals) and the AUC of every replica.'''
+        grid = numpy.linspace(self.eff_s[0], self.eff_s[-1], n_grid)
+        n_tasks = max(1, min(processes, n_replicas))
+        tasks = [(seed + i_task, n_replicas // n_tasks + (i_task < n_replicas % n_tasks), grid)
+                 for i_task in xrange(n_tasks)]
+        _bootstrap_roc[:] = [self]
+        if n_tasks > 1:
+            pool = multiprocessing.Pool(n_tasks)
+            results = pool.map(_bootstrapReplicas, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(_bootstrapReplicas, tasks)
+        del _bootstrap_roc[:]
+        eff_b = numpy.concatenate([replica_eff_b for replica_eff_b, _ in results])
+        aucs = numpy.concatenate([replica_aucs for _, replica_aucs in results])
+        low, high = numpy.percentile(eff_b, [50. * (1. - interval), 50. * (1. + interval)], axis=0)
+        return grid, low, high, aucs
+
+    def band(self, n_replicas=200, processes=1, interval=0.683):
+        '''Bootstrap band around the ROC graph, which carries the standard
+        deviation of the replica AUCs as auc_spread'''
+        grid, low, high, aucs = self.bootstrap(n_replicas, processes, interval=interval)
+        eff_b = numpy.interp(grid, self.eff_s, self.eff_b)
+        band = graphFromArrays(grid, eff_b, eyl=numpy.maximum(eff_b - low, 0.), eyh=numpy.maximum(high - eff_b, 0.))
+        band.auc_spread = float(aucs.std())
+        return band
+
+    def graph(self, n_points=None, w_error=False, interval=0.683, method='wilson'):
+        '''ROC graph (x: signal, y: background efficiency) of n_points
+        points, with binomial intervals if w_error. The graph carries the
+        auc and the thresholds of its points.'''
+        indices = self.sample(n_points)
+        eff_s, eff_b = self.eff_s[indices], self.eff_b[indices]
+        errors = []
+        if w_error:
+            for eff, n in [(eff_s, self.n_s), (eff_b, self.n_b)]:
+                low, high = intervals[method](eff, n, interval)
+                errors += [numpy.maximum(eff - low, 0.), numpy.maximum(high - eff, 0.)]
+        roc = graphFromArrays(eff_s, eff_b, *errors)
+        roc.auc = self.auc
+        roc.thresholds = self.thresholds[indices]
+        return roc
+
+
+def arraysToRoc(signal, background, w_error=False, n_points=None, signal_weights=None, background_weights=None,
+                n_replicas=0, processes=1):
+    '''Produce exact ROC curve from the signal and background score arrays,
+    downsampled to n_points for plotting, with a bootstrap band of
+    n_replicas replicas as attribute band.
+    '''
+    roc = ExactRoc(signal, background, signal_weights, background_weights)
+    if roc.sum_s <= 0. or roc.sum_b <= 0.:
+        print 'WARNING: Either signal or background scores empty', roc.sum_s, roc.sum_b
+        return None
+    graph = roc.graph(n_points, w_error)
+    if n_replicas:
+        graph.band = roc.band(n_replicas, processes)
+        graph.auc_spread = graph.band.auc_spread
+    return graph
+
+
+def solveWorkingPoints(signal, background, signal_effs=[], background_effs=[], higher_is_signal=None, interval=0.683):
+    '''Score thresholds reaching the target signal efficiencies (tightest
+    cut with at least the target) and background efficiencies (loosest cut
+    with at most the target), read off the sorted scores, with the achieved
+    efficiencies and their Wilson intervals. One dict per target; the
+    threshold is None if no cut reaches the target.'''
+    roc = ExactRoc(signal, background, higher_is_signal=higher_is_signal)
+    targets = [('eff_s', value) for value in signal_effs] + [('eff_b', value) for value in background_effs]
+    n_points = len(roc.thresholds) if roc.sum_s > 0. and roc.sum_b > 0. else 0
+    # Tolerance for targets that are reached exactly
+    indices = numpy.concatenate([
+        numpy.searchsorted(roc.eff_s, numpy.asarray(signal_effs, dtype=numpy.float64) - 1e-12, side='left'),
+        numpy.searchsorted(roc.eff_b, numpy.asarray(background_effs, dtype=numpy.float64) + 1e-12, side='right') - 1,
+    ]).astype(numpy.int64)
+    valid = (indices >= 0) & (indices < n_points)
+    indices = numpy.where(valid, indices, 0)
+    if n_points:
+        eff_s, eff_b = roc.eff_s[indices], roc.eff_b[indices]
+        eff_s_low, eff_s_high = wilsonInterval(eff_s, roc.n_s, interval)
+        eff_b_low, eff_b_high = wilsonInterval(eff_b, roc.n_b, interval)
+    results = []
+    for i_target, (target, value) in enumerate(targets):
+        result = dict(target=target, value=value, threshold=None, higher_is_signal=bool(roc.higher_is_signal))
+        if valid[i_target]:
+            result.update(threshold=float(roc.thresholds[indices[i_target]]),
+                          eff_s=float(eff_s[i_target]), eff_s_low=float(eff_s_low[i_target]), eff_s_high=float(eff_s_high[i_target]),
+                          eff_b=float(eff_b[i_target]), eff_b_low=float(eff_b_low[i_target]), eff_b_high=float(eff_b_high[i_target]))
+        results.append(result)
+    return results
+
+
+def wpSelection(score, cuts, higher_is_signal=True):
+    '''TTree::Draw selection of a working point: score at least (at most)
+    the threshold of the bin. cuts are (bin selection, threshold) pairs.
+    The selection is parenthesised as a whole, since it is joined to other
+    selections with &&.'''
+    op = '>=' if higher_is_signal else '<='
+    terms = ['(({}){}{!r})'.format(score, op, threshold) if bin_cut == '1'
+             else '({}&&({}){}{!r})'.format(bin_cut, score, op, threshold)
+             for bin_cut, threshold in cuts]
+    return '({})'.format('||'.join(terms)) if terms else '0'
+
+
+def binIndex(values, bins, categorical=False):
+    '''Bin of each value, -1 outside. bins are the bin edges or, if
+    categorical, the values of the categories (e.g. decay modes).'''
+    bins = numpy.asarray(bins, dtype=numpy.float64)
+    if categorical:
+        order = numpy.argsort(bins)
+        positions = numpy.minimum(numpy.searchsorted(bins[order], values), len(bins) - 1)
+        return numpy.where(bins[order][positions] == values, order[positions], -1)
+    index = numpy.searchsorted(bins, values, side='right') - 1
+    return numpy.where((index >= 0) & (index < len(bins) - 1), index, -1)
+
+
+def groupByBin(values, index, n_bins):
+    '''Splits values into n_bins arrays by their bin index with one sort,
+    dropping the entries with index -1'''
+    inside = index >= 0
+    values, index = values[inside], index[inside]
+    order = numpy.argsort(index, kind='mergesort')
+    ends = numpy.cumsum(numpy.bincount(index, minlength=n_bins))
+    return numpy.split(values[order], ends[:-1])
+
+
+def aucTable(bin_titles, titles, aucs):
+    '''Text table of the AUC (aucs[bin][curve], None if empty) per bin'''
+    width = max([len(title) for title in bin_titles] + [3])
+    lines = [' '.join(['bin'.ljust(width)] + ['{:>12}'.format(title[:12]) for title in titles])]
+    for bin_title, bin_aucs in zip(bin_titles, aucs):
+        lines.append(' '.join([bin_title.ljust(width)] + [
+            '{:12.4f}'.format(auc) if auc is not None else '{:>12}'.format('-') for auc in bin_aucs]))
+    return '\n'.join(lines)
+
+
 def makeLegend(rocs, textSize=0.035, left=True):
     (x1, y1, x2, y2) = (.18 if left else .68, .76 - textSize * max(len(rocs) - 3, 0), .45 if left else .95, .88)
     leg = ROOT.TLegend(x1, y1, x2, y2)
@@ -86,6 +355,13 @@ def makeLegend(rocs, textSize=0.035, left=True):
     return leg
 
 
+def rocTitle(roc):
+    '''Legend entry, with the AUC and its bootstrap spread if known'''
+    if getattr(roc, 'auc_spread', None) is not None:
+        return '{} (AUC {:.4f} #pm {:.4f})'.format(roc.title, roc.auc, roc.auc_spread)
+    return roc.title
+
+
 def makeROCPlot(rocs, set_name, ymin=0., ymax=1., xmin=0., xmax=1., logy=False):
     print "makeROCPlot"
     allrocs = ROOT.TMultiGraph(set_name, '')
@@ -155,7 +431,18 @@ def makeROCPlot(rocs, set_name, ymin=0., ymax=1., xmin=0., xmax=1., logy=False):
     for graph in point_graphs:
         graph.Draw('Psame')
 
-    allrocs.leg = makeLegend(zip([r.title for r in rocs], rocs))
+    # Bootstrap bands of the exact ROC curves
+    allrocs.bands = []
+    for graph in rocs:
+        band = getattr(graph, 'band', None)
+        if band is None:
+            continue
+        band.SetFillColorAlpha(graph.GetLineColor(), 0.3)
+        band.SetLineWidth(0)
+        band.Draw('3')
+        allrocs.bands.append(band)
+
+    allrocs.leg = makeLegend(zip([rocTitle(r) for r in rocs], rocs))
 
     c.cd()          # Go back to the main canvas before defining pad2
     pad2 = TPad("pad2", "pad2", 0, 0.0, 1, 0.27)
@@ -209,3 +496,44 @@ def makeROCPlot(rocs, set_name, ymin=0., ymax=1., xmin=0., xmax=1., logy=False):
     c.Print(set_name + '.png')
 
     return allrocs
+
+
+def makeROCGrid(bin_rocs, bin_titles, set_name, ymin=0., ymax=1., xmin=0., xmax=1., logy=False):
+    '''One pad per bin with its ROC curves (bin_rocs[bin][curve], None if
+    empty, such that a curve keeps its colour in all pads)'''
+    n_cols = int(math.ceil(math.sqrt(len(bin_rocs))))
+    n_rows = int(math.ceil(float(len(bin_rocs)) / n_cols))
+    c = ROOT.TCanvas('c_' + set_name, '', 400 * n_cols, 400 * n_rows)
+    c.Divide(n_cols, n_rows)
+    grid = []
+    for i_bin, (rocs, bin_title) in enumerate(zip(bin_rocs, bin_titles)):
+        pad = c.cd(i_bin + 1)
+        if ymin > 0. and logy:
+            pad.SetLogy()
+        allrocs = ROOT.TMultiGraph('{}_{}'.format(set_name, i_bin), '')
+        for i_col, graph in enumerate(rocs):
+            if graph is None:
+                continue
+            graph.SetLineColor(colours[i_col])
+            graph.SetMarkerColor(colours[i_col])
+            graph.SetLineWidth(2)
+            graph.SetMarkerSize(0)
+            allrocs.Add(graph)
+        if not allrocs.GetListOfGraphs():
+            continue
+        allrocs.Draw('AL')
+        allrocs.GetXaxis().SetTitle('#epsilon_{s}')
+        allrocs.GetYaxis().SetTitle('#epsilon_{b}')
+        allrocs.GetYaxis().SetRangeUser(ymin, ymax)
+        allrocs.GetXaxis().SetRangeUser(xmin, xmax)
+        allrocs.tex = TLatex(0.18, 0.95, bin_title)
+        allrocs.tex.SetNDC()
+        allrocs.tex.SetTextFont(42)
+        allrocs.tex.SetTextSize(0.045)
+        allrocs.tex.Draw()
+        if not grid:
+            allrocs.leg = makeLegend([(graph.title, graph) for graph in rocs if graph is not None])
+        grid.append(allrocs)
+    c.Print(set_name + '.png')
+
+    return grid
@@ -0,0 +1,78 @@
+''' Splits the plot jobs of compare.py into parts of similar cost. A job
+is estimated as tree entries x expression complexity (summed over the
+releases) until its measured cost is known from an earlier run. Measured
+costs are recorded per part and merged into the cost file afterwards, such
+that all parts of one run see the same cost file and agree on the split.
+'''
+
+import os
+import glob
+import heapq
+import json
+from collections import namedtuple
+
+from expressions import tokenize, ExpressionError
+
+PlotJob = namedtuple('PlotJob', 'key estimate')
+
+
+def expressionComplexity(expr):
+    try:
+        return max(1, len(tokenize(expr)))
+    except ExpressionError:
+        return len(expr.split())
+
+
+def estimateCost(exprs, n_entries):
+    return n_entries * sum(expressionComplexity(expr) for expr in exprs)
+
+
+def loadCosts(cost_file):
+    if not os.path.exists(cost_file):
+        return {}
+    with open(cost_file) as f:
+        return json.load(f)
+
+
+def jobCosts(jobs, costs):
+    '''Measured cost of each job (seconds). Jobs without measurement get
+    their estimate converted with the median seconds per estimate unit of
+    the measured jobs.'''
+    ratios = sorted(costs[job.key] / job.estimate for job in jobs
+                    if job.key in costs and job.estimate > 0)
+    scale = ratios[len(ratios) // 2] if ratios else 1.
+    return [costs[job.key] if job.key in costs else job.estimate * scale
+            for job in jobs]
+
+
+def schedule(jobs, n_parts, costs=None):
+    '''Returns n_parts lists of jobs with similar summed cost (longest
+    processing time first). Deterministic for the same jobs and costs.'''
+    weighted = sorted(zip(jobCosts(jobs, costs or {}), jobs),
+                      key=lambda item: (-item[0], item[1].key))
+    parts = [[] for _ in range(n_parts)]
+    loads = [(0., i_part) for i_part in range(n_parts)]
+    for cost, job in weighted:
+        load, i_part = heapq.heappop(loads)
+        parts[i_part].append(job)
+        heapq.heappush(loads, (load + cost, i_part))
+    return parts
+
+
+def recordCosts(cost_file, part, measured):
+    '''Writes the measured costs of one part next to the cost file'''
+    with open('{}.part{}'.format(cost_file, part), 'w') as f:
+        json.dump(measured, f)
+
+
+def mergeCosts(cost_file):
+    '''Merges the recorded costs of all parts into the cost file'''
+    costs = loadCosts(cost_file)
+    part_files = glob.glob(cost_file + '.part*')
+    for part_file in part_files:
+        with open(part_file) as f:
+            costs.update(json.load(f))
+    with open(cost_file, 'w') as f:
+        json.dump(costs, f, indent=1, sort_keys=True)
+    for part_file in part_files:
+        os.remove(part_file)
@@ -0,0 +1,138 @@
+''' Solves for the score thresholds of working points with given signal
+efficiencies or background rates, inclusively or per reco pt or decay mode
+bin. Each sample is read in one pass and the thresholds are read off its
+sorted scores. The working points are written as vardict entries, which
+compare.py adds to its efficiency plots with --wpFile, e.g.
+
+python solve_wps.py --score tau_byDeepTau2017v2p1VSjetraw --signal-effs 0.5 0.7 --dms 0 1 10 11 \
+    --signal-files Myroot_ZTT.root --background-files Myroot_QCD.root --name deepVSjet
+'''
+
+import json
+import argparse
+
+import numpy
+from ROOT import TChain
+
+from expressions import ExpressionCompiler
+from hist_engine import readSelectedColumns
+from roc_tools import solveWorkingPoints, wpSelection, binIndex, groupByBin
+from tau_ids import add_wp_aliases
+from event_tree import add_event_friend
+
+
+def readScores(files, tree_name, exprs, selection):
+    chain = TChain(tree_name)
+    for file_name in files:
+        chain.Add(file_name)
+    add_wp_aliases(chain)
+    add_event_friend(chain)
+    return readSelectedColumns(chain, exprs, selection)
+
+
+def checkWorkingPoint(selection, score, scores, bin_var, bin_values, bin_index, bin_results):
+    '''Evaluates the working point selection on the signal scores, as the
+    columnar engine does, and checks that joined to a failing selection it
+    never passes and that its efficiency in each bin is the solved one'''
+    compiler = ExpressionCompiler()
+    score_key = compiler.compile(score)
+    key = compiler.compile(selection)
+    guarded = compiler.compile('0&&' + selection)
+    size = len(scores)
+    columns = {bin_var: bin_values} if bin_var else {}
+    # The score is known, its columns need not be read again
+    cache = {score_key: scores}
+    if compiler.evaluate(guarded, columns, dict(cache), size).any():
+        raise RuntimeError('Working point selection {} passes when joined to a failing selection'.format(selection))
+    passed = compiler.evaluate(key, columns, cache, size) != 0.
+    for i_bin, result in enumerate(bin_results):
+        in_bin = bin_index == i_bin
+        if result['threshold'] is None or not in_bin.any():
+            continue
+        eff_s = passed[in_bin].mean()
+        if eff_s > 1. or abs(eff_s - result['eff_s']) > 1e-9:
+            raise RuntimeError('Working point selection {} gives efficiency {} in bin {} instead of {}'.format(
+                selection, eff_s, i_bin, result['eff_s']))
+
+
+def wpName(name, target, value):
+    return '{}_{}{:g}'.format(name, 'effS' if target == 'eff_s' else 'effB', value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Working point thresholds from target efficiencies')
+    parser.add_argument('--score', required=True, help='Score expression of the discriminator')
+    parser.add_argument('--name', default='solvedWP', help='Prefix of the working point names')
+    parser.add_argument('--signal-files', required=True, nargs='*', help='Signal files (or glob patterns)')
+    parser.add_argument('--background-files', required=True, nargs='*', help='Background files (or glob patterns)')
+    parser.add_argument('--tree-name', default='per_tau', help='Tree name')
+    parser.add_argument('--selection-signal', default='tau_pt > 20. && abs(tau_eta)<2.3', help='Denominator of the signal efficiency')
+    parser.add_argument('--selection-background', default='tau_pt > 20. && abs(tau_eta)<2.3', help='Denominator of the background rate')
+    parser.add_argument('--signal-effs', default=[], type=float, nargs='*', help='Target signal efficiencies')
+    parser.add_argument('--background-effs', default=[], type=float, nargs='*', help='Target background efficiencies (fake rates)')
+    parser.add_argument('--direction', default='auto', choices=['auto', 'higher', 'lower'],
+                        help='Whether higher or lower scores are signal-like; auto compares the mean scores')
+    bins = parser.add_mutually_exclusive_group()
+    bins.add_argument('--pt-bins', default=[], type=float, nargs='*', help='Reco pt bin edges of per-bin thresholds')
+    bins.add_argument('--dms', default=[], type=int, nargs='*', help='Reco decay modes of per-bin thresholds')
+    parser.add_argument('-o', '--output', default='solved_wps.json', help='Output file for compare.py --wpFile')
+    args = parser.parse_args()
+
+    # Thresholds are applied to reco taus, so the bins are in reco variables
+    if args.pt_bins:
+        bin_var, bins, categorical = 'tau_pt', args.pt_bins, False
+        bin_cuts = ['tau_pt>={:g}&&tau_pt<{:g}'.format(low, high) for low, high in zip(bins[:-1], bins[1:])]
+    elif args.dms:
+        bin_var, bins, categorical = 'tau_dm', args.dms, True
+        bin_cuts = ['tau_dm=={}'.format(dm) for dm in bins]
+    else:
+        bin_var, bins, categorical, bin_cuts = None, None, False, ['1']
+    exprs = [args.score] + ([bin_var] if bin_var else [])
+
+    samples = []
+    for files, selection in [(args.signal_files, args.selection_signal),
+                             (args.background_files, args.selection_background)]:
+        columns = readScores(files, args.tree_name, exprs, selection)
+        index = binIndex(columns[1], bins, categorical) if bin_var else numpy.zeros(columns.shape[1], dtype=numpy.int64)
+        samples.append((columns, index, groupByBin(columns[0], index, len(bin_cuts))))
+    (signal_columns, signal_index, signals), (background_columns, _, backgrounds) = samples
+    signal, background = signal_columns[0], background_columns[0]
+
+    # One direction for all bins
+    if args.direction == 'auto':
+        higher_is_signal = bool(len(signal) and len(background) and signal.mean() > background.mean())
+    else:
+        higher_is_signal = args.direction == 'higher'
+
+    results = [solveWorkingPoints(bin_signal, bin_background, args.signal_effs, args.background_effs, higher_is_signal)
+               for bin_signal, bin_background in zip(signals, backgrounds)]
+
+    solved = {}
+    for i_target, (target, value) in enumerate([('eff_s', value) for value in args.signal_effs] +
+                                               [('eff_b', value) for value in args.background_effs]):
+        name = wpName(args.name, target, value)
+        print '{} ({} = {:g}):'.format(name, target, value)
+        cuts = []
+        for bin_cut, bin_results in zip(bin_cuts, results):
+            result = bin_results[i_target]
+            if result['threshold'] is None:
+                print '  {:30} not reachable'.format(bin_cut)
+                continue
+            print '  {:30} threshold {:.6g}  eff_s {:.4f} [{:.4f}, {:.4f}]  eff_b {:.3e} [{:.3e}, {:.3e}]'.format(
+                bin_cut, result['threshold'], result['eff_s'], result['eff_s_low'], result['eff_s_high'],
+                result['eff_b'], result['eff_b_low'], result['eff_b_high'])
+            cuts.append((bin_cut, result['threshold']))
+        selection = wpSelection(args.score, cuts, higher_is_signal)
+        checkWorkingPoint(selection, args.score, signal, bin_var, signal_columns[-1], signal_index,
+                          [bin_results[i_target] for bin_results in results])
+        solved[name] = {'var': selection, 'nbin': 2, 'min': -0.5, 'max': 1.5, 'title': name}
+
+    with open(args.output, 'w') as f:
+        json.dump({'vardict': solved,
+                   'results': [dict(bin=bin_cut, results=bin_results) for bin_cut, bin_results in zip(bin_cuts, results)]},
+                  f, indent=1, sort_keys=True)
+    print 'Wrote', len(solved), 'working points to', args.output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+''' Storage profiles of the per_tau output: precision of the floating point
+branches, compression algorithm and level, and basket/auto-flush settings.
+'fast' is meant for trees that are re-read often by compare.py, 'archive'
+for trees that are kept long term.
+'''
+
+import os
+from fnmatch import fnmatch
+from time import time
+
+import numpy
+import ROOT
+
+# ROOT compression algorithms, setting = 100 * algorithm + level
+ZLIB, LZMA, LZ4 = 1, 2, 4
+
+profiles = {
+    'default': {'single': False, 'algorithm': None, 'level': None,
+                'basket_size': None, 'auto_flush': None},
+    'fast': {'single': True, 'algorithm': LZ4, 'level': 4,
+             'basket_size': 256000, 'auto_flush': -30000000},
+    'archive': {'single': True, 'algorithm': LZMA, 'level': 8,
+                'basket_size': 512000, 'auto_flush': -60000000},
+}
+
+
+class StorageProfile(object):
+    '''Applies a storage profile to the variables, file and tree of a
+    production. Floating point variables matching one of the double_vars
+    patterns are kept in double precision.
+    '''
+
+    def __init__(self, name='default', double_vars=None):
+        self.name = name
+        self.__dict__.update(profiles[name])
+        self.double_vars = double_vars or []
+
+    def compression(self):
+        '''Compression setting for TFile/TFileMerger, None for ROOT default'''
+        if self.algorithm is None:
+            return None
+        return 100 * self.algorithm + self.level
+
+    def variableTypes(self, variables):
+        '''Maps float variables to numpy.float32 unless kept in double'''
+        if not self.single:
+            return variables
+        return [(name, numpy.float32 if vtype is float and
+                 not any(fnmatch(name, pattern) for pattern in self.double_vars)
+                 else vtype)
+                for name, vtype in variables]
+
+    def openFile(self, file_name):
+        if self.compression() is None:
+            return ROOT.TFile(file_name, 'recreate')
+        return ROOT.TFile(file_name, 'recreate', '', self.compression())
+
+    def configureTree(self, tree):
+        '''Call after all branches are booked'''
+        if self.basket_size:
+            tree.SetBasketSize('*', self.basket_size)
+        if self.auto_flush:
+            tree.SetAutoFlush(self.auto_flush)
+
+
+def reportStorage(file_name, tree_name='per_tau'):
+    '''Prints size, compression factor and sequential read speed of a tree'''
+    in_file = ROOT.TFile(file_name)
+    tree = in_file.Get(tree_name)
+    n_entries = tree.GetEntries()
+    start = time()
+    for i in xrange(n_entries):
+        tree.GetEntry(i)
+    read_time = time() - start
+    size = os.path.getsize(file_name) / 1.e6
+    zip_bytes = tree.GetZipBytes()
+    print 'Storage report for', file_name
+    print '  file size: {:.1f} MB, {} entries, {:.0f} bytes/entry'.format(
+        size, n_entries, zip_bytes / max(n_entries, 1.))
+    print '  compression factor: {:.2f}'.format(tree.GetTotBytes() / max(zip_bytes, 1.))
+    print '  full read: {:.1f} s, {:.1f} MB/s, {:.0f} entries/s'.format(
+        read_time, zip_bytes / 1.e6 / max(read_time, 1.e-6), n_entries / max(read_time, 1.e-6))
+    in_file.Close()
@@ -1,3 +1,6 @@
+import numpy
+import ROOT
+
 all_tau_ids = [
     ('byCombinedIsolationDeltaBetaCorrRaw3Hits', float),
     ('byLooseCombinedIsolationDeltaBetaCorr3Hits', int),
@@ -98,9 +101,34 @@ def create_tau_ids(name, n_wps=7):
       rawname = 'by' + name[:-4] + 'raw' + name[-4:]
     else:
       rawname = 'by' + name + 'raw'
+    wp_families[name] = ['by' + wp + name for wp in wps]
     return [('by' + wp + name, int) for wp in wps] + [(rawname, float)]
 
 
+# Working points per discriminator family, in bit order of the packed branch
+wp_families = {
+    'IsolationMVArun2v1DBoldDMwLT': ['by' + wp + 'IsolationMVArun2v1DBoldDMwLT' for wp in all_wps],
+    'IsolationMVArun2v1DBnewDMwLT': ['by' + wp + 'IsolationMVArun2v1DBnewDMwLT' for wp in all_wps],
+    'IsolationMVArun2v1DBdR03oldDMwLT': ['by' + wp + 'IsolationMVArun2v1DBdR03oldDMwLT' for wp in all_wps],
+    'CombinedIsolationDeltaBetaCorr3Hits': ['by' + wp + 'CombinedIsolationDeltaBetaCorr3Hits' for wp in ['Loose', 'Medium', 'Tight']],
+}
+
+
+def packed_branch_name(family):
+    return 'tau_by' + family + 'WPs'
+
+
+def add_wp_aliases(tree):
+    '''Makes the bits of packed WP branches available under the names of
+    the single WP branches, e.g. tau_byLooseDeepTau2017v2p1VSjet'''
+    for family, wps in wp_families.iteritems():
+        packed = packed_branch_name(family)
+        if not tree.GetBranch(packed):
+            continue
+        for bit, tau_id in enumerate(wps):
+            tree.SetAlias(branch_name(tau_id), '(({}>>{})&1)'.format(packed, bit))
+
+
 tau_ids = {
     'deepTauIDv2p1VSe':create_tau_ids('DeepTau2017v2p1VSe', 8),
     'deepTauIDv2p1VSmu':create_tau_ids('DeepTau2017v2p1VSmu', 4),
@@ -112,6 +140,110 @@ tau_ids = {
     'dR0p32017v2':create_tau_ids('IsolationMVArun2017v2DBoldDMdR0p3wLT2017')
 }
 
-def fill_tau_ids(avd, tau, tau_id_names):
-    for (tau_id, _) in tau_id_names:
-        avd['tau_'+tau_id.replace("2018", "").replace("Simple", "3")].fill(tau.tauID(tau_id))
+def get_run_tau_ids(tau_collection, mvaid, no_anti_lepton=False):
+    run_tau_ids = list(all_tau_ids)
+    if tau_collection == "selectedPatTaus":
+        run_tau_ids += selected_pat_tau_ids
+    elif tau_collection == "slimmedTaus":
+        run_tau_ids += slimmed_tau_ids
+
+    if not no_anti_lepton:
+        run_tau_ids += lepton_tau_ids
+
+    for mva_id in mvaid:
+        run_tau_ids += tau_ids[mva_id]
+    return run_tau_ids
+
+
+def branch_name(tau_id):
+    '''The 2018 anti-e and the "Simple" anti-mu IDs are stored under the
+    branch names of their standard counterparts'''
+    return 'tau_' + tau_id.replace("2018", "").replace("Simple", "3")
+
+
+fill_tau_ids_code = '''
+#include "DataFormats/PatCandidates/interface/Tau.h"
+namespace tauval {
+void fillTauIDs(const pat::Tau& tau, const std::vector<std::string>& names,
+                std::vector<int>& positions, double* out) {
+  const std::vector<pat::Tau::IdPair>& ids = tau.tauIDs();
+  for (size_t i = 0; i < names.size(); ++i) {
+    int pos = positions[i];
+    if (pos < 0 || pos >= int(ids.size()) || ids[pos].first != names[i]) {
+      pos = -1;
+      for (size_t j = 0; j < ids.size(); ++j) {
+        if (ids[j].first == names[i]) { pos = j; break; }
+      }
+      positions[i] = pos;
+    }
+    out[i] = pos >= 0 ? ids[pos].second : tau.tauID(names[i]);
+  }
+}
+}
+'''
+
+
+class TauIDTable(object):
+    '''Accessor table compiled once per run. Maps every requested tau ID to
+    its output slot and fetches all discriminators of a tau in one call,
+    using the position of each ID in the pat::Tau ID vector.
+    '''
+
+    def __init__(self, tau_id_names, pack_wps=False):
+        self.branches = []
+        self.types = {}
+        self.tau_ids = {}
+        for tau_id, v_type in tau_id_names:
+            name = branch_name(tau_id)
+            if name not in self.types:
+                self.branches.append(name)
+                self.types[name] = v_type
+            # If several IDs share a branch, the last one is stored
+            self.tau_ids[name] = tau_id
+
+        # Families with all WPs requested are stored as one 8-bit mask
+        self.packed = {}
+        if pack_wps:
+            for family, wps in sorted(wp_families.iteritems()):
+                wp_branches = [branch_name(tau_id) for tau_id in wps]
+                if all(name in self.types for name in wp_branches):
+                    self.packed[packed_branch_name(family)] = wp_branches
+
+    def variables(self):
+        packed_wps = set(name for wps in self.packed.itervalues() for name in wps)
+        return [(name, self.types[name]) for name in self.branches if name not in packed_wps] + \
+            [(name, numpy.uint8) for name in sorted(self.packed)]
+
+    def compile(self, record):
+        self.names = [self.tau_ids[name] for name in self.branches]
+        self.values = numpy.zeros(len(self.names))
+        self.packs = []
+        for packed, wps in self.packed.iteritems():
+            values, index = record.slot(packed)
+            sources = numpy.array([self.branches.index(name) for name in wps])
+            self.packs.append((values, index, sources, 1 << numpy.arange(len(wps))))
+        packed_wps = set(name for wps in self.packed.itervalues() for name in wps)
+
+        # IDs stored as their own branch, in the order of self.values
+        self.sources = numpy.array([i_name for i_name, name in enumerate(self.branches)
+                                    if name not in packed_wps], dtype=numpy.int64)
+        self.slots = record.slotGroup([self.branches[i_name] for i_name in self.sources])
+
+        self.batched = bool(ROOT.gInterpreter.Declare(fill_tau_ids_code))
+        if self.batched:
+            self.cpp_names = ROOT.std.vector('string')()
+            for tau_id in self.names:
+                self.cpp_names.push_back(tau_id)
+            self.cpp_positions = ROOT.std.vector('int')(len(self.names), -1)
+        else:
+            print 'WARNING: Cannot compile batched tau ID access, falling back to tauID calls'
+
+    def fill(self, tau):
+        if self.batched:
+            ROOT.tauval.fillTauIDs(tau, self.cpp_names, self.cpp_positions, self.values)
+        else:
+            for i_name, tau_id in enumerate(self.names):
+                self.values[i_name] = tau.tauID(tau_id)
+        self.slots.fill(self.values[self.sources])
+        for values, index, sources, bits in self.packs:
+            values[index] = bits[self.values[sources] > 0.5].sum()
@@ -0,0 +1,154 @@
+''' Statistical triage of the comparison plots. Every plot is compared to
+the reference release (the first one) before it is rendered: histograms
+with a chi2 test of the normalised shapes and a binned Kolmogorov-Smirnov
+test, efficiency graphs with per-point pulls. The score of a plot is
+-log10 of its smallest p-value over releases and tests, such that with a
+threshold only plots showing a significant difference are rendered. The
+scores of all parts are merged into a ranked JSON and HTML summary.
+'''
+
+import os
+import cgi
+import glob
+import json
+import math
+
+import numpy
+from ROOT import TMath
+
+from hist_arrays import histArray, histSumw2, graphArrays, graphYErrors
+
+
+def score(p_value):
+    return -math.log10(max(p_value, 1e-300))
+
+
+def histCompatibility(hist, ref):
+    '''chi2, ndf and p-value of the shape chi2 test and KS distance and
+    p-value of two 1D histograms, under- and overflow excluded'''
+    n, n_ref = histArray(hist)[1:-1].astype(numpy.float64), histArray(ref)[1:-1].astype(numpy.float64)
+    w2, w2_ref = histSumw2(hist)[1:-1], histSumw2(ref)[1:-1]
+    total, total_ref = n.sum(), n_ref.sum()
+    if total <= 0. or total_ref <= 0.:
+        return None
+    p, p_ref = n / total, n_ref / total_ref
+    variance = w2 / total ** 2 + w2_ref / total_ref ** 2
+    used = variance > 0.
+    chi2 = float(((p - p_ref)[used] ** 2 / variance[used]).sum())
+    ndf = max(int(used.sum()) - 1, 1)
+
+    distance = float(numpy.abs(numpy.cumsum(p) - numpy.cumsum(p_ref)).max())
+    # Effective numbers of entries of weighted histograms
+    n_eff = total ** 2 / w2.sum() if w2.sum() > 0. else total
+    n_eff_ref = total_ref ** 2 / w2_ref.sum() if w2_ref.sum() > 0. else total_ref
+    ks_prob = TMath.KolmogorovProb(distance * math.sqrt(n_eff * n_eff_ref / (n_eff + n_eff_ref)))
+    return dict(chi2=chi2, ndf=ndf, chi2_prob=TMath.Prob(chi2, ndf),
+                ks=distance, ks_prob=ks_prob)
+
+
+def graphCompatibility(graph, ref):
+    '''Pulls of the efficiency points of graph with respect to ref, using
+    the asymmetric errors towards the other point, and their chi2'''
+    _, y = graphArrays(graph)
+    _, y_ref = graphArrays(ref)
+    n_points = min(len(y), len(y_ref))
+    if not n_points:
+        return None
+    y, y_ref = y[:n_points], y_ref[:n_points]
+    low, high = [errors[:n_points] for errors in graphYErrors(graph)]
+    low_ref, high_ref = [errors[:n_points] for errors in graphYErrors(ref)]
+    above = y > y_ref
+    sigma = numpy.sqrt(numpy.where(above, low ** 2 + high_ref ** 2, high ** 2 + low_ref ** 2))
+    used = sigma > 0.
+    pulls = numpy.zeros(n_points)
+    pulls[used] = (y - y_ref)[used] / sigma[used]
+    chi2 = float((pulls ** 2).sum())
+    ndf = max(int(used.sum()), 1)
+    return dict(pulls=[round(pull, 3) for pull in pulls], max_pull=float(numpy.abs(pulls).max()),
+                chi2=chi2, ndf=ndf, chi2_prob=TMath.Prob(chi2, ndf))
+
+
+class Triage(object):
+    '''Collects the compatibility scores of the plots of one part and
+    decides which plots are rendered'''
+
+    def __init__(self, threshold=0.):
+        self.threshold = threshold
+        self.scores = {}
+
+    def record(self, plot, image, releases):
+        '''releases maps release names to compatibility dicts (or None)'''
+        releases = dict((name, result) for name, result in releases.iteritems() if result)
+        p_values = [result[key] for result in releases.values()
+                    for key in ['chi2_prob', 'ks_prob'] if key in result]
+        plot_score = score(min(p_values)) if p_values else 0.
+        self.scores[plot] = dict(score=plot_score, image=image, releases=releases)
+        return plot_score
+
+    def checkHists(self, plot, image, hists):
+        '''Scores hists against hists[0], returns whether to render the plot'''
+        return self.record(plot, image, dict(
+            (hist.GetName(), histCompatibility(hist, hists[0])) for hist in hists[1:])) >= self.threshold
+
+    def checkGraphs(self, plot, image, graphs):
+        '''Scores efficiency graphs against graphs[0], returns whether to
+        render the plot'''
+        return self.record(plot, image, dict(
+            (graph.GetName(), graphCompatibility(graph, graphs[0])) for graph in graphs[1:])) >= self.threshold
+
+
+def recordScores(triage_file, part, scores):
+    '''Writes the scores of one part next to the triage file'''
+    directory = os.path.dirname(triage_file)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by a parallel part
+            pass
+    with open('{}.part{}'.format(triage_file, part), 'w') as f:
+        json.dump(scores, f)
+
+
+def mergeScores(triage_file):
+    '''Merges the scores of all parts into the ranked triage file and an
+    HTML summary next to it'''
+    scores = {}
+    part_files = glob.glob(triage_file + '.part*')
+    if not part_files:
+        return
+    for part_file in part_files:
+        with open(part_file) as f:
+            scores.update(json.load(f))
+    ranked = sorted(scores.items(), key=lambda item: (-item[1]['score'], item[0]))
+    directory = os.path.dirname(triage_file)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(triage_file, 'w') as f:
+        json.dump([dict(plot=plot, **result) for plot, result in ranked], f, indent=1)
+    with open(os.path.splitext(triage_file)[0] + '.html', 'w') as f:
+        f.write(htmlSummary(ranked, directory))
+    for part_file in part_files:
+        os.remove(part_file)
+
+
+def htmlSummary(ranked, directory=''):
+    '''Ranked table of the plots, linking the rendered ones'''
+    rows = []
+    for plot, result in ranked:
+        details = '<br>'.join(
+            '{}: {}'.format(cgi.escape(name), ', '.join(
+                '{}={:.3g}'.format(key, value) for key, value in sorted(values.items())
+                if not isinstance(value, list)))
+            for name, values in sorted(result['releases'].items()))
+        image = result['image']
+        link = '<a href="{0}">{1}</a>'.format(cgi.escape(os.path.relpath(image, directory or '.')), cgi.escape(plot)) \
+            if image and os.path.exists(image) else cgi.escape(plot)
+        rows.append('<tr><td>{:.2f}</td><td>{}</td><td>{}</td></tr>'.format(result['score'], link, details))
+    return '''<html><head><title>Comparison triage</title></head><body>
+<p>Score: -log10 of the smallest p-value (chi2/KS for histograms, pulls for efficiencies) against the reference release</p>
+<table border="1">
+<tr><th>score</th><th>plot</th><th>tests</th></tr>
+{}
+</table></body></html>
+'''.format('\n'.join(rows))
@@ -1,3 +1,7 @@
+# WP selections like tau_byLooseDeepTau2017v2p1VSjet > 0.5 also work on trees
+# produced with --packWPs: tau_ids.add_wp_aliases maps them to the mask bits.
+import json
+
 vardict = {
 
     #============================================================================================================================
@@ -591,3 +595,12 @@ cvardict = {
     'tau_hcalEnergyLeadChargedHadrCandFrac' : {'var': 'tau_hcalEnergyLeadChargedHadrCandFrac', 'nbin': 101, 'min': -0.1, 'max': 0.1, 'title': 'hcal Energy LeadChargedHadrCand Frac', 'sel': 'tau_genpt>0&&tau_pt>0', 'dim': 1, 'norm': 'abs'},
     'tau_ecalEnergyLeadChargedHadrCandFrac' : {'var': 'tau_ecalEnergyLeadChargedHadrCandFrac', 'nbin': 101, 'min': -0.1, 'max': 0.1, 'title': 'ecal Energy LeadChargedHadrCand Frac', 'sel': 'tau_genpt>0&&tau_pt>0', 'dim': 1, 'norm': 'abs'},
 }
+
+
+def addSolvedWPs(file_name):
+    '''Adds the working points written by solve_wps.py to vardict'''
+    with open(file_name) as f:
+        solved = json.load(f)['vardict']
+    for name, h_dict in solved.iteritems():
+        vardict[str(name)] = dict((str(key), str(value) if isinstance(value, unicode) else value)
+                                  for key, value in h_dict.iteritems())